@@ -0,0 +1,162 @@
+import os
+import json
+from typing import Dict, List, Optional, Tuple
+import metrics
+from config import JOURNAL_FSYNC_EVERY
+from utils import get_video_name, create_directory, create_coco_annotation_base, save_coco_annotations
+
+
+def read_journal(journal_path: str) -> Tuple[List[Dict], List[Dict], int]:
+    """Images and annotations recorded in a journal, and the size of its complete lines
+
+    Reading stops at a partial line left by an interrupted append. The file is
+    not modified, so journals another process may still append to can be read.
+    A frame journaled again, after an interruption before its progress was
+    checkpointed, replaces the earlier record and its annotations.
+    """
+    images, annotations = {}, {}  # image id -> image, image id -> its annotations
+    valid_size = 0
+    with open(journal_path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            data = record["data"]
+            if record["type"] == "image":
+                images.pop(data["id"], None)
+                images[data["id"]] = data
+                annotations[data["id"]] = []
+            else:
+                annotations.setdefault(data["image_id"], []).append(data)
+            valid_size += len(line)
+    return list(images.values()), [ann for image_anns in annotations.values() for ann in image_anns], valid_size
+
+
+class AnnotationJournal:
+    """Append-only record of the COCO images and annotations of one video
+
+    Every new image or annotation is appended as one JSON line instead of
+    rewriting the whole COCO document. Appends are buffered and fsynced in
+    batches of `fsync_every` records or on `sync`. The COCO JSON file is only
+    written by `compact`, once per video or on demand.
+
+    With `part` the journal records one work unit of a video in
+    annotations/parts/<video>/<part>.jsonl. Parts are merged into the video's
+    journal by the coordinator, compacting a part only syncs it.
+    """
+
+    def __init__(self, video_path: str, fsync_every: int = JOURNAL_FSYNC_EVERY, part: Optional[str] = None):
+        self.video_path = video_path
+        self.fsync_every = max(1, fsync_every)
+        self.video_name = get_video_name(video_path)
+        self.part = part
+        if part is None:
+            self.annotation_dir = 'annotations'
+            self.journal_path = os.path.join(self.annotation_dir, f"{self.video_name}_annotations.jsonl")
+        else:
+            self.annotation_dir = os.path.join('annotations', 'parts', self.video_name)
+            self.journal_path = os.path.join(self.annotation_dir, f"{part}.jsonl")
+        self.annotation_path = os.path.join('annotations', f"{self.video_name}_annotations.json")
+        self._file = None
+        self._unsynced = 0
+
+    def load(self) -> Dict:
+        """Rebuild the COCO document by replaying the journal
+
+        A COCO file written before the journal existed is imported into a new
+        journal once, so later runs only replay the journal.
+        """
+        annotations = create_coco_annotation_base()
+
+        if not os.path.exists(self.journal_path):
+            if self.part is None and os.path.exists(self.annotation_path):
+                try:
+                    with open(self.annotation_path, 'r', encoding='utf-8') as f:
+                        annotations = json.load(f)
+                except Exception as e:
+                    print(f"Error loading annotations: {e}")
+                    return annotations
+                for image_info in annotations["images"]:
+                    self._write_record("image", image_info)
+                for annotation in annotations["annotations"]:
+                    self._write_record("annotation", annotation)
+                self.sync()
+            return annotations
+
+        annotations["images"], annotations["annotations"], valid_size = read_journal(self.journal_path)
+
+        # Partial line from an interrupted append, drop it and everything after
+        if valid_size < os.path.getsize(self.journal_path):
+            print(f"Dropping incomplete journal tail: {self.journal_path}")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+        return annotations
+
+    def _write_record(self, record_type: str, data: Dict) -> None:
+        if self._file is None:
+            create_directory(self.annotation_dir)
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+
+        line = json.dumps({"type": record_type, "data": data}, ensure_ascii=False) + "\n"
+        self._file.write(line)
+        metrics.inc("checkpoint_bytes", len(line), self.video_name)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def append_image(self, image_info: Dict) -> None:
+        self._write_record("image", image_info)
+
+    def append_annotation(self, annotation: Dict) -> None:
+        self._write_record("annotation", annotation)
+
+    def sync(self) -> None:
+        """Flush buffered records and fsync the journal"""
+        if self._file is None:
+            return
+        with metrics.timer("journal_sync", self.video_name):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def compact(self, annotations: Dict) -> None:
+        """Write the full COCO document for the video"""
+        self.sync()
+        if self.part is None:
+            save_coco_annotations(annotations, self.video_path)
+
+    def staged(self) -> "AnnotationJournal":
+        """An empty journal of the same video beside this one, made current by `replace_with`"""
+        staged = AnnotationJournal(self.video_path, self.fsync_every, self.part)
+        staged.journal_path = self.journal_path + ".staged"
+        staged.discard()
+        return staged
+
+    def replace_with(self, staged: "AnnotationJournal") -> None:
+        """Atomically replace this journal by a staged one, compact writes the COCO file"""
+        staged.close()
+        self.close()
+        os.replace(staged.journal_path, self.journal_path)
+
+    def discard(self) -> None:
+        """Delete the journal file only"""
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def reset(self) -> Dict:
+        """Delete the journal and COCO file of the video and return empty annotations"""
+        self.close()
+        paths = [self.journal_path] if self.part is not None else [self.journal_path, self.annotation_path]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        return create_coco_annotation_base()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,534 @@
+"""Offline throughput benchmark
+
+Generates a synthetic video, runs VideoProcessor end to end against a stub
+model with configurable latency and prints a JSON report, so runs on
+different commits can be compared without a GPU or a download. With
+--model real the actual model runs instead, and --compare reports the
+configured CPU backend against the default float model. --mode budget
+labels within --budget model calls in priority order against a stub whose
+hits depend on frame content, and reports the yield against labeling in
+extraction order with the same number of model calls.
+
+    python benchmark.py --seconds 60 --width 1280 --height 720 --cuts-per-minute 12 --output bench.json
+    python benchmark.py --model real --device cpu --quantize --replicas 4 --compare
+    python benchmark.py --startup
+    python benchmark.py --check-archive
+    python benchmark.py --mode budget --budget 200 --gop 25 --cuts-per-minute 60 --seconds 600
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import itertools
+import tempfile
+import contextlib
+import resource
+import tracemalloc
+import subprocess
+import numpy as np
+from typing import Dict, List
+
+
+class StubModelHandler:
+    """Stand-in for ModelHandler that sleeps instead of running the model
+
+    Args:
+        latency: Seconds per detect_batch call
+        per_image_latency: Additional seconds per image in a call
+        hit_rate: Fraction of frames that get a detection
+        content_hits: Detect an object in frames that are mostly red instead of at random,
+            so hits cluster in similar looking scenes like real targets do
+    """
+
+    def __init__(self, latency: float = 0.0, per_image_latency: float = 0.02, hit_rate: float = 0.5, seed: int = 0,
+                 content_hits: bool = False):
+        self.latency = latency
+        self.per_image_latency = per_image_latency
+        self.hit_rate = hit_rate
+        self.content_hits = content_hits
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.images = 0
+        self.busy = 0.0
+
+    def load_model(self):
+        pass
+
+    def has_target(self, image) -> bool:
+        if not self.content_hits:
+            return self.random.random() < self.hit_rate
+        red, green, blue = np.asarray(image.convert('RGB').resize((16, 16)), dtype=np.float32).mean(axis=(0, 1))
+        return red > green and red > blue
+
+    def _fake_objects(self, image, target_objects) -> list:
+        if isinstance(target_objects, str):
+            target_objects = [target_objects]
+        objects = []
+        for category_id, _ in enumerate(target_objects, start=1):
+            if self.has_target(image):
+                x, y = self.random.uniform(0, 0.6), self.random.uniform(0, 0.6)
+                objects.append({"x_min": x, "y_min": y, "x_max": x + 0.3, "y_max": y + 0.3, "category_id": category_id})
+        return objects
+
+    def detect_objects(self, image, target_object: str) -> list:
+        return self.detect_batch([image], target_object)[0]
+
+    def detect_batch(self, images: List, target_objects) -> List[list]:
+        start = time.perf_counter()
+        time.sleep(self.latency + self.per_image_latency * len(images))
+        self.calls += 1
+        self.images += len(images)
+        results = [self._fake_objects(image, target_objects) for image in images]
+        self.busy += time.perf_counter() - start
+        return results
+
+    def close(self):
+        pass
+
+
+def generate_synthetic_video(path: str, seconds: float, width: int, height: int, fps: int,
+                             cuts_per_minute: float, gop: int = 250, seed: int = 0) -> int:
+    """Encode a synthetic video with FFmpeg from generated frames
+
+    Each scene has its own background and a moving rectangle, scenes change
+    `cuts_per_minute` times per minute at random points.
+
+    Returns:
+        Number of scene cuts in the video
+    """
+    rng = np.random.default_rng(seed)
+    total_frames = int(seconds * fps)
+    num_cuts = int(round(cuts_per_minute * seconds / 60))
+    cut_frames = set(rng.choice(np.arange(1, max(2, total_frames)), size=min(num_cuts, max(0, total_frames - 1)), replace=False).tolist())
+
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0',
+        '-c:v', 'mpeg4', '-q:v', '4', '-g', str(gop),
+        path
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    background = rng.integers(0, 256, size=3)
+    box = max(8, min(width, height) // 6)
+    for frame_num in range(total_frames):
+        if frame_num in cut_frames:
+            background = rng.integers(0, 256, size=3)
+        frame[:] = background
+        x = (frame_num * 4) % max(1, width - box)
+        y = (frame_num * 2) % max(1, height - box)
+        frame[y:y + box, x:x + box] = 255 - background
+        process.stdin.write(frame.tobytes())
+
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("FFmpeg failed to encode the synthetic video")
+    return len(cut_frames)
+
+
+def directory_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def process_write_bytes() -> int:
+    """Bytes this process actually caused to be written to storage, 0 where /proc is unavailable"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def measure_frame_preparation(video_path: str, max_side) -> Dict:
+    """Latency and memory of turning streamed keyframes into model input
+
+    Compares the former path (full resolution BGR from FFmpeg, a new array per
+    frame, cvtColor, then a PIL copy) with the FramePreparer path (RGB at the
+    inference resolution read into a reused buffer, then a PIL copy). Total
+    time per frame includes decoding the whole video for scene detection,
+    convert time only the step from raw pixels to the model input. Peak
+    traced bytes cover Python and numpy allocations, PIL pixel memory is
+    reported separately as bytes held per prepared image.
+    """
+    import metrics
+    from utils import probe_video, cv2_to_pil
+    from video_processor import VideoProcessor
+    from frame_prep import FramePreparer
+    from config import SCENE_THRESHOLD
+
+    info = probe_video(video_path)
+    width, height = info["width"], info["height"]
+
+    def legacy_frames():
+        cmd = [
+            'ffmpeg', '-nostats', '-loglevel', 'error', '-i', video_path,
+            '-vf', f"select='eq(pict_type,I) + gt(scene,{SCENE_THRESHOLD})'",
+            '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        frame_size = width * height * 3
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            start = time.perf_counter()
+            image = cv2_to_pil(np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3))
+            convert_seconds[0] += time.perf_counter() - start
+            yield image
+        process.wait()
+
+    def prepare_seconds() -> float:
+        return metrics.snapshot()["global"]["stages"].get("prepare_frame", {}).get("sum", 0.0)
+
+    def prepared_frames():
+        processor = VideoProcessor(video_path)
+        processor.preparer = FramePreparer(width, height, max_side)
+        before = prepare_seconds()
+        for _, image in processor.stream_keyframes():
+            yield image
+        convert_seconds[0] = prepare_seconds() - before
+        processor.close()
+
+    results = {}
+    for name, frames in (("legacy", legacy_frames), ("prepared", prepared_frames)):
+        convert_seconds = [0.0]
+        tracemalloc.start()
+        start = time.perf_counter()
+        count, size = 0, (0, 0)
+        for image in frames():
+            count += 1
+            size = image.size
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            "frames": count,
+            "size": list(size),
+            "ms_per_frame": round(seconds / count * 1000, 3) if count else 0.0,
+            "convert_ms_per_frame": round(convert_seconds[0] / count * 1000, 3) if count else 0.0,
+            "peak_traced_bytes": peak,
+            # PIL stores RGB with 4 bytes per pixel
+            "image_bytes": size[0] * size[1] * 4
+        }
+    legacy, prepared = results["legacy"], results["prepared"]
+    results["latency_saved"] = round(1 - prepared["ms_per_frame"] / legacy["ms_per_frame"], 3) if legacy["ms_per_frame"] else 0.0
+    results["convert_latency_saved"] = (round(1 - prepared["convert_ms_per_frame"] / legacy["convert_ms_per_frame"], 3)
+                                        if legacy["convert_ms_per_frame"] else 0.0)
+    results["image_memory_saved"] = round(1 - prepared["image_bytes"] / legacy["image_bytes"], 3) if legacy["image_bytes"] else 0.0
+    return results
+
+
+# Commands that do not run the model should start in well under a second
+STARTUP_TARGET_SECONDS = 0.3
+STARTUP_COMMANDS = [["--help"], ["status"], ["download", "--help"], ["export", "--help"]]
+HEAVY_MODULES = ("torch", "transformers", "yt_dlp", "cv2", "numpy")
+_STARTUP_PROBE = (
+    "import json, os, runpy, sys\n"
+    "sys.argv = sys.argv[1:]\n"
+    "sys.path.insert(0, os.path.dirname(sys.argv[0]))\n"
+    "try:\n"
+    "    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+    "except SystemExit:\n"
+    "    pass\n"
+    "print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)), file=sys.stderr)\n"
+)
+
+
+def measure_cli_startup(repeats: int = 5) -> Dict:
+    """Wall time of non-model CLI commands in fresh interpreters, and the heavy modules they import"""
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    probe = _STARTUP_PROBE.format(heavy=HEAVY_MODULES)
+    workdir = tempfile.mkdtemp(prefix='dreamlabel_startup_')
+    commands = {}
+    try:
+        for command in STARTUP_COMMANDS:
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, '-c', probe, cli_path] + command,
+                                        cwd=workdir, capture_output=True, text=True)
+                times.append(time.perf_counter() - start)
+            median = sorted(times)[len(times) // 2]
+            commands[" ".join(command)] = {
+                "median_seconds": round(median, 3),
+                "heavy_modules": json.loads(result.stderr.strip().splitlines()[-1]),
+                "meets_target": median <= STARTUP_TARGET_SECONDS
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"target_seconds": STARTUP_TARGET_SECONDS, "commands": commands}
+
+
+def make_model(args):
+    """Stub model, or the real model for the device and CPU options of `args`"""
+    if args.model == 'stub':
+        return StubModelHandler(args.latency, args.per_image_latency, args.hit_rate, seed=args.seed,
+                                content_hits=args.mode == 'budget')
+
+    from model_handler import ModelHandler
+    from model_pool import ModelPool
+    if args.device == 'cpu' and args.replicas > 1:
+        return ModelPool(args.replicas, args.threads, args.quantize, args.compile)
+    return ModelHandler(args.device, args.threads, args.quantize, args.compile)
+
+
+def exhaustive_order_yield(video_path: str, budget: int) -> Dict:
+    """Label keyframes in extraction order until `budget` model calls are spent, without recording them
+
+    Frames go through the same near-duplicate reuse and batches as the
+    budgeted run, so both sides are compared at the same number of model
+    calls. A separate stub without latency gives the same hits.
+    """
+    from config import BATCH_SIZE
+    from video_processor import VideoProcessor
+
+    model = StubModelHandler(per_image_latency=0.0, content_hits=True)
+    processor = VideoProcessor(video_path)
+    keyframes = processor.iter_keyframes(skip_done=False, save_keyframes=False)
+    frames, annotated = 0, 0
+    try:
+        while processor.model_calls < budget:
+            size = min(BATCH_SIZE, budget - processor.model_calls)
+            batch = [image for _, image in itertools.islice(keyframes, size)]
+            if not batch:
+                break
+            results = processor.detect_frames(batch, model)
+            frames += len(batch)
+            annotated += sum(1 for objects in results if objects)
+    finally:
+        keyframes.close()
+        processor.close()
+    return {
+        "model_calls": processor.model_calls,
+        "frames": frames,
+        "annotated": annotated,
+        "hit_rate": round(annotated / frames, 3) if frames else None,
+        "yield_per_call": round(annotated / processor.model_calls, 3) if processor.model_calls else None
+    }
+
+
+def check_keyframe_archive(args, thresholds=(0.0005, 0.9)) -> Dict:
+    """Archive streamed keyframes at one scene threshold, then at another, and read the archive back
+
+    The archive must hold exactly the keyframes selected at the last
+    threshold, none left over from the first.
+    """
+    workdir = tempfile.mkdtemp(prefix='dreamlabel_archive_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        os.makedirs('Video', exist_ok=True)
+        video_path = os.path.join('Video', 'synthetic.mp4')
+        generate_synthetic_video(video_path, args.seconds, args.width, args.height, args.fps,
+                                 args.cuts_per_minute, gop=args.gop, seed=args.seed)
+
+        # Imported here so module level config runs inside the scratch directory
+        import video_processor
+        from video_processor import VideoProcessor
+        video_processor.SAVE_KEYFRAMES = True
+        selected = {}
+        for threshold in thresholds:
+            video_processor.SCENE_THRESHOLD = threshold
+            processor = VideoProcessor(video_path)
+            selected[threshold] = sorted(frame_num for frame_num, _ in processor.stream_keyframes())
+            processor.close()
+
+        processor = VideoProcessor(video_path)
+        cached = processor.has_cached_keyframes()
+        archived = sorted(frame_num for frame_num, _ in processor.read_keyframe_files(skip_done=False))
+        processor.close()
+        expected = selected[thresholds[-1]]
+        return {
+            "keyframes": {str(threshold): len(frames) for threshold, frames in selected.items()},
+            "archive_complete": cached,
+            "archived": len(archived),
+            "stale": len(set(archived) - set(expected)),
+            "passed": cached and archived == expected
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmark(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix='dreamlabel_bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        os.makedirs('Video', exist_ok=True)
+        video_path = os.path.join('Video', 'synthetic.mp4')
+
+        start = time.perf_counter()
+        cuts = generate_synthetic_video(video_path, args.seconds, args.width, args.height, args.fps,
+                                        args.cuts_per_minute, gop=args.gop, seed=args.seed)
+        generate_seconds = time.perf_counter() - start
+        video_bytes = os.path.getsize(video_path)
+        write_bytes_before = process_write_bytes()
+
+        # Imported here so module level config runs inside the scratch directory
+        import config
+        if args.max_side is not None:
+            config.INFERENCE_MAX_SIDE = args.max_side or None
+        from config import STREAM_KEYFRAMES, USE_SCENE_INDEX
+        from video_processor import VideoProcessor
+        from pipeline import PipelineRunner
+        import metrics
+        metrics.enable()
+        metrics.reset()
+
+        model = make_model(args)
+        start = time.perf_counter()
+        model.load_model()
+        load_seconds = time.perf_counter() - start
+
+        exhaustive = None
+        if args.mode == 'budget':
+            if not isinstance(model, StubModelHandler):
+                raise SystemExit("--mode budget needs the stub model")
+            exhaustive = exhaustive_order_yield(video_path, args.budget)
+
+        stages = {}
+        budget_report = None
+        start = time.perf_counter()
+        if args.mode == 'budget':
+            from prioritizer import PriorityLabeler
+            labeler = PriorityLabeler(model, budget_frames=args.budget, budget_seconds=None)
+            labeler.add_video(video_path)
+            budget_report = labeler.run()
+            frames = budget_report["keyframes"] - budget_report["unlabeled"]
+            budget_report["exhaustive_order"] = exhaustive
+            # Same model calls and near-duplicate reuse on both sides, so yields per call compare directly
+            if exhaustive["yield_per_call"] and budget_report["yield_per_call"] is not None:
+                budget_report["lift_over_exhaustive"] = round(
+                    budget_report["yield_per_call"] / exhaustive["yield_per_call"], 3)
+        elif args.mode == 'pipeline':
+            report = PipelineRunner(model).run([video_path])
+            frames = report["stages"]["extract"]["items"]
+            stages = {name: stage["busy_seconds"] for name, stage in report["stages"].items()}
+        else:
+            processor = VideoProcessor(video_path)
+            if not STREAM_KEYFRAMES and not USE_SCENE_INDEX and not processor.extract_keyframes():
+                processor.close()
+                raise RuntimeError("Keyframe extraction failed")
+            processor.process_keyframes(model)
+            frames = processor.model_calls + processor.model_calls_saved
+        total_seconds = time.perf_counter() - start
+        model.close()
+        if isinstance(model, StubModelHandler):
+            stages["model"] = round(model.busy, 3)
+        snapshot = metrics.snapshot()["global"]
+        for stage, histogram in snapshot["stages"].items():
+            stages[stage] = histogram["sum"]
+
+        frame_preparation = None
+        if args.measure_prep:
+            frame_preparation = measure_frame_preparation(video_path, config.INFERENCE_MAX_SIDE)
+
+        output_bytes = sum(directory_bytes(d) for d in ('annotations', 'box', 'keyframes'))
+        output_bytes += sum(os.path.getsize(f) for f in os.listdir('.') if f.startswith('progress.db'))
+
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rss_scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is KiB on Linux, bytes on macOS
+
+        return {
+            "config": vars(args),
+            "video": {"bytes": video_bytes, "scene_cuts": cuts, "generate_seconds": round(generate_seconds, 3)},
+            "frames": frames,
+            "model_calls": getattr(model, 'calls', None),
+            "model_images": getattr(model, 'images', snapshot["counters"].get("model_images", 0)),
+            "model_load_seconds": round(load_seconds, 3),
+            "total_seconds": round(total_seconds, 3),
+            "frames_per_second": round(frames / total_seconds, 3) if total_seconds > 0 else 0.0,
+            "stage_seconds": stages,
+            "peak_rss_bytes": self_usage.ru_maxrss * rss_scale,
+            "peak_child_rss_bytes": child_usage.ru_maxrss * rss_scale,
+            "output_bytes": output_bytes,
+            "storage_write_bytes": process_write_bytes() - write_bytes_before,
+            "counters": snapshot["counters"],
+            "frame_preparation": frame_preparation,
+            "budget": budget_report
+        }
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Benchmark files kept in: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline DreamLabel throughput benchmark")
+    parser.add_argument('--seconds', type=float, default=30, help="Synthetic video length")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--gop', type=int, default=250, help="Encoder keyframe interval in frames")
+    parser.add_argument('--cuts-per-minute', type=float, default=12, help="Scene cut density")
+    parser.add_argument('--latency', type=float, default=0.0, help="Stub model seconds per call")
+    parser.add_argument('--per-image-latency', type=float, default=0.02, help="Stub model seconds per image")
+    parser.add_argument('--hit-rate', type=float, default=0.5, help="Fraction of frames with a detection")
+    parser.add_argument('--mode', choices=['sequential', 'pipeline', 'budget'], default='sequential')
+    parser.add_argument('--budget', type=int, default=40, help="Model calls allowed in budget mode")
+    parser.add_argument('--max-side', type=int,
+                        help="Inference resolution, longest side in pixels, 0 for the source size. Defaults to config")
+    parser.add_argument('--measure-prep', action='store_true',
+                        help="Also measure keyframe preparation latency and memory against the former full resolution path")
+    parser.add_argument('--model', choices=['stub', 'real'], default='stub', help="Stub or the configured model")
+    parser.add_argument('--device', default='cpu', help="Device of the real model")
+    parser.add_argument('--threads', type=int, help="Intra-op threads per real model on CPU")
+    parser.add_argument('--quantize', action='store_true', help="Dynamic int8 quantization on CPU")
+    parser.add_argument('--compile', action='store_true', help="torch.compile image encoding on CPU")
+    parser.add_argument('--replicas', type=int, default=1, help="CPU model replicas in worker processes")
+    parser.add_argument('--compare', action='store_true',
+                        help="Also run the default float model without CPU options and report the speedup")
+    parser.add_argument('--startup', action='store_true',
+                        help="Only measure startup time of the non-model CLI commands against the target")
+    parser.add_argument('--check-archive', action='store_true',
+                        help="Only check that changing the scene threshold leaves no stale archived keyframes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch directory")
+    args = parser.parse_args()
+
+    # Progress output goes to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.check_archive:
+            result = check_keyframe_archive(args)
+        elif args.startup:
+            result = measure_cli_startup()
+        else:
+            result = run_benchmark(args)
+        if args.compare and not args.startup and not args.check_archive:
+            default_args = argparse.Namespace(**vars(args))
+            default_args.threads, default_args.quantize, default_args.compile, default_args.replicas = None, False, False, 1
+            default = run_benchmark(default_args)
+            result = {
+                "default": default,
+                "configured": result,
+                "speedup": round(result["frames_per_second"] / default["frames_per_second"], 3)
+                if default["frames_per_second"] else None
+            }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.check_archive and not result["passed"]:
+        sys.exit("Archived keyframes do not match the last scene threshold")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Command line entry point with one subcommand per stage
+
+    python cli.py download [URL ...]
+    python cli.py extract [VIDEO ...]
+    python cli.py label [VIDEO ...] [--device cpu] [--objects robot,person]
+    python cli.py render [VIDEO ...]
+    python cli.py export [--output dataset]
+    python cli.py status
+
+Settings come from config.py, overridden by a JSON or TOML file
+(--config, or DREAMLABEL_CONFIG), DREAMLABEL_<SETTING> environment
+variables and flags, with --set SETTING=VALUE for any setting. Stage
+modules are imported by the command that needs them, so commands that do
+not run the model start without loading torch, transformers or yt-dlp.
+"""
+import os
+import sys
+import argparse
+import config
+
+
+def video_dir() -> str:
+    return os.path.dirname(config.VIDEO_PATH) if os.path.dirname(config.VIDEO_PATH) else "."
+
+
+def local_videos(paths):
+    from utils import list_videos
+
+    if paths:
+        return paths
+    return list_videos(video_dir()) if os.path.isdir(video_dir()) else []
+
+
+def cmd_download(args) -> None:
+    from video_downloader import download_video
+
+    urls = args.urls or config.YOUTUBE_URL
+    paths = download_video(urls, config.VIDEO_PATH)
+    print(f"{len(paths)} videos in {video_dir()}")
+
+
+def cmd_extract(args) -> None:
+    from video_processor import VideoProcessor
+    from scene_index import SceneIndex
+
+    failed = 0
+    for video_path in local_videos(args.videos):
+        print(f"\nExtracting keyframes: {video_path}")
+        if config.USE_SCENE_INDEX:
+            SceneIndex.load_or_build(video_path)
+        else:
+            processor = VideoProcessor(video_path)
+            if not processor.extract_keyframes():
+                failed += 1
+            processor.close()
+    if failed:
+        sys.exit(f"Keyframe extraction failed for {failed} videos")
+
+
+def cmd_label(args) -> None:
+    from main import label_videos
+
+    if args.videos:
+        label_videos(args.videos)
+    else:
+        from video_downloader import iter_videos
+        # Like main.py: local videos first, then each download as soon as it finishes
+        label_videos(iter_videos(config.YOUTUBE_URL, video_dir()))
+
+
+def cmd_render(args) -> None:
+    from render import render
+
+    render(local_videos(args.videos))
+
+
+def cmd_export(args) -> None:
+    from dataset_export import export_dataset
+
+    export_dataset(args.output or config.EXPORT_DIR, args.shard_mb or config.EXPORT_SHARD_MB,
+                   args.yolo_dir, args.max_side, args.videos)
+
+
+def _journal_frames(video_name: str) -> int:
+    """Annotated frames of a video, a frame journaled again after a resume counts once"""
+    from annotation_journal import read_journal
+
+    journal_path = os.path.join('annotations', f"{video_name}_annotations.jsonl")
+    if not os.path.exists(journal_path):
+        return 0
+    images, _, _ = read_journal(journal_path)
+    return len(images)
+
+
+def cmd_status(args) -> None:
+    from utils import get_video_name
+
+    names = [get_video_name(path) for path in local_videos(None)]
+    processed = {}
+    # Opening the store creates it, so only read one that exists
+    if os.path.exists(config.PROGRESS_DB):
+        from progress_store import ProgressStore
+        store = ProgressStore(legacy_json=None)
+        processed = store.video_counts()
+        store.close()
+
+    print(f"Videos in {video_dir()}: {len(names)}")
+    for name in sorted(set(names) | set(processed)):
+        print(f"  {name:<40} processed={processed.get(name, 0):<7} annotated={_journal_frames(name)}")
+
+    if os.path.exists(config.COORDINATOR_DB):
+        from coordinator import Coordinator, print_status
+        print("Coordinator:")
+        coordinator = Coordinator()
+        print_status(coordinator)
+        coordinator.close()
+
+
+def parse_settings(items) -> dict:
+    overrides = {}
+    for item in items or []:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit(f"--set expects SETTING=VALUE, got {item!r}")
+        overrides[name.strip()] = value
+    return overrides
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="DreamLabel: download, label and export videos stage by stage")
+    parser.add_argument('--config', help="JSON or TOML settings file, overrides config.py")
+    parser.add_argument('--set', action='append', metavar='SETTING=VALUE', help="Override any setting, repeatable")
+    parser.add_argument('--video-dir', help="Directory of the videos (VIDEO_PATH)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    download = subparsers.add_parser('download', help="Download videos")
+    download.add_argument('urls', nargs='*', help="Defaults to YOUTUBE_URL")
+    download.add_argument('--workers', type=int, dest='DOWNLOAD_WORKERS', help="Concurrent downloads")
+    download.set_defaults(handler=cmd_download)
+
+    extract = subparsers.add_parser('extract', help="Extract keyframes to disk, or build scene indexes")
+    extract.add_argument('videos', nargs='*', help="Defaults to all videos in the video directory")
+    extract.add_argument('--scene-threshold', type=float, dest='SCENE_THRESHOLD')
+    extract.set_defaults(handler=cmd_extract)
+
+    label = subparsers.add_parser('label', help="Detect objects and write annotations")
+    label.add_argument('videos', nargs='*', help="Defaults to local videos and YOUTUBE_URL downloads")
+    label.add_argument('--device', dest='DEVICE')
+    label.add_argument('--batch-size', type=int, dest='BATCH_SIZE')
+    label.add_argument('--objects', dest='DETECTION_OBJECTS', help="Comma separated targets")
+    label.add_argument('--mode', choices=['keyframes', 'dense'], dest='LABEL_MODE')
+    label.add_argument('--server', dest='MODEL_SERVER_URL', help="Use a running model server")
+    label.add_argument('--budget-frames', type=int, dest='LABEL_BUDGET_FRAMES',
+                       help="Model calls allowed, the most promising keyframes are labeled first")
+    label.add_argument('--budget-seconds', type=float, dest='LABEL_BUDGET_SECONDS', help="Wall time allowed")
+    label.add_argument('--budget-scope', choices=['video', 'global'], dest='LABEL_BUDGET_SCOPE',
+                       help="Budget per video, or shared by all videos")
+    label.set_defaults(handler=cmd_label)
+
+    render = subparsers.add_parser('render', help="Re-render boxes and COCO files from the detection cache")
+    render.add_argument('videos', nargs='*', help="Defaults to all videos in the video directory")
+    render.set_defaults(handler=cmd_render)
+
+    export = subparsers.add_parser('export', help="Export WebDataset shards, YOLO labels and merged COCO")
+    export.add_argument('--output', help="Defaults to EXPORT_DIR")
+    export.add_argument('--shard-mb', type=float)
+    export.add_argument('--yolo-dir')
+    export.add_argument('--max-side', type=int)
+    export.add_argument('--videos', nargs='+', help="Video names, defaults to all annotated videos")
+    export.set_defaults(handler=cmd_export)
+
+    status = subparsers.add_parser('status', help="Show progress of every video")
+    status.set_defaults(handler=cmd_status)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Flags whose dest is a setting name override that setting
+    overrides = {name: value for name, value in vars(args).items() if name.isupper() and value is not None}
+    if args.video_dir:
+        overrides["VIDEO_PATH"] = os.path.join(args.video_dir, '')
+    overrides.update(parse_settings(args.set))
+    try:
+        config.configure(args.config, overrides)
+    except (ValueError, OSError) as e:
+        raise SystemExit(f"Invalid configuration: {e}")
+
+    from utils import add_bundled_tools_to_path
+    add_bundled_tools_to_path()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,219 @@
+"""Settings of all stages
+
+Each constant below is a default. Values are overridden, in increasing
+priority, by a JSON or TOML file named in DREAMLABEL_CONFIG, by
+DREAMLABEL_<SETTING> environment variables, and by command line flags of
+cli.py. Overrides must be applied before other modules import settings.
+"""
 import os
+import json
 
 # Video settings
 VIDEO_PATH = "Video/"
 YOUTUBE_URL = ["https://www.youtube.com/watch?v=jiZm337SueE"] #keep it empty if no need to download video
 SAVE_DIR = "box"
 BATCH_SIZE = 20
-
-# Ensure save directory exists
-os.makedirs(SAVE_DIR, exist_ok=True)
+DOWNLOAD_WORKERS = 3  # concurrent downloads, each video is processed as soon as it lands
+DOWNLOAD_MANIFEST = "downloads.json"  # ids of finished downloads, kept in the video directory
 
 # Model settings
 MODEL_NAME = "vikhyatk/moondream2"
 MODEL_REVISION = "2025-01-09"
-DEVICE = "cuda"
+DEVICE = "cuda"  # cuda or cpu
+CPU_THREADS = None  # intra-op threads per model on CPU, None uses the cores available to it
+CPU_QUANTIZE = False  # dynamic int8 quantization of linear layers on CPU
+CPU_COMPILE = False  # torch.compile image encoding on CPU
+MODEL_REPLICAS = 1  # >1 runs CPU model replicas in worker processes, each pinned to its own cores
+
+# Model server settings
+MODEL_SERVER_URL = None  # e.g. "http://127.0.0.1:8765" to use a shared model server instead of loading the model
+MODEL_SERVER_HOST = "127.0.0.1"
+MODEL_SERVER_PORT = 8765
+SERVER_BATCH_WINDOW = 0.02  # seconds the server waits for more requests before running a batch
+SERVER_MAX_QUEUE = 256  # images waiting on the server before new requests are rejected
 
 # Detection settings
-DETECTION_OBJECT = "robot"
+DETECTION_OBJECTS = ["robot"]  # one COCO category per target, ids follow list order
 BOX_COLOR = "red"
 BOX_WIDTH = 3 
 
 SAVE_FRAME = True
-SCENE_THRESHOLD = 0.3
\ No newline at end of file
+FRAME_FORMAT = "png"  # png, jpeg or webp
+FRAME_QUALITY = 90  # jpeg / webp quality
+PNG_COMPRESS_LEVEL = 1  # 0-9, lower encodes faster
+FRAME_WRITER_WORKERS = 2  # background threads drawing and saving frames
+FRAME_WRITER_QUEUE = 16  # frames waiting before the caller blocks
+SCENE_THRESHOLD = 0.3
+INFERENCE_MAX_SIDE = None  # decode keyframes at most this large on their longest side for the model, None keeps the source size
+
+# Keyframe extraction settings
+STREAM_KEYFRAMES = True  # pipe raw frames from FFmpeg instead of writing JPEGs first
+SAVE_KEYFRAMES = False  # also archive streamed keyframes to keyframes/<video>/
+USE_SCENE_INDEX = False  # decode once into keyframes/<video>/scene_index.npz, then seek to selected frames
+KEYFRAMES_PER_MINUTE = None  # with the scene index, keep at most this many keyframes per minute
+EXTRACT_WORKERS = 1  # >1 splits long videos at I-frames and extracts segments concurrently
+EXTRACT_SEGMENT_MIN_SECONDS = 60  # shortest segment, shorter videos use one FFmpeg process
+SEEK_READ_GAP = 50  # read through gaps up to this many frames instead of seeking
+
+# Labeling mode
+LABEL_MODE = "keyframes"  # keyframes, or dense to label every frame with tracking between detections
+DENSE_DETECT_EVERY = 10  # run the detector on every Nth frame in dense mode
+TRACK_MIN_CONFIDENCE = 0.5  # re-detect when tracked points drop below this fraction
+TRACK_IOU_THRESHOLD = 0.3  # min IoU to keep a track id across detections
+TRACK_MAX_SIDE = 480  # tracking runs on frames downscaled to this size
+TRACK_MAX_POINTS = 50  # corners tracked per box
+
+# Budgeted labeling settings
+LABEL_BUDGET_FRAMES = None  # model calls allowed, keyframes are labeled most promising first; None labels everything
+LABEL_BUDGET_SECONDS = None  # wall time allowed for labeling, scoring included
+LABEL_BUDGET_SCOPE = "video"  # video: the budget applies to each video, global: one budget shared by all videos
+PRIORITY_PROBE_FRACTION = 0.1  # share of the budget spent on random keyframes, measures the baseline yield
+PRIORITY_MIN_PROBE = 20  # random keyframes needed before the report compares the prioritized hit rate with them
+PRIORITY_THUMB_SIDE = 64  # keyframes are decoded at this size to score them
+PRIORITY_EXPLORE = 0.2  # score bonus for keyframes unlike any labeled one
+
+# Near-duplicate keyframe settings
+DEDUP_MAX_DISTANCE = 3  # max dHash Hamming distance (of 64 bits) to reuse detections, -1 disables
+DEDUP_HISTORY = 8  # recently inferred frames compared against
+
+# Annotation settings
+JOURNAL_FSYNC_EVERY = 50  # journal records written between fsyncs
+CHECKPOINT_EVERY = 10  # annotated frames between progress checkpoints
+PROGRESS_DB = "progress.db"  # SQLite progress store, replaces progress.json
+PROGRESS_WAL = True  # WAL needs all processes on one machine, set False when the working directory is on network storage
+
+# Detection cache settings
+DETECTION_CACHE = True  # reuse detections of frames seen before by the same model and prompt
+DETECTION_CACHE_PATH = "detection_cache.db"
+DETECTION_CACHE_MAX_MB = 512  # least recently used detections are evicted above this size
+RENDER_MIN_HIT_RATE = 0.9  # render leaves a video's annotations as they are when fewer of its keyframes hit the cache
+
+# Work distribution settings
+COORDINATOR_DB = "coordinator.db"  # shared SQLite database of work units, on storage all workers can reach
+COORDINATOR_WAL = True  # WAL needs all workers on one machine, set False when the database is on network storage
+LEASE_SECONDS = 300  # a unit whose worker stopped heartbeating this long ago is reclaimed
+HEARTBEAT_SECONDS = 30
+UNIT_SECONDS = 600  # videos at least twice this long are split into I-frame aligned ranges, None leases whole videos
+UNIT_MAX_ATTEMPTS = 3  # a unit that fails this often is marked failed
+
+# Dataset export settings
+EXPORT_DIR = "dataset"
+EXPORT_SHARD_MB = 512  # WebDataset tar shards are closed once they reach this size
+EXPORT_JPEG_QUALITY = 95  # quality of frames re-encoded for export, archived keyframes are copied as is
+
+# Metrics settings
+METRICS_ENABLED = False  # record per-stage latency histograms and counters
+METRICS_PATH = "metrics.json"
+METRICS_FORMAT = "json"  # json or prometheus (textfile collector format)
+METRICS_INTERVAL = 30  # seconds between periodic dumps
+
+# Pipeline settings
+USE_PIPELINE = True  # overlap extraction, inference and writing across videos
+PIPELINE_EXTRACT_WORKERS = 2  # videos decoded ahead of the model
+PIPELINE_WRITE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 64  # frames buffered between stages
+
+
+ENV_PREFIX = "DREAMLABEL_"
+
+# Former single value settings, still accepted as a one-element list of their replacement
+DEPRECATED_SETTINGS = {"DETECTION_OBJECT": "DETECTION_OBJECTS"}
+
+
+def _is_setting(name: str) -> bool:
+    return name.isupper() and not name.startswith('_') and name not in ("ENV_PREFIX", "DEPRECATED_SETTINGS")
+
+
+def parse_value(name: str, text: str):
+    """Convert the text of an environment variable or flag to the type of the setting's default"""
+    default = globals()[name]
+    if isinstance(default, bool):
+        lowered = text.strip().lower()
+        if lowered not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+            raise ValueError(f"{name} expects true or false, got {text!r}")
+        return lowered in ('1', 'true', 'yes', 'on')
+    if text.strip().lower() == 'none':
+        return None
+    try:
+        value = json.loads(text)
+    except ValueError:
+        value = text
+    if isinstance(default, list) and isinstance(value, str):
+        value = [item.strip() for item in value.split(',') if item.strip()]
+    return value
+
+
+def check_type(name: str, value) -> None:
+    """Reject a value whose type differs from the setting's default, None is always allowed"""
+    default = globals()[name]
+    if value is None or default is None:
+        return
+    if isinstance(default, bool):
+        expected, valid = "true or false", isinstance(value, bool)
+    elif isinstance(default, int):
+        expected, valid = "an integer", isinstance(value, int) and not isinstance(value, bool)
+    elif isinstance(default, float):
+        expected, valid = "a number", isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif isinstance(default, list):
+        expected, valid = "a list", isinstance(value, list)
+    else:
+        expected, valid = "a string", isinstance(value, str)
+    if not valid:
+        raise ValueError(f"{name} expects {expected}, got {value!r}")
+
+
+def apply(values: dict, source: str = "overrides") -> None:
+    """Override settings, names are case insensitive"""
+    for key, value in values.items():
+        name = key.upper()
+        if name in DEPRECATED_SETTINGS:
+            replacement = DEPRECATED_SETTINGS[name]
+            print(f"{name} in {source} is deprecated, use {replacement}")
+            name, value = replacement, [value]
+        if not _is_setting(name) or name not in globals():
+            raise ValueError(f"Unknown setting in {source}: {key}")
+        try:
+            if isinstance(value, str) and not isinstance(globals()[name], str):
+                value = parse_value(name, value)
+            check_type(name, value)
+        except ValueError as e:
+            raise ValueError(f"{e} (from {source})") from None
+        globals()[name] = value
+
+
+def load_file(path: str) -> dict:
+    """Settings from a JSON file, or a TOML file on Python 3.11+"""
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def configure(path: str = None, overrides: dict = None) -> None:
+    """Apply the config file, then environment variables, then explicit overrides"""
+    path = path or os.environ.get(ENV_PREFIX + "CONFIG")
+    if path:
+        try:
+            values = load_file(path)
+        except ValueError as e:
+            raise ValueError(f"config file {path}: {e}") from None
+        apply(values, f"config file {path}")
+    for key, text in os.environ.items():
+        if not key.startswith(ENV_PREFIX) or key == ENV_PREFIX + "CONFIG":
+            continue
+        name = key[len(ENV_PREFIX):]
+        if (_is_setting(name) and name in globals()) or name in DEPRECATED_SETTINGS:
+            apply({name: text}, f"environment variable {key}")
+        else:
+            print(f"Ignoring unknown setting in environment: {key}")
+    if overrides:
+        apply(overrides)
+
+
+try:
+    configure()
+except (ValueError, OSError) as e:
+    # Every module imports settings, report a bad value once instead of a traceback from wherever that was
+    raise SystemExit(f"Invalid configuration: {e}")
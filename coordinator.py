@@ -0,0 +1,509 @@
+"""Spread labeling of many videos over several processes or machines
+
+Work is split into units stored in a shared SQLite database: whole videos,
+or I-frame aligned frame ranges of long videos, plus one merge unit per video
+that becomes available once its ranges are labeled. Workers lease a unit for
+LEASE_SECONDS, renew the lease while working, and a unit whose worker stopped
+heartbeating is reclaimed by the next worker asking for work:
+
+    python coordinator.py plan                 # add all videos in VIDEO_PATH
+    python coordinator.py work --workers 4     # local worker processes
+    python coordinator.py work                 # one worker, e.g. per machine or GPU
+    python coordinator.py status
+    python coordinator.py retry                # make failed units available again
+
+Every unit attempt writes its own part journal, annotations/parts/<video>/.
+The merge unit renumbers annotation ids and appends the parts to the video's
+journal, so annotation ids never collide between workers.
+"""
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from collections import defaultdict
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+from config import (VIDEO_PATH, LABEL_MODE, COORDINATOR_DB, COORDINATOR_WAL, LEASE_SECONDS, HEARTBEAT_SECONDS,
+                    UNIT_SECONDS, UNIT_MAX_ATTEMPTS)
+from utils import get_video_name, list_videos, probe_video
+from segments import find_iframe_times, plan_segments
+from annotation_journal import AnnotationJournal, read_journal
+
+LABEL = "label"
+MERGE = "merge"
+
+
+class LeaseLost(Exception):
+    """The lease of a unit expired and another worker took it over"""
+
+
+class WorkUnit:
+    """A leased unit: a video or a frame range of it to label, or a video to merge"""
+
+    def __init__(self, unit_id: int, video: str, path: str, kind: str, start_frame: int,
+                 end_frame: Optional[int], attempt: int):
+        self.id = unit_id
+        self.video = video
+        self.path = path
+        self.kind = kind
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.attempt = attempt
+
+    @property
+    def frame_range(self) -> Optional[Tuple[int, Optional[int]]]:
+        if self.start_frame == 0 and self.end_frame is None:
+            return None
+        return self.start_frame, self.end_frame
+
+    @property
+    def part(self) -> str:
+        """Part journal name, sorts by start frame and then attempt"""
+        return f"{self.start_frame:09d}-a{self.attempt:03d}"
+
+    def __str__(self) -> str:
+        if self.kind == MERGE:
+            return f"merge {self.video}"
+        end = "end" if self.end_frame is None else self.end_frame
+        return f"{self.video} frames {self.start_frame}-{end}"
+
+
+def plan_units(video_path: str, unit_seconds: Optional[float] = UNIT_SECONDS) -> List[Tuple[int, Optional[int]]]:
+    """Frame ranges of a video, the whole video unless it is at least twice `unit_seconds` long"""
+    if not unit_seconds or LABEL_MODE == "dense":
+        # Dense tracking carries track ids through the whole video
+        return [(0, None)]
+    info = probe_video(video_path)
+    if info["duration"] < 2 * unit_seconds:
+        return [(0, None)]
+    fps = info["fps"]
+    iframe_frames = [int(round(t * fps)) for t in find_iframe_times(video_path)]
+    total_frames = int(round(info["duration"] * fps))
+    count = int(round(info["duration"] / unit_seconds))
+    return plan_segments(iframe_frames, total_frames, count, int(unit_seconds * fps / 2))
+
+
+class Coordinator:
+    """Work units of all videos and their leases, stored in SQLite
+
+    Leasing, renewing and completing are single transactions, so any number
+    of processes can share the database. Leases expire after
+    `lease_seconds` without a heartbeat. Clocks of the machines sharing a
+    database must agree to well within that.
+    """
+
+    def __init__(self, db_path: str = COORDINATOR_DB, lease_seconds: float = LEASE_SECONDS,
+                 max_attempts: int = UNIT_MAX_ATTEMPTS, wal: bool = COORDINATOR_WAL):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "id INTEGER PRIMARY KEY, video TEXT NOT NULL, path TEXT NOT NULL, kind TEXT NOT NULL, "
+            "start_frame INTEGER NOT NULL, end_frame INTEGER, "
+            "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, reclaims INTEGER NOT NULL DEFAULT 0, error TEXT, "
+            "UNIQUE (video, kind, start_frame))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state, id)")
+
+    def _transaction(self, statements) -> None:
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                statements()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def has_video(self, video: str) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM units WHERE video = ?", (video,)).fetchone() is not None
+
+    def add_video(self, video_path: str, ranges: List[Tuple[int, Optional[int]]]) -> int:
+        """Add label units for the ranges of a video and its merge unit
+
+        Returns:
+            Number of units added, 0 if the video was planned before
+        """
+        video = get_video_name(video_path)
+        rows = [(video, video_path, LABEL, start, end) for start, end in ranges]
+        rows.append((video, video_path, MERGE, 0, None))
+        added = []
+
+        def insert():
+            if self.conn.execute("SELECT 1 FROM units WHERE video = ?", (video,)).fetchone():
+                return
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO units (video, path, kind, start_frame, end_frame) VALUES (?, ?, ?, ?, ?)", rows)
+            added.append(len(rows))
+
+        self._transaction(insert)
+        return added[0] if added else 0
+
+    def add_videos(self, video_paths: Iterable[str], unit_seconds: Optional[float] = UNIT_SECONDS) -> int:
+        """Plan every video not planned yet, safe to run from several workers at once"""
+        added = 0
+        for video_path in video_paths:
+            if self.has_video(get_video_name(video_path)):
+                continue
+            try:
+                ranges = plan_units(video_path, unit_seconds)
+            except Exception as e:
+                print(f"Error planning {video_path}, leasing it whole: {e}")
+                ranges = [(0, None)]
+            count = self.add_video(video_path, ranges)
+            if count:
+                print(f"Planned {video_path}: {len(ranges)} label units")
+            added += count
+        return added
+
+    def lease(self) -> Optional[WorkUnit]:
+        """Lease the next available unit, reclaiming an expired lease if there is one
+
+        A merge unit is available once no label unit of its video is pending
+        or leased. Returns None when nothing can be leased right now.
+        """
+        now = time.time()
+        leased = []
+
+        def take():
+            row = self.conn.execute(
+                "SELECT id, video, path, kind, start_frame, end_frame, attempts, state, worker FROM units u "
+                "WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) "
+                "AND (kind = ? OR NOT EXISTS (SELECT 1 FROM units l WHERE l.video = u.video AND l.kind = ? "
+                "AND l.state IN ('pending', 'leased'))) "
+                "ORDER BY kind = ?, id LIMIT 1",
+                (now, LABEL, LABEL, MERGE)
+            ).fetchone()
+            if row is None:
+                return
+            unit_id, video, path, kind, start_frame, end_frame, attempts, state, worker = row
+            if attempts >= self.max_attempts:
+                # Expired lease of the last attempt, the worker crashed every time
+                self.conn.execute("UPDATE units SET state = 'failed', worker = NULL, error = ? WHERE id = ?",
+                                  (f"lease expired on {worker}", unit_id))
+                leased.append(None)
+                return
+            self.conn.execute(
+                "UPDATE units SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "reclaims = reclaims + ? WHERE id = ?",
+                (self.worker_id, now + self.lease_seconds, int(state == 'leased'), unit_id)
+            )
+            if state == 'leased':
+                print(f"Reclaimed expired lease of unit {unit_id} from {worker}")
+            leased.append(WorkUnit(unit_id, video, path, kind, start_frame, end_frame, attempts + 1))
+
+        self._transaction(take)
+        if leased and leased[0] is None:
+            return self.lease()
+        return leased[0] if leased else None
+
+    def heartbeat(self, unit: WorkUnit) -> bool:
+        """Renew a lease, False if it was lost to another worker"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ? AND attempts = ? AND state = 'leased'",
+                (time.time() + self.lease_seconds, unit.id, self.worker_id, unit.attempt)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, unit: WorkUnit) -> bool:
+        """Mark a unit done, False if the lease was lost before"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE units SET state = 'done', lease_expires = NULL, error = NULL "
+                "WHERE id = ? AND worker = ? AND attempts = ? AND state = 'leased'",
+                (unit.id, self.worker_id, unit.attempt)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, unit: WorkUnit, error: str) -> None:
+        """Give a unit back after an error, it is marked failed after `max_attempts`"""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_expires = NULL, error = ? "
+                "WHERE id = ? AND worker = ? AND attempts = ? AND state = 'leased'",
+                (self.max_attempts, error, unit.id, self.worker_id, unit.attempt)
+            )
+
+    def retry_failed(self) -> int:
+        """Make failed units pending again, with the merge units of their videos
+
+        A merge that already ran without a failed range has to run again, or
+        what the retried range labels never reaches the video's annotations.
+        """
+        retried = []
+
+        def reset():
+            self.conn.execute(
+                "UPDATE units SET state = 'pending', attempts = 0, worker = NULL WHERE kind = ? AND state != 'pending' "
+                "AND video IN (SELECT video FROM units WHERE kind = ? AND state = 'failed')", (MERGE, LABEL))
+            retried.append(self.conn.execute(
+                "UPDATE units SET state = 'pending', attempts = 0, worker = NULL WHERE state = 'failed'"
+            ).rowcount)
+
+        self._transaction(reset)
+        return retried[0]
+
+    def remaining(self) -> int:
+        """Units not done or failed yet"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """Unit counts per video and state, with reclaimed leases under 'reclaims'"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT video, state, COUNT(*), SUM(reclaims) FROM units GROUP BY video, state ORDER BY video"
+            ).fetchall()
+        report = defaultdict(lambda: defaultdict(int))
+        for video, state, count, reclaims in rows:
+            report[video][state] += count
+            report[video]["reclaims"] += reclaims or 0
+        return report
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class LeaseKeeper:
+    """Renew the lease of a unit in the background while it is processed"""
+
+    def __init__(self, coordinator: Coordinator, unit: WorkUnit, interval: float = HEARTBEAT_SECONDS):
+        self.coordinator = coordinator
+        self.unit = unit
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.coordinator.heartbeat(self.unit):
+                    print(f"Lost the lease of {self.unit}")
+                    self.lost.set()
+                    return
+            except Exception as e:
+                # The database may be briefly unreachable, the lease survives until it expires
+                print(f"Error renewing the lease of {self.unit}: {e}")
+
+    def guard(self, keyframes: Iterable) -> Generator:
+        """Pass keyframes through until the lease is lost"""
+        for item in keyframes:
+            if self.lost.is_set():
+                raise LeaseLost(str(self.unit))
+            yield item
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def merge_video_parts(video_path: str) -> int:
+    """Append the part journals of a video to its journal and write its COCO file
+
+    Frames already in the video's annotations are skipped, which covers
+    frames labeled by two attempts of a unit and a merge that is re-run
+    after a crash. Annotation ids continue after the highest one present.
+
+    Returns:
+        Number of frames merged
+    """
+    journal = AnnotationJournal(video_path)
+    annotations = journal.load()
+    seen = {image["id"] for image in annotations["images"]}
+    annotation_id = max((annotation["id"] for annotation in annotations["annotations"]), default=0) + 1
+
+    parts_dir = os.path.join('annotations', 'parts', get_video_name(video_path))
+    part_files = sorted(f for f in os.listdir(parts_dir) if f.endswith('.jsonl')) if os.path.isdir(parts_dir) else []
+    merged = 0
+    for part_file in part_files:
+        images, part_annotations, _ = read_journal(os.path.join(parts_dir, part_file))
+        by_image = defaultdict(list)
+        for annotation in part_annotations:
+            by_image[annotation["image_id"]].append(annotation)
+        for image_info in images:
+            if image_info["id"] in seen:
+                continue
+            seen.add(image_info["id"])
+            annotations["images"].append(image_info)
+            journal.append_image(image_info)
+            for annotation in by_image[image_info["id"]]:
+                annotation = dict(annotation, id=annotation_id)
+                annotation_id += 1
+                annotations["annotations"].append(annotation)
+                journal.append_annotation(annotation)
+            merged += 1
+
+    annotations["images"].sort(key=lambda image: image["id"])
+    journal.compact(annotations)
+    journal.close()
+    return merged
+
+
+def process_unit(unit: WorkUnit, model_handler, keeper: LeaseKeeper) -> None:
+    """Label a unit through VideoProcessor, its annotations go to the unit's part journal"""
+    # Imported here so planning and status do not load the video stack
+    from video_processor import VideoProcessor
+
+    processor = VideoProcessor(unit.path, frame_range=unit.frame_range, journal_part=unit.part)
+    try:
+        if LABEL_MODE == "dense":
+            processor.process_dense(model_handler)
+            return
+        processor.process_keyframes(model_handler, keeper.guard(processor.iter_keyframes()))
+    except LeaseLost:
+        # Keep what this attempt labeled, the merge skips frames labeled twice
+        processor.finalize()
+        raise
+    finally:
+        # A failed unit is not finalized, but its connections are still released
+        processor.close()
+
+
+def run_worker(db_path: str = COORDINATOR_DB, poll_seconds: float = 5.0, gpu: Optional[str] = None) -> Dict[str, int]:
+    """Lease and process units until every unit is done or failed
+
+    Returns:
+        Counts of units completed, failed and lost by this worker
+    """
+    if gpu is not None:
+        # Read when CUDA initializes, which is on first use, not on import
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+    from model_pool import create_model_handler
+
+    coordinator = Coordinator(db_path)
+    model_handler = None
+    stats = defaultdict(int)
+    try:
+        while True:
+            unit = coordinator.lease()
+            if unit is None:
+                if coordinator.remaining() == 0:
+                    break
+                # Others hold the remaining leases, wait for them to finish or expire
+                time.sleep(poll_seconds)
+                continue
+
+            print(f"[{coordinator.worker_id}] {unit} (attempt {unit.attempt})")
+            try:
+                with LeaseKeeper(coordinator, unit) as keeper:
+                    if unit.kind == MERGE:
+                        frames = merge_video_parts(unit.path)
+                        print(f"Merged {frames} frames of {unit.video}")
+                    else:
+                        if model_handler is None:
+                            model_handler = create_model_handler()
+                            model_handler.load_model()
+                        process_unit(unit, model_handler, keeper)
+            except LeaseLost:
+                stats["lost"] += 1
+                continue
+            except Exception as e:
+                print(f"Error processing {unit}: {e}")
+                coordinator.fail(unit, str(e))
+                stats["failed"] += 1
+                continue
+
+            if coordinator.complete(unit):
+                stats["completed"] += 1
+            else:
+                print(f"Lease of {unit} expired before it completed, another worker redoes it")
+                stats["lost"] += 1
+    finally:
+        if model_handler is not None:
+            model_handler.close()
+        coordinator.close()
+    return dict(stats)
+
+
+def _worker_process(db_path: str, gpu: Optional[str]) -> None:
+    stats = run_worker(db_path, gpu=gpu)
+    print(f"Worker {os.getpid()} finished: {stats}")
+
+
+def run_local_workers(workers: int, db_path: str = COORDINATOR_DB, gpus: Optional[List[str]] = None) -> None:
+    """Run workers as local processes, round robin over `gpus` if given"""
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for i in range(workers):
+        gpu = gpus[i % len(gpus)] if gpus else None
+        process = context.Process(target=_worker_process, args=(db_path, gpu))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+
+def print_status(coordinator: Coordinator) -> None:
+    report = coordinator.status()
+    totals = defaultdict(int)
+    for video, states in report.items():
+        print(f"  {video:<40} " + " ".join(f"{state}={count}" for state, count in sorted(states.items())))
+        for state, count in states.items():
+            totals[state] += count
+    print("Total: " + " ".join(f"{state}={count}" for state, count in sorted(totals.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distribute video labeling over worker processes with leased work units")
+    parser.add_argument('--db', default=COORDINATOR_DB, help="Coordinator database shared by all workers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan = subparsers.add_parser('plan', help="Add videos as work units")
+    plan.add_argument('videos', nargs='*', help="Videos to add, defaults to all videos in VIDEO_PATH")
+    plan.add_argument('--unit-seconds', type=float, default=UNIT_SECONDS,
+                      help="Split videos at least twice this long into ranges, 0 leases whole videos")
+
+    work = subparsers.add_parser('work', help="Process units until none are left")
+    work.add_argument('--workers', type=int, default=1, help="Local worker processes")
+    work.add_argument('--gpus', help="Comma separated GPU ids assigned to local workers round robin")
+    work.add_argument('--no-plan', action='store_true', help="Do not add videos in VIDEO_PATH first")
+
+    subparsers.add_parser('status', help="Show unit states per video")
+    subparsers.add_parser('retry', help="Make failed units available again")
+    args = parser.parse_args()
+
+    coordinator = Coordinator(args.db)
+    video_dir = os.path.dirname(VIDEO_PATH) if os.path.dirname(VIDEO_PATH) else "."
+    if args.command == 'plan':
+        video_paths = args.videos or list_videos(video_dir)
+        added = coordinator.add_videos(video_paths, args.unit_seconds)
+        print(f"Added {added} units")
+    elif args.command == 'work':
+        if not args.no_plan and os.path.isdir(video_dir):
+            coordinator.add_videos(list_videos(video_dir))
+        coordinator.close()
+        gpus = args.gpus.split(',') if args.gpus else None
+        if args.workers > 1 or gpus:
+            run_local_workers(args.workers, args.db, gpus)
+        else:
+            print(f"Worker finished: {run_worker(args.db)}")
+        coordinator = Coordinator(args.db)
+        print_status(coordinator)
+    elif args.command == 'status':
+        print_status(coordinator)
+    elif args.command == 'retry':
+        print(f"{coordinator.retry_failed()} failed units are pending again")
+    coordinator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Export annotated keyframes of all videos as a training dataset
+
+Streams video by video, so memory stays bounded by the largest single video:
+
+    python dataset_export.py --output dataset --shard-mb 512 --yolo-dir dataset/yolo
+
+Output:
+    <output>/shards/dataset-000000.tar  WebDataset samples <key>.jpg, <key>.txt (YOLO) and <key>.json
+    <output>/coco.json                  Merged COCO file with global image and annotation ids
+    <output>/classes.txt                Class names in YOLO index order
+    <yolo-dir>/images, <yolo-dir>/labels  Optional loose YOLO layout
+
+Frames are taken from archived keyframe JPEGs when present and decoded from
+the video by seeking otherwise. Merged images keep their video and frame
+number, boxes are scaled to the exported image size.
+"""
+import io
+import os
+import json
+import time
+import tarfile
+import argparse
+from collections import defaultdict
+from typing import Dict, Generator, List, Optional, Tuple
+from PIL import Image
+from config import VIDEO_PATH, EXPORT_DIR, EXPORT_SHARD_MB, EXPORT_JPEG_QUALITY
+from frame_prep import FramePreparer, target_size
+from annotation_journal import read_journal
+from utils import create_directory, list_videos, get_video_name, probe_video, create_coco_annotation_base
+
+ANNOTATION_DIR = 'annotations'
+
+
+def sample_key(video_name: str, frame_num: int) -> str:
+    # WebDataset splits keys from extensions at the first dot
+    return f"{video_name.replace('.', '_')}_{frame_num:06d}"
+
+
+def annotated_videos(annotation_dir: str = ANNOTATION_DIR) -> List[str]:
+    """Names of videos with a COCO file or an annotation journal"""
+    if not os.path.isdir(annotation_dir):
+        return []
+    names = set()
+    for filename in os.listdir(annotation_dir):
+        for suffix in ('_annotations.json', '_annotations.jsonl'):
+            if filename.endswith(suffix):
+                names.add(filename[:-len(suffix)])
+    return sorted(names)
+
+
+def load_video_annotations(video_name: str, annotation_dir: str = ANNOTATION_DIR) -> Dict:
+    """COCO document of one video, from its compacted file or by replaying its journal"""
+    annotation_path = os.path.join(annotation_dir, f"{video_name}_annotations.json")
+    if os.path.exists(annotation_path):
+        with open(annotation_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    annotations = create_coco_annotation_base()
+    annotations["images"], annotations["annotations"], _ = read_journal(annotation_path + 'l')
+    return annotations
+
+
+class ShardWriter:
+    """Write samples into numbered tar files of about `max_bytes` each"""
+
+    def __init__(self, directory: str, max_bytes: int, prefix: str = 'dataset'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.shards = []
+        self._file = None
+        self._tar = None
+
+    @property
+    def current(self) -> str:
+        return os.path.basename(self.shards[-1])
+
+    def _open_next(self) -> None:
+        self.close()
+        create_directory(self.directory)
+        path = os.path.join(self.directory, f"{self.prefix}-{len(self.shards):06d}.tar")
+        self._file = open(path, 'wb')
+        self._tar = tarfile.open(fileobj=self._file, mode='w', format=tarfile.USTAR_FORMAT)
+        self.shards.append(path)
+
+    def write(self, key: str, files: Dict[str, bytes]) -> str:
+        """Add one sample, all its files go to the same shard. Returns the shard name"""
+        if self._tar is None or self._file.tell() >= self.max_bytes:
+            self._open_next()
+        for extension, data in files.items():
+            info = tarfile.TarInfo(f"{key}.{extension}")
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+        return self.current
+
+    def close(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+            self._tar = None
+            self._file = None
+
+
+class CocoStreamWriter:
+    """Write a COCO file incrementally
+
+    Images go straight to the output, annotations to a side file that is
+    appended at the end, so neither list is held in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._temp_path = path + '.tmp'
+        self._annotations_path = path + '.annotations.tmp'
+        self._file = open(self._temp_path, 'w', encoding='utf-8')
+        self._annotations = open(self._annotations_path, 'w+', encoding='utf-8')
+        info = create_coco_annotation_base()["info"]
+        self._file.write('{"info": ' + json.dumps(info, ensure_ascii=False) + ', "images": [')
+        self._images = 0
+        self._annotation_count = 0
+
+    def add_image(self, image_info: Dict) -> None:
+        self._file.write((',\n' if self._images else '\n') + json.dumps(image_info, ensure_ascii=False))
+        self._images += 1
+
+    def add_annotation(self, annotation: Dict) -> None:
+        self._annotations.write(json.dumps(annotation, ensure_ascii=False) + '\n')
+        self._annotation_count += 1
+
+    def close(self, categories: List[Dict]) -> None:
+        self._file.write('\n], "annotations": [')
+        self._annotations.seek(0)
+        for i, line in enumerate(self._annotations):
+            self._file.write((',\n' if i else '\n') + line.rstrip('\n'))
+        self._file.write('\n], "categories": ' + json.dumps(categories, ensure_ascii=False) + '}\n')
+        self._file.close()
+        self._annotations.close()
+        os.remove(self._annotations_path)
+        os.replace(self._temp_path, self.path)
+
+
+class DatasetExporter:
+    """Export annotated keyframes of many videos as WebDataset shards, YOLO labels and merged COCO"""
+
+    def __init__(self, output_dir: str = EXPORT_DIR, shard_mb: float = EXPORT_SHARD_MB,
+                 yolo_dir: Optional[str] = None, max_side: Optional[int] = None,
+                 jpeg_quality: int = EXPORT_JPEG_QUALITY, video_dir: Optional[str] = None):
+        self.output_dir = output_dir
+        self.shards = ShardWriter(os.path.join(output_dir, 'shards'), int(shard_mb * 1024 * 1024))
+        self.yolo_dir = yolo_dir
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        video_dir = video_dir or (os.path.dirname(VIDEO_PATH) if os.path.dirname(VIDEO_PATH) else ".")
+        self.video_files = {get_video_name(path): path for path in list_videos(video_dir)} if os.path.isdir(video_dir) else {}
+        self.categories = {}  # name -> global category id
+        self.next_image_id = 1
+        self.next_annotation_id = 1
+        self.stats = defaultdict(int)
+
+    def _category_id(self, name: str) -> int:
+        if name not in self.categories:
+            self.categories[name] = len(self.categories) + 1
+        return self.categories[name]
+
+    def _encode(self, image: Image.Image) -> bytes:
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=self.jpeg_quality)
+        return buffer.getvalue()
+
+    def _frames(self, video_name: str, frame_nums: List[int]) -> Generator[Tuple[int, bytes, Tuple[int, int]], None, None]:
+        """JPEG bytes and size of each frame, copied from the keyframe archive or decoded from the video"""
+        missing = []
+        for frame_num in frame_nums:
+            path = os.path.join('keyframes', video_name, f"{video_name}_{frame_num}.jpg")
+            if not os.path.exists(path):
+                missing.append(frame_num)
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            image = Image.open(io.BytesIO(data))
+            size = target_size(image.width, image.height, self.max_side)
+            if size != image.size:
+                # draft() lets the JPEG decoder skip most of the work of downscaling
+                image.draft("RGB", size)
+                image = image.resize(size, Image.BOX)
+                data = self._encode(image)
+            self.stats["frames_copied"] += 1
+            yield frame_num, data, size
+
+        if not missing:
+            return
+        video_path = self.video_files.get(video_name)
+        if video_path is None:
+            print(f"Video file for {video_name} not found, skipping {len(missing)} frames")
+            self.stats["frames_missing"] += len(missing)
+            return
+
+        # Imported here so exporting archived keyframes does not load the video stack
+        from video_processor import VideoProcessor
+        processor = VideoProcessor(video_path)
+        info = probe_video(video_path)
+        processor.preparer = FramePreparer(info["width"], info["height"], self.max_side)
+        for frame_num, image in processor.read_indexed_keyframes(missing, skip_done=False):
+            self.stats["frames_decoded"] += 1
+            yield frame_num, self._encode(image), image.size
+        processor.close()
+
+    def export_video(self, video_name: str, coco: CocoStreamWriter) -> None:
+        annotations = load_video_annotations(video_name)
+        category_names = {category["id"]: category["name"] for category in annotations.get("categories", [])}
+        by_image = defaultdict(list)
+        for annotation in annotations["annotations"]:
+            by_image[annotation["image_id"]].append(annotation)
+        # Older annotations have no frame_num, their image id is the frame number
+        images = {image.get("frame_num", image["id"]): image for image in annotations["images"]}
+
+        for frame_num, data, (width, height) in self._frames(video_name, sorted(images)):
+            image_info = images[frame_num]
+            source_width, source_height = image_info["width"], image_info["height"]
+            scale_x, scale_y = width / source_width, height / source_height
+            key = sample_key(video_name, frame_num)
+
+            objects, yolo_lines = [], []
+            for annotation in by_image[image_info["id"]]:
+                name = category_names.get(annotation["category_id"], str(annotation["category_id"]))
+                category_id = self._category_id(name)
+                x, y, w, h = annotation["bbox"]
+                bbox = [x * scale_x, y * scale_y, w * scale_x, h * scale_y]
+                obj = {"category": name, "category_id": category_id, "bbox": bbox}
+                if "track_id" in annotation:
+                    obj["track_id"] = annotation["track_id"]
+                objects.append(obj)
+                yolo_lines.append(f"{category_id - 1} {(x + w / 2) / source_width:.6f} {(y + h / 2) / source_height:.6f} "
+                                  f"{w / source_width:.6f} {h / source_height:.6f}")
+
+            label = "\n".join(yolo_lines) + ("\n" if yolo_lines else "")
+            sample_info = {"video": video_name, "frame_num": frame_num, "width": width, "height": height,
+                           "objects": objects}
+            shard = self.shards.write(key, {
+                "jpg": data,
+                "txt": label.encode(),
+                "json": json.dumps(sample_info, ensure_ascii=False).encode()
+            })
+
+            if self.yolo_dir:
+                with open(os.path.join(self.yolo_dir, 'images', f"{key}.jpg"), 'wb') as f:
+                    f.write(data)
+                with open(os.path.join(self.yolo_dir, 'labels', f"{key}.txt"), 'w') as f:
+                    f.write(label)
+
+            image_id = self.next_image_id
+            self.next_image_id += 1
+            coco.add_image({"id": image_id, "file_name": f"{key}.jpg", "width": width, "height": height,
+                            "video": video_name, "frame_num": frame_num, "shard": shard})
+            for obj in objects:
+                bbox = obj["bbox"]
+                annotation = {"id": self.next_annotation_id, "image_id": image_id, "category_id": obj["category_id"],
+                              "bbox": bbox, "area": bbox[2] * bbox[3], "iscrowd": 0}
+                if "track_id" in obj:
+                    annotation["track_id"] = obj["track_id"]
+                coco.add_annotation(annotation)
+                self.next_annotation_id += 1
+            self.stats["images"] += 1
+            self.stats["annotations"] += len(objects)
+
+    def export(self, video_names: Optional[List[str]] = None) -> Dict:
+        start = time.perf_counter()
+        create_directory(self.output_dir)
+        if self.yolo_dir:
+            create_directory(os.path.join(self.yolo_dir, 'images'))
+            create_directory(os.path.join(self.yolo_dir, 'labels'))
+
+        video_names = video_names or annotated_videos()
+        coco = CocoStreamWriter(os.path.join(self.output_dir, 'coco.json'))
+        try:
+            for video_name in video_names:
+                print(f"Exporting {video_name}")
+                self.export_video(video_name, coco)
+                self.stats["videos"] += 1
+        finally:
+            self.shards.close()
+            coco.close([{"id": category_id, "name": name, "supercategory": "object"}
+                        for name, category_id in self.categories.items()])
+
+        class_names = "\n".join(self.categories) + "\n"
+        with open(os.path.join(self.output_dir, 'classes.txt'), 'w', encoding='utf-8') as f:
+            f.write(class_names)
+        if self.yolo_dir:
+            with open(os.path.join(self.yolo_dir, 'classes.txt'), 'w', encoding='utf-8') as f:
+                f.write(class_names)
+
+        report = dict(self.stats, shards=len(self.shards.shards), seconds=round(time.perf_counter() - start, 3))
+        return report
+
+
+def export_dataset(output_dir: str = EXPORT_DIR, shard_mb: float = EXPORT_SHARD_MB, yolo_dir: Optional[str] = None,
+                   max_side: Optional[int] = None, video_names: Optional[List[str]] = None) -> Dict:
+    """Export and print a summary"""
+    report = DatasetExporter(output_dir, shard_mb, yolo_dir, max_side).export(video_names)
+    print(f"Exported {report.get('images', 0)} images with {report.get('annotations', 0)} annotations "
+          f"from {report.get('videos', 0)} videos into {report['shards']} shards in {report['seconds']:.1f}s")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export annotated keyframes as WebDataset shards, YOLO labels and merged COCO")
+    parser.add_argument('--output', default=EXPORT_DIR)
+    parser.add_argument('--shard-mb', type=float, default=EXPORT_SHARD_MB)
+    parser.add_argument('--yolo-dir', help="Also write a loose YOLO images/labels layout here")
+    parser.add_argument('--max-side', type=int, help="Downscale exported frames to this longest side")
+    parser.add_argument('--videos', nargs='+', help="Video names to export, defaults to all annotated videos")
+    args = parser.parse_args()
+
+    export_dataset(args.output, args.shard_mb, args.yolo_dir, args.max_side, args.videos)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Union
+from PIL import Image
+import metrics
+from config import (MODEL_NAME, MODEL_REVISION, DEVICE, CPU_QUANTIZE, DETECTION_CACHE_PATH,
+                    DETECTION_CACHE_MAX_MB)
+
+
+def frame_hash(image: Image.Image) -> str:
+    """Hash of the decoded pixels of a frame"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    digest = hashlib.blake2b(f"{image.size[0]}x{image.size[1]}".encode(), digest_size=16)
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def model_key() -> str:
+    """Identifies the model whose detections are cached, quantized weights give different boxes"""
+    key = f"{MODEL_NAME}@{MODEL_REVISION}"
+    if DEVICE == "cpu" and CPU_QUANTIZE:
+        key += "+int8"
+    return key
+
+
+class DetectionCache:
+    """Raw detections per frame content, model and prompt, stored in SQLite
+
+    Values are the normalized boxes returned by the model for one prompt,
+    empty lists included. The total size of the stored values is kept below
+    `max_mb` by evicting the least recently used entries. Last-use times of
+    hits are written back in one statement per lookup.
+    """
+
+    def __init__(self, db_path: str = DETECTION_CACHE_PATH, max_mb: float = DETECTION_CACHE_MAX_MB,
+                 model: Optional[str] = None):
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.model = model or model_key()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "frame TEXT NOT NULL, model TEXT NOT NULL, prompt TEXT NOT NULL, "
+            "objects TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (frame, model, prompt)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used)")
+        self._total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+
+    def get_many(self, frames: List[str], prompt: str) -> Dict[str, list]:
+        """Cached objects of the given frame hashes for one prompt, misses are left out"""
+        if not frames:
+            return {}
+        found = {}
+        with self._lock:
+            unique = list(dict.fromkeys(frames))
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT frame, objects FROM detections WHERE model = ? AND prompt = ? "
+                    f"AND frame IN ({','.join('?' * len(chunk))})",
+                    [self.model, prompt] + chunk
+                ).fetchall()
+                found.update((frame, json.loads(objects)) for frame, objects in rows)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE detections SET last_used = ? WHERE frame = ? AND model = ? AND prompt = ?",
+                    [(now, frame, self.model, prompt) for frame in found]
+                )
+
+        hits = sum(1 for frame in frames if frame in found)
+        self.hits += hits
+        self.misses += len(frames) - hits
+        metrics.inc("cache_hits", hits)
+        metrics.inc("cache_misses", len(frames) - hits)
+        return found
+
+    def put_many(self, entries: Dict[str, list], prompt: str) -> None:
+        """Store objects per frame hash for one prompt and evict if over the size limit"""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for frame, objects in entries.items():
+            value = json.dumps(objects)
+            rows.append((frame, self.model, prompt, value, len(value), now))
+
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                replaced = 0
+                for start in range(0, len(rows), 500):
+                    chunk = [row[0] for row in rows[start:start + 500]]
+                    replaced += self.conn.execute(
+                        f"SELECT COALESCE(SUM(size), 0) FROM detections WHERE model = ? AND prompt = ? "
+                        f"AND frame IN ({','.join('?' * len(chunk))})",
+                        [self.model, prompt] + chunk
+                    ).fetchone()[0]
+                self.conn.executemany("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self._total_bytes += sum(row[4] for row in rows) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache is 10% below its limit"""
+        target = int(self.max_bytes * 0.9)
+        # Other processes may share the file, so start from the real total
+        self._total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+        evicted = 0
+        while self._total_bytes > target:
+            rows = self.conn.execute(
+                "SELECT frame, model, prompt, size FROM detections ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            cutoff = 0
+            for cutoff, row in enumerate(rows, start=1):
+                self._total_bytes -= row[3]
+                if self._total_bytes <= target:
+                    break
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("DELETE FROM detections WHERE frame = ? AND model = ? AND prompt = ?",
+                                  [row[:3] for row in rows[:cutoff]])
+            self.conn.execute("COMMIT")
+            evicted += cutoff
+        metrics.inc("cache_evictions", evicted)
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self) -> str:
+        return (f"Detection cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate():.1%} hit rate), {self._total_bytes / 1024 / 1024:.1f} MB stored")
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+def _lookup(cache: DetectionCache, hashes: List[str], target_objects: List[str]) -> List[Optional[list]]:
+    """Objects of every frame for all targets, tagged with category ids, None where any target misses"""
+    per_target = [cache.get_many(hashes, target_object) for target_object in target_objects]
+    results = []
+    for frame in hashes:
+        if not all(frame in found for found in per_target):
+            results.append(None)
+            continue
+        objects = []
+        for category_id, found in enumerate(per_target, start=1):
+            objects.extend(dict(obj, category_id=category_id) for obj in found[frame])
+        results.append(objects)
+    return results
+
+
+class CachedModelHandler:
+    """Model handler that answers from the detection cache and only runs the model on misses"""
+
+    def __init__(self, model_handler, cache: Optional[DetectionCache] = None):
+        self.model_handler = model_handler
+        self.cache = cache or DetectionCache()
+
+    def load_model(self):
+        self.model_handler.load_model()
+
+    def detect_objects(self, image: Image.Image, target_object: str) -> list:
+        return self.detect_batch([image], target_object)[0]
+
+    def detect_batch(self, images: List[Image.Image], target_objects: Union[str, List[str]]) -> List[list]:
+        """Same contract as ModelHandler.detect_batch"""
+        if isinstance(target_objects, str):
+            target_objects = [target_objects]
+        if not images:
+            return []
+
+        with metrics.timer("cache_lookup"):
+            hashes = [frame_hash(image) for image in images]
+            results = _lookup(self.cache, hashes, target_objects)
+
+        missing = [i for i, objects in enumerate(results) if objects is None]
+        if missing:
+            inferred = self.model_handler.detect_batch([images[i] for i in missing], target_objects)
+            for i, objects in zip(missing, inferred):
+                results[i] = objects
+            for category_id, target_object in enumerate(target_objects, start=1):
+                self.cache.put_many({
+                    hashes[i]: [{key: value for key, value in obj.items() if key != "category_id"}
+                                for obj in results[i] if obj.get("category_id", 1) == category_id]
+                    for i in missing
+                }, target_object)
+        return results
+
+    def close(self) -> None:
+        print(self.cache.report())
+        self.model_handler.close()
+        self.cache.close()
+
+
+class CacheOnlyHandler:
+    """Stand-in model that only answers from the cache, misses get no detections"""
+
+    def __init__(self, cache: Optional[DetectionCache] = None):
+        self.cache = cache or DetectionCache()
+        self.frames = 0
+        self.missed_frames = 0
+
+    def load_model(self):
+        pass
+
+    def detect_objects(self, image: Image.Image, target_object: str) -> list:
+        return self.detect_batch([image], target_object)[0]
+
+    def detect_batch(self, images: List[Image.Image], target_objects: Union[str, List[str]]) -> List[list]:
+        if isinstance(target_objects, str):
+            target_objects = [target_objects]
+        hashes = [frame_hash(image) for image in images]
+        results = _lookup(self.cache, hashes, target_objects)
+        self.frames += len(results)
+        self.missed_frames += sum(1 for objects in results if objects is None)
+        return [objects if objects is not None else [] for objects in results]
+
+    def close(self) -> None:
+        self.cache.close()
@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+from typing import Dict, Optional, Tuple
+
+# Bytes hashed from each end of the video for its fingerprint
+_HASH_CHUNK = 1024 * 1024
+
+
+def video_fingerprint(video_path: str, with_hash: bool = True) -> Dict:
+    """Identify video content by size, mtime and a hash of its first and last MiB"""
+    stat = os.stat(video_path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if with_hash:
+        digest = hashlib.sha1(str(stat.st_size).encode())
+        with open(video_path, 'rb') as f:
+            digest.update(f.read(_HASH_CHUNK))
+            if stat.st_size > _HASH_CHUNK:
+                f.seek(max(_HASH_CHUNK, stat.st_size - _HASH_CHUNK))
+                digest.update(f.read(_HASH_CHUNK))
+        fingerprint["hash"] = digest.hexdigest()
+    return fingerprint
+
+
+class ExtractionManifest:
+    """Record of a keyframe extraction in keyframes/<video>/manifest.json
+
+    The manifest stores the video fingerprint, the requested scene threshold
+    and the one extraction used, lower after a retry that found no keyframes,
+    the size of the keyframe JPEGs and whether extraction finished. An
+    unchanged video with the same requested threshold can skip extraction, and
+    an unfinished one can resume.
+    """
+
+    def __init__(self, keyframes_dir: str, video_path: str):
+        self.path = os.path.join(keyframes_dir, 'manifest.json')
+        self.video_path = video_path
+        self.data = self._load()
+
+    def _load(self) -> Optional[Dict]:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading extraction manifest: {e}")
+            return None
+
+    def matches(self, scene_threshold: float) -> bool:
+        """Check that the manifest describes this video content and requested threshold"""
+        if not self.data:
+            return False
+        # Manifests written before the requested threshold was recorded only have the one used
+        if self.data.get("requested_threshold", self.data.get("scene_threshold")) != scene_threshold:
+            return False
+
+        recorded = self.data.get("fingerprint", {})
+        current = video_fingerprint(self.video_path, with_hash=False)
+        if recorded.get("size") != current["size"]:
+            return False
+        if recorded.get("mtime") == current["mtime"]:
+            return True
+
+        # Touched or copied, compare content before trusting the keyframes
+        current = video_fingerprint(self.video_path)
+        if recorded.get("hash") != current["hash"]:
+            return False
+        self.data["fingerprint"] = current
+        self._save()
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.data and self.data.get("status") == "complete")
+
+    def start(self, scene_threshold: float, frame_size: Tuple[int, int],
+              requested_threshold: Optional[float] = None) -> None:
+        """Mark a new extraction of this video as in progress
+
+        Args:
+            scene_threshold: Threshold the extraction uses
+            requested_threshold: Threshold asked for, when a retry lowered it
+        """
+        self.data = {
+            "fingerprint": video_fingerprint(self.video_path),
+            "requested_threshold": scene_threshold if requested_threshold is None else requested_threshold,
+            "scene_threshold": scene_threshold,
+            "frame_size": list(frame_size),
+            "status": "partial",
+            "keyframes": 0
+        }
+        self._save()
+
+    def update(self, **fields) -> None:
+        self.data.update(fields)
+        self._save()
+
+    def finish(self, keyframe_count: int) -> None:
+        self.data["status"] = "complete"
+        self.data["keyframes"] = keyframe_count
+        self._save()
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+from PIL import Image
+from typing import Optional, Tuple
+from config import INFERENCE_MAX_SIDE
+
+# Largest JPEG decode reduction first
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def target_size(width: int, height: int, max_side: Optional[int]) -> Tuple[int, int]:
+    """Size with the longest side at most max_side, even dimensions as FFmpeg's scaler wants"""
+    if not max_side or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+class FramePreparer:
+    """Turn decoded frames into RGB model input at the inference resolution
+
+    The model resizes its input internally, so frames are decoded or reduced
+    to at most `max_side` before anything else touches them. Sources that can
+    decode small and in RGB do so (FFmpeg scale filter, reduced JPEG decoding),
+    the rest are resized and converted into buffers that are reused for every
+    frame. PIL copies pixels when it builds an image, so reusing the buffers
+    is safe. `source_size` is kept for annotations in source pixels.
+    """
+
+    def __init__(self, width: int, height: int, max_side: Optional[int] = INFERENCE_MAX_SIDE):
+        self.source_size = (width, height)
+        self.size = target_size(width, height, max_side)
+        self._resized = None
+        self._rgb = None
+
+    @property
+    def scaled(self) -> bool:
+        return self.size != self.source_size
+
+    @property
+    def frame_bytes(self) -> int:
+        """Bytes of one prepared frame as packed RGB"""
+        return self.size[0] * self.size[1] * 3
+
+    def scale_filter(self) -> str:
+        """FFmpeg filter that scales to the target size, to append to a filter chain"""
+        return f",scale={self.size[0]}:{self.size[1]}:flags=area" if self.scaled else ""
+
+    def imread_flag(self) -> int:
+        """cv2.imread flag that decodes a source-sized JPEG as small as possible but not below the target"""
+        width, height = self.source_size
+        for factor, flag in _REDUCED_FLAGS:
+            if width // factor >= self.size[0] and height // factor >= self.size[1]:
+                return flag
+        return cv2.IMREAD_COLOR
+
+    def from_rgb_bytes(self, data) -> Image.Image:
+        """Image from packed RGB bytes already at the target size"""
+        return Image.frombytes("RGB", self.size, data)
+
+    def from_bgr(self, frame: np.ndarray) -> Image.Image:
+        """Image from a BGR frame of any size"""
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            if self._resized is None:
+                self._resized = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+            frame = cv2.resize(frame, self.size, dst=self._resized, interpolation=cv2.INTER_AREA)
+        if self._rgb is None:
+            self._rgb = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+        return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb))
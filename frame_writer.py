@@ -0,0 +1,52 @@
+import threading
+import queue
+from PIL import Image
+from config import FRAME_WRITER_WORKERS, FRAME_WRITER_QUEUE, FRAME_FORMAT, FRAME_QUALITY, PNG_COMPRESS_LEVEL
+from utils import draw_boxes, save_frame
+
+
+class FrameWriter:
+    """Draw and save rendered frames on background threads
+
+    `submit` hands the frame to a bounded queue and returns, so the caller
+    only blocks when `queue_size` frames are already waiting. Boxes are drawn
+    in place, the submitted image belongs to the writer afterwards.
+    """
+
+    def __init__(self, workers: int = FRAME_WRITER_WORKERS, queue_size: int = FRAME_WRITER_QUEUE,
+                 image_format: str = FRAME_FORMAT, quality: int = FRAME_QUALITY,
+                 compress_level: int = PNG_COMPRESS_LEVEL):
+        self.image_format = image_format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            video_path, image, detection_results, frame_num = item
+            try:
+                image_with_boxes = draw_boxes(image, detection_results, in_place=True)
+                save_frame(video_path, image_with_boxes, frame_num,
+                           image_format=self.image_format,
+                           quality=self.quality,
+                           compress_level=self.compress_level)
+            except Exception as e:
+                print(f"Error occurred while saving frame {frame_num}: {str(e)}")
+
+    def submit(self, video_path: str, image: Image.Image, detection_results: list, frame_num: int) -> None:
+        """Queue a frame for drawing and saving, blocks only while the queue is full"""
+        self.queue.put((video_path, image, detection_results, frame_num))
+
+    def close(self) -> None:
+        """Write all queued frames and stop the workers"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -1,55 +1,69 @@
-from config import VIDEO_PATH, YOUTUBE_URL, DETECTION_OBJECT
-from video_downloader import download_video
+from config import (VIDEO_PATH, YOUTUBE_URL, STREAM_KEYFRAMES, USE_SCENE_INDEX, USE_PIPELINE, LABEL_MODE,
+                    LABEL_BUDGET_FRAMES, LABEL_BUDGET_SECONDS)
+from video_downloader import iter_videos
 from video_processor import VideoProcessor
-from model_handler import ModelHandler
+from model_pool import create_model_handler
+from pipeline import PipelineRunner
+from prioritizer import label_with_budget
+import metrics
 import os
+from utils import add_bundled_tools_to_path
+from typing import Iterable
 
-if os.name == 'nt':
-    vips_path = r'vips-dev-8.16\bin' 
-    ffmpeg_path = r'ffmpeg-7.1-essentials_build\bin'
-    current_path = os.path.dirname(os.path.abspath(__file__))
-    vips_path = os.path.join(current_path, vips_path)
-    ffmpeg_path = os.path.join(current_path, ffmpeg_path)
+add_bundled_tools_to_path()
 
-    os.environ['PATH'] = vips_path + os.pathsep + ffmpeg_path + os.pathsep + os.environ.get('PATH', '')
 
-
-def process_single_video(video_path: str, model_handler: ModelHandler):
+def process_single_video(video_path: str, model_handler):
     # Initialize video processor
     processor = VideoProcessor(video_path)
+
+    # Dense mode decodes every frame itself and tracks boxes between detections
+    if LABEL_MODE == "dense":
+        processor.process_dense(model_handler)
+        print(f"Video dense processing completed: {video_path}")
+        return
     
-    # Extract keyframes
-    if not processor.extract_keyframes():
+    # Extract keyframes to disk unless they are streamed straight from FFmpeg
+    if not STREAM_KEYFRAMES and not USE_SCENE_INDEX and not processor.extract_keyframes():
         print(f"Failed to extract keyframes from video: {video_path}")
+        processor.close()
         return
         
-    # Process keyframes
+    # Process keyframes, saves the COCO format annotations when done
     processor.process_keyframes(model_handler)
     
-    # Save COCO format annotations
-    processor.save_coco_annotations()
-    
     print(f"Video keyframe processing completed: {video_path}")
 
-def main():
-    # Download video if needed
-    download_video(YOUTUBE_URL, VIDEO_PATH)
-    
-    # Get the directory path from VIDEO_PATH
-    video_dir = os.path.dirname(VIDEO_PATH) if os.path.dirname(VIDEO_PATH) else "."
-    
+def label_videos(video_paths: Iterable[str]):
+    """Load the model and label all videos, which may be a generator of downloads"""
+    # Dump per-stage metrics periodically when enabled in config
+    metrics.start_periodic_dump()
+
     # Initialize model
-    model_handler = ModelHandler()
+    model_handler = create_model_handler()
     model_handler.load_model()
-    
-    # Process all video files in the directory
-    for filename in os.listdir(video_dir):
-        if filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-            video_path = os.path.join(video_dir, filename)
+
+    budgeted = LABEL_BUDGET_FRAMES is not None or LABEL_BUDGET_SECONDS is not None
+    if budgeted and LABEL_MODE != "dense":
+        # Most promising keyframes first, until the budget is spent
+        label_with_budget(video_paths, model_handler)
+    elif USE_PIPELINE and LABEL_MODE != "dense":
+        PipelineRunner(model_handler).run(video_paths)
+    else:
+        for video_path in video_paths:
             print(f"\nProcessing video: {video_path}")
             process_single_video(video_path, model_handler)
 
+    model_handler.close()
+    metrics.stop_periodic_dump()
     print("\nAll videos have been processed.")
 
+def main():
+    # Get the directory path from VIDEO_PATH
+    video_dir = os.path.dirname(VIDEO_PATH) if os.path.dirname(VIDEO_PATH) else "."
+
+    # Process local videos first, then each download as soon as it finishes
+    label_videos(iter_videos(YOUTUBE_URL, video_dir))
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
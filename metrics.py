@@ -0,0 +1,190 @@
+"""Per-stage latency histograms and counters
+
+Every observation is recorded globally and, when a video name is given, for
+that video too. Snapshots can be written as JSON or as a Prometheus textfile,
+once or periodically from a background thread. When metrics are disabled
+`timer` returns a shared no-op context manager and `inc`/`observe` return
+right away, so instrumented code pays one flag check.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+from config import METRICS_ENABLED, METRICS_PATH, METRICS_FORMAT, METRICS_INTERVAL
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+_enabled = METRICS_ENABLED
+_lock = threading.Lock()
+_counters = {}  # (name, video) -> value
+_histograms = {}  # (name, video) -> Histogram
+_NULL_TIMER = nullcontext()
+_dump_thread = None
+_dump_stop = threading.Event()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "buckets": {("+Inf" if bound == float('inf') else str(bound)): count
+                        for bound, count in zip(BUCKETS, self.counts)}
+        }
+
+
+def enable(enabled: bool = True) -> None:
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name: str, value: float = 1, video: Optional[str] = None) -> None:
+    """Add to a counter"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[(name, None)] = _counters.get((name, None), 0) + value
+        if video is not None:
+            _counters[(name, video)] = _counters.get((name, video), 0) + value
+
+
+def observe(name: str, seconds: float, video: Optional[str] = None) -> None:
+    """Record one latency observation of a stage"""
+    if not _enabled:
+        return
+    with _lock:
+        for key in ((name, None), (name, video)) if video is not None else ((name, None),):
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+
+@contextmanager
+def _timer(name: str, video: Optional[str]):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, video)
+
+
+def timer(name: str, video: Optional[str] = None):
+    """Context manager timing a stage"""
+    if not _enabled:
+        return _NULL_TIMER
+    return _timer(name, video)
+
+
+def snapshot() -> Dict:
+    """Current counters and histograms, global and per video"""
+    with _lock:
+        result = {"timestamp": time.time(), "global": {"counters": {}, "stages": {}}, "videos": {}}
+        for (name, video), value in sorted(_counters.items(), key=lambda item: (item[0][1] or "", item[0][0])):
+            scope = result["global"] if video is None else result["videos"].setdefault(video, {"counters": {}, "stages": {}})
+            scope["counters"][name] = value
+        for (name, video), histogram in sorted(_histograms.items(), key=lambda item: (item[0][1] or "", item[0][0])):
+            scope = result["global"] if video is None else result["videos"].setdefault(video, {"counters": {}, "stages": {}})
+            scope["stages"][name] = histogram.to_dict()
+    return result
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(data: Dict) -> str:
+    """Render a snapshot in the Prometheus text exposition format"""
+    lines = []
+    scopes = [(None, data["global"])] + list(data["videos"].items())
+
+    counter_names = sorted({name for _, scope in scopes for name in scope["counters"]})
+    for name in counter_names:
+        metric = f"dreamlabel_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for video, scope in scopes:
+            if name in scope["counters"]:
+                labels = f'{{video="{_escape(video)}"}}' if video is not None else ""
+                lines.append(f"{metric}{labels} {scope['counters'][name]}")
+
+    lines.append("# TYPE dreamlabel_stage_seconds histogram")
+    for video, scope in scopes:
+        video_label = f',video="{_escape(video)}"' if video is not None else ""
+        for stage, histogram in scope["stages"].items():
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f'dreamlabel_stage_seconds_bucket{{stage="{stage}"{video_label},le="{bound}"}} {cumulative}')
+            lines.append(f'dreamlabel_stage_seconds_sum{{stage="{stage}"{video_label}}} {histogram["sum"]}')
+            lines.append(f'dreamlabel_stage_seconds_count{{stage="{stage}"{video_label}}} {histogram["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def dump(path: str = METRICS_PATH, fmt: str = METRICS_FORMAT) -> None:
+    """Write a snapshot atomically as JSON or Prometheus textfile"""
+    if not _enabled:
+        return
+    data = snapshot()
+    text = to_prometheus(data) if fmt == "prometheus" else json.dumps(data, indent=2)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def _dump_loop(interval: float, path: str, fmt: str) -> None:
+    while not _dump_stop.wait(interval):
+        try:
+            dump(path, fmt)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+
+def start_periodic_dump(interval: float = METRICS_INTERVAL, path: str = METRICS_PATH, fmt: str = METRICS_FORMAT) -> None:
+    """Dump metrics every `interval` seconds from a background thread"""
+    global _dump_thread
+    if not _enabled or _dump_thread is not None:
+        return
+    _dump_stop.clear()
+    _dump_thread = threading.Thread(target=_dump_loop, args=(interval, path, fmt), daemon=True)
+    _dump_thread.start()
+
+
+def stop_periodic_dump(path: str = METRICS_PATH, fmt: str = METRICS_FORMAT) -> None:
+    """Stop the background thread and write a final snapshot"""
+    global _dump_thread
+    if _dump_thread is not None:
+        _dump_stop.set()
+        _dump_thread.join()
+        _dump_thread = None
+    dump(path, fmt)
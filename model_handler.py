@@ -1,25 +1,131 @@
 from transformers import AutoModelForCausalLM
 from PIL import Image
-from config import MODEL_NAME, MODEL_REVISION, DEVICE
+import torch
+from typing import List, Optional, Union
+import metrics
+from config import MODEL_NAME, MODEL_REVISION, DEVICE, CPU_THREADS, CPU_QUANTIZE, CPU_COMPILE
+
+
+def configure_cpu_threads(threads: Optional[int] = None) -> None:
+    """Set the intra-op thread count for CPU inference
+
+    Inter-op parallelism is turned off, the model runs one op at a time and
+    extra pools would only compete with replicas for the same cores.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only settable once, before any parallel work started
+        pass
+
 
 class ModelHandler:
-    def __init__(self):
+    def __init__(self, device: str = DEVICE, threads: Optional[int] = CPU_THREADS,
+                 quantize: bool = CPU_QUANTIZE, compile_model: bool = CPU_COMPILE):
         self.model = None
+        self.device = device
+        self.threads = threads
+        self.quantize = quantize
+        self.compile_model = compile_model
         
     def load_model(self):
         
         if self.model is not None:
             return
+
+        if self.device == "cpu":
+            configure_cpu_threads(self.threads)
             
         self.model = AutoModelForCausalLM.from_pretrained(
-            "vikhyatk/moondream2",
-            revision="2025-01-09",
+            MODEL_NAME,
+            revision=MODEL_REVISION,
             trust_remote_code=True,
-        ).to(DEVICE)
+        ).to(self.device)
+        self.model.eval()
+
+        if self.device == "cpu":
+            if self.quantize:
+                self._quantize()
+            if self.compile_model:
+                self._compile()
+
+    def _check_model(self, model) -> bool:
+        """Run one tiny detection to make sure a transformed model still works"""
+        try:
+            with torch.inference_mode():
+                model.detect(model.encode_image(Image.new("RGB", (64, 64))), "object")
+            return True
+        except Exception as e:
+            print(f"Model check failed: {e}")
+            return False
+
+    def _quantize(self) -> None:
+        """Replace linear layers with dynamically quantized int8 ones"""
+        quantized = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        if self._check_model(quantized):
+            self.model = quantized
+        else:
+            print("Int8 quantization not supported by this model, using float weights")
+
+    def _compile(self) -> None:
+        """Compile image encoding, the check call also warms up the compiled graph"""
+        encode_image = self.model.encode_image
+        self.model.encode_image = torch.compile(encode_image)
+        if not self._check_model(self.model):
+            print("torch.compile failed for this model, running eagerly")
+            self.model.encode_image = encode_image
         
     def detect_objects(self, image: Image.Image, target_object: str) -> list:
  
         if self.model is None:
             self.load_model()
             
-        return self.model.detect(image, target_object)["objects"] 
\ No newline at end of file
+        with metrics.timer("model_detect"):
+            return self.model.detect(image, target_object)["objects"]
+
+    def detect_batch(self, images: List[Image.Image], target_objects: Union[str, List[str]]) -> List[list]:
+        """Detect objects in a list of frames
+
+        This is not a batched forward pass. moondream2's encode_image takes
+        one image and builds that image's own text decoder cache, so frames
+        are still encoded one at a time. Only the crops of a single image
+        share an encoder pass. BATCH_SIZE therefore sets how many frames go
+        through one call, not the encoder batch. Each image is encoded once
+        and the encoding is reused for every target.
+
+        Args:
+            images: Frames to run detection on. Any length, a partial last batch is fine
+            target_objects: Object or list of objects to detect
+
+        Returns:
+            One list of detected objects per input image, in input order. Each
+            object carries the "category_id" of its target (position in the list, from 1)
+        """
+        if self.model is None:
+            self.load_model()
+
+        if isinstance(target_objects, str):
+            target_objects = [target_objects]
+
+        if not images:
+            return []
+
+        results = []
+        metrics.inc("model_images", len(images))
+        with torch.inference_mode():
+            with metrics.timer("model_encode"):
+                encoded = [self.model.encode_image(image) for image in images]
+            with metrics.timer("model_detect"):
+                for enc in encoded:
+                    objects = []
+                    for category_id, target_object in enumerate(target_objects, start=1):
+                        for obj in self.model.detect(enc, target_object)["objects"]:
+                            obj["category_id"] = category_id
+                            objects.append(obj)
+                    results.append(objects)
+        return results
+
+    def close(self) -> None:
+        self.model = None
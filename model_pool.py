@@ -0,0 +1,180 @@
+import os
+import queue
+import threading
+import multiprocessing
+from typing import List, Optional, Union
+from PIL import Image
+import metrics
+from config import DEVICE, CPU_THREADS, CPU_QUANTIZE, CPU_COMPILE, MODEL_REPLICAS, MODEL_SERVER_URL, DETECTION_CACHE
+from model_server import RemoteModelHandler
+from detection_cache import CachedModelHandler
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: List[int], parts: int) -> List[List[int]]:
+    """Split cores into `parts` contiguous, near equal subsets"""
+    parts = max(1, min(parts, len(cores)))
+    size, extra = divmod(len(cores), parts)
+    subsets, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        subsets.append(cores[start:end])
+        start = end
+    return subsets
+
+
+def _replica_worker(cores: List[int], threads: Optional[int], quantize: bool, compile_model: bool,
+                    tasks, results) -> None:
+    """Load one CPU model pinned to `cores` and serve detection tasks until a None task arrives"""
+    from model_handler import ModelHandler
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    handler = ModelHandler(device="cpu", threads=threads or len(cores), quantize=quantize, compile_model=compile_model)
+    try:
+        handler.load_model()
+    except Exception as e:
+        results.put((None, "error", str(e)))
+        return
+    results.put((None, "ready", None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, images, target_objects = task
+        try:
+            results.put((task_id, "ok", handler.detect_batch(images, target_objects)))
+        except Exception as e:
+            results.put((task_id, "error", str(e)))
+
+
+class ModelPool:
+    """CPU model replicas in worker processes, each pinned to its own core subset
+
+    Drop-in replacement for ModelHandler. A batch is split into one chunk per
+    replica and the chunks run in parallel, results come back in input order.
+    Worker processes are started with spawn, forking a process that already
+    initialized torch threads is not safe.
+    """
+
+    def __init__(self, replicas: int = MODEL_REPLICAS, threads: Optional[int] = CPU_THREADS,
+                 quantize: bool = CPU_QUANTIZE, compile_model: bool = CPU_COMPILE):
+        self.core_sets = split_cores(available_cores(), replicas)
+        self.replicas = len(self.core_sets)
+        self.threads = threads
+        self.quantize = quantize
+        self.compile_model = compile_model
+        self.processes = []
+        self.tasks = None
+        self.results = None
+        self._next_task_id = 0
+        self._lock = threading.Lock()
+
+    def load_model(self):
+        if self.processes:
+            return
+
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        for cores in self.core_sets:
+            process = context.Process(
+                target=_replica_worker,
+                args=(cores, self.threads, self.quantize, self.compile_model, self.tasks, self.results),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+        for _ in self.processes:
+            _, status, error = self._get_result()
+            if status != "ready":
+                self.close()
+                raise RuntimeError(f"Model replica failed to load: {error}")
+        print(f"Started {self.replicas} model replicas on cores {self.core_sets}")
+
+    def _get_result(self):
+        """Next result, failing instead of waiting forever when a replica died"""
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [p.pid for p in self.processes if not p.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Model replica processes exited: {dead}")
+
+    def detect_objects(self, image: Image.Image, target_object: str) -> list:
+        return self.detect_batch([image], target_object)[0]
+
+    def detect_batch(self, images: List[Image.Image], target_objects: Union[str, List[str]]) -> List[list]:
+        """Same contract as ModelHandler.detect_batch, chunks run on all replicas"""
+        if not self.processes:
+            self.load_model()
+
+        if not images:
+            return []
+
+        with self._lock, metrics.timer("model_pool"):
+            chunk_count = min(self.replicas, len(images))
+            size, extra = divmod(len(images), chunk_count)
+            pending, start = {}, 0
+            for i in range(chunk_count):
+                end = start + size + (1 if i < extra else 0)
+                task_id = self._next_task_id
+                self._next_task_id += 1
+                pending[task_id] = i
+                self.tasks.put((task_id, images[start:end], target_objects))
+                start = end
+
+            chunks = [None] * chunk_count
+            errors = []
+            while pending:
+                task_id, status, payload = self._get_result()
+                if task_id not in pending:
+                    continue
+                index = pending.pop(task_id)
+                if status == "ok":
+                    chunks[index] = payload
+                else:
+                    errors.append(payload)
+            if errors:
+                raise RuntimeError(f"Detection failed in model replica: {errors[0]}")
+
+        metrics.inc("model_images", len(images))
+        return [objects for chunk in chunks for objects in chunk]
+
+    def close(self) -> None:
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+
+def create_model_handler(use_server: bool = True):
+    """Model for the configured device, a replica pool when several CPU replicas are configured
+
+    Args:
+        use_server: Return a client of MODEL_SERVER_URL when one is configured
+
+    Returns:
+        The handler, wrapped in the detection cache when DETECTION_CACHE is set
+    """
+    if use_server and MODEL_SERVER_URL:
+        model_handler = RemoteModelHandler()
+    elif DEVICE == "cpu" and MODEL_REPLICAS > 1:
+        model_handler = ModelPool()
+    else:
+        # Imported here so server clients and replica pools do not load torch in this process
+        from model_handler import ModelHandler
+        model_handler = ModelHandler()
+    return CachedModelHandler(model_handler) if DETECTION_CACHE else model_handler
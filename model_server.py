@@ -0,0 +1,335 @@
+"""Shared model server with cross-client batching
+
+One process loads the model and serves detection requests over HTTP on
+localhost, so several labeling jobs share one copy of the weights:
+
+    python model_server.py --port 8765
+
+Jobs use it by setting MODEL_SERVER_URL, which makes create_model_handler
+return a RemoteModelHandler. Requests that arrive within SERVER_BATCH_WINDOW
+of each other and ask for the same targets are run as one batch of up to
+BATCH_SIZE images. When more than SERVER_MAX_QUEUE images are waiting, new
+requests get 503 and the client retries with backoff.
+
+Protocol: POST /detect with a JSON header line followed by raw RGB pixels,
+GET /health for queue and batch counters.
+"""
+import json
+import time
+import argparse
+import threading
+import http.client
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Union
+from urllib.parse import urlsplit
+from PIL import Image
+import metrics
+from config import (BATCH_SIZE, MODEL_SERVER_URL, MODEL_SERVER_HOST, MODEL_SERVER_PORT,
+                    SERVER_BATCH_WINDOW, SERVER_MAX_QUEUE)
+
+
+def encode_request(images: List[Image.Image], target_objects: List[str]) -> bytes:
+    images = [image if image.mode == "RGB" else image.convert("RGB") for image in images]
+    header = {"targets": target_objects, "sizes": [image.size for image in images]}
+    return json.dumps(header).encode() + b"\n" + b"".join(image.tobytes() for image in images)
+
+
+def decode_request(body: bytes):
+    newline = body.index(b"\n")
+    header = json.loads(body[:newline])
+    images, offset = [], newline + 1
+    for width, height in header["sizes"]:
+        end = offset + width * height * 3
+        if end > len(body):
+            raise ValueError("Request body shorter than the image sizes in its header")
+        images.append(Image.frombytes("RGB", (width, height), body[offset:end]))
+        offset = end
+    return images, header["targets"]
+
+
+class _Request:
+    def __init__(self, images: List[Image.Image], target_objects: List[str]):
+        self.images = images
+        self.targets = tuple(target_objects)
+        self.arrived = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class ModelServer:
+    """Serve detect_batch of a local model to many clients
+
+    Handler threads queue requests, a single batch thread owns the model and
+    runs everything queued within the batching window as one detect_batch call.
+    """
+
+    def __init__(self, model_handler, host: str = MODEL_SERVER_HOST, port: int = MODEL_SERVER_PORT,
+                 max_batch: int = BATCH_SIZE, batch_window: float = SERVER_BATCH_WINDOW,
+                 max_queue: int = SERVER_MAX_QUEUE):
+        self.model_handler = model_handler
+        self.max_batch = max(1, max_batch)
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+
+        self._pending = deque()
+        self._queued_images = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self.stats = {"requests": 0, "rejected": 0, "batches": 0, "images": 0}
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._batch_thread = threading.Thread(target=self._batch_loop, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status: int, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != "/health":
+                    self._reply(404, {"error": "not found"})
+                    return
+                self._reply(200, server.health())
+
+            def do_POST(self):
+                if self.path != "/detect":
+                    self._reply(404, {"error": "not found"})
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    images, target_objects = decode_request(body)
+                except Exception as e:
+                    self._reply(400, {"error": f"Bad request: {e}"})
+                    return
+
+                request = server.submit(images, target_objects)
+                if request is None:
+                    self._reply(503, {"error": "queue full"})
+                    return
+                request.done.wait()
+                if request.error is not None:
+                    self._reply(500, {"error": request.error})
+                else:
+                    self._reply(200, {"results": request.results})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def submit(self, images: List[Image.Image], target_objects: List[str]) -> Optional[_Request]:
+        """Queue a request, None when the queue is full"""
+        request = _Request(images, target_objects)
+        with self._condition:
+            # An oversized request is still accepted into an empty queue
+            if self._pending and self._queued_images + len(images) > self.max_queue:
+                self.stats["rejected"] += 1
+                metrics.inc("server_rejected")
+                return None
+            self._pending.append(request)
+            self._queued_images += len(images)
+            self.stats["requests"] += 1
+            self._condition.notify()
+        return request
+
+    def _ready_images(self) -> int:
+        """Images queued with the same targets as the oldest request"""
+        targets = self._pending[0].targets
+        return sum(len(request.images) for request in self._pending if request.targets == targets)
+
+    def _take_batch(self) -> List[_Request]:
+        targets = self._pending[0].targets
+        batch, images, remaining = [], 0, deque()
+        for request in self._pending:
+            if request.targets == targets and (not batch or images + len(request.images) <= self.max_batch):
+                batch.append(request)
+                images += len(request.images)
+            else:
+                remaining.append(request)
+        self._pending = remaining
+        self._queued_images -= images
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+                # Wait for more requests until the batch is full or the oldest one has waited long enough
+                deadline = self._pending[0].arrived + self.batch_window
+                while self._ready_images() < self.max_batch and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._take_batch()
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_Request]) -> None:
+        images = [image for request in batch for image in request.images]
+        try:
+            with metrics.timer("server_batch"):
+                results = self.model_handler.detect_batch(images, list(batch[0].targets))
+        except Exception as e:
+            for request in batch:
+                request.error = str(e)
+                request.done.set()
+            return
+
+        self.stats["batches"] += 1
+        self.stats["images"] += len(images)
+        metrics.inc("server_batches")
+        offset = 0
+        for request in batch:
+            request.results = results[offset:offset + len(request.images)]
+            offset += len(request.images)
+            request.done.set()
+
+    def health(self) -> dict:
+        with self._condition:
+            queued = self._queued_images
+        batches = self.stats["batches"]
+        return dict(self.stats, queued_images=queued,
+                    mean_batch=round(self.stats["images"] / batches, 2) if batches else 0.0)
+
+    def start(self) -> None:
+        """Serve in background threads"""
+        self._batch_thread.start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def serve_forever(self) -> None:
+        self._batch_thread.start()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._batch_thread.is_alive():
+            self._batch_thread.join()
+
+
+class RemoteModelHandler:
+    """Drop-in ModelHandler that sends detection requests to a ModelServer
+
+    Each calling thread keeps its own keep-alive connection. A full server
+    queue (503) is retried with exponential backoff.
+    """
+
+    def __init__(self, url: str = MODEL_SERVER_URL, timeout: float = 600, max_retries: int = 20):
+        parsed = urlsplit(url)
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._local = threading.local()
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None):
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                connection.request(method, path, body=body)
+                response = connection.getresponse()
+                return response.status, json.loads(response.read())
+            except (ConnectionError, http.client.HTTPException):
+                # Server closed the kept-alive connection, reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def load_model(self):
+        """Check that the server is reachable, the model lives in the server process"""
+        try:
+            status, _ = self._request("GET", "/health")
+        except OSError as e:
+            raise RuntimeError(f"Model server not reachable at {self.url}: {e}")
+        if status != 200:
+            raise RuntimeError(f"Model server at {self.url} answered {status}")
+
+    def detect_objects(self, image: Image.Image, target_object: str) -> list:
+        return self.detect_batch([image], target_object)[0]
+
+    def detect_batch(self, images: List[Image.Image], target_objects: Union[str, List[str]]) -> List[list]:
+        """Same contract as ModelHandler.detect_batch"""
+        if isinstance(target_objects, str):
+            target_objects = [target_objects]
+        if not images:
+            return []
+
+        body = encode_request(images, target_objects)
+        delay = 0.05
+        for _ in range(self.max_retries + 1):
+            with metrics.timer("model_remote"):
+                status, payload = self._request("POST", "/detect", body)
+            if status == 200:
+                metrics.inc("model_images", len(images))
+                return payload["results"]
+            if status != 503:
+                raise RuntimeError(f"Model server error {status}: {payload.get('error')}")
+            metrics.inc("server_retries")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        raise RuntimeError(f"Model server at {self.url} stayed busy")
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the detection model to labeling jobs on this machine")
+    parser.add_argument('--host', default=MODEL_SERVER_HOST)
+    parser.add_argument('--port', type=int, default=MODEL_SERVER_PORT)
+    parser.add_argument('--batch-window', type=float, default=SERVER_BATCH_WINDOW)
+    parser.add_argument('--max-batch', type=int, default=BATCH_SIZE)
+    parser.add_argument('--max-queue', type=int, default=SERVER_MAX_QUEUE)
+    args = parser.parse_args()
+
+    from model_pool import create_model_handler
+    model_handler = create_model_handler(use_server=False)
+    model_handler.load_model()
+
+    server = ModelServer(model_handler, args.host, args.port, args.max_batch, args.batch_window, args.max_queue)
+    print(f"Model server listening on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        model_handler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import threading
+import queue
+import time
+from typing import Dict, Iterable, List
+from config import BATCH_SIZE, STREAM_KEYFRAMES, USE_SCENE_INDEX, PIPELINE_EXTRACT_WORKERS, PIPELINE_WRITE_WORKERS, PIPELINE_QUEUE_SIZE
+import metrics
+from video_processor import VideoProcessor
+from frame_writer import FrameWriter
+
+# Queue markers
+_VIDEO_DONE = "video_done"
+_PRODUCER_DONE = "producer_done"
+
+
+class StageStats:
+    """Busy time and item count of one pipeline stage"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, items: int = 1) -> None:
+        with self._lock:
+            self.busy += seconds
+            self.items += items
+
+    def report(self, wall_time: float) -> Dict:
+        capacity = wall_time * self.workers
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_seconds": round(self.busy, 3),
+            "utilization": round(self.busy / capacity, 3) if capacity > 0 else 0.0
+        }
+
+
+class PipelineRunner:
+    """Process many videos with overlapping extract / infer / write stages
+
+    A pool of extract workers decodes keyframes of upcoming videos, the calling
+    thread owns the model and runs batched inference, and a pool of writers
+    records annotations and renders frames. Stages are connected by bounded
+    queues, so a slow stage blocks the ones feeding it instead of buffering
+    frames without limit. All frames of one video go to the same writer, which
+    keeps each VideoProcessor single threaded.
+    """
+
+    def __init__(self, model_handler,
+                 extract_workers: int = PIPELINE_EXTRACT_WORKERS,
+                 write_workers: int = PIPELINE_WRITE_WORKERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.model_handler = model_handler
+        self.extract_workers = max(1, extract_workers)
+        self.write_workers = max(1, write_workers)
+        self.queue_size = queue_size
+
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.write_queues = [queue.Queue(maxsize=queue_size) for _ in range(self.write_workers)]
+        self.stats = {
+            "extract": StageStats("extract", self.extract_workers),
+            "infer": StageStats("infer", 1),
+            "write": StageStats("write", self.write_workers)
+        }
+        self._videos = None
+        self.frame_writer = None
+        self._videos_lock = threading.Lock()
+        self._writer_index = 0
+
+    def _next_video(self):
+        with self._videos_lock:
+            return next(self._videos, None)
+
+    def _extract_worker(self) -> None:
+        stats = self.stats["extract"]
+        while True:
+            video_path = self._next_video()
+            if video_path is None:
+                break
+
+            start = time.perf_counter()
+            processor = None
+            try:
+                processor = VideoProcessor(video_path, frame_writer=self.frame_writer)
+                if not STREAM_KEYFRAMES and not USE_SCENE_INDEX and not processor.extract_keyframes():
+                    print(f"Failed to extract keyframes from video: {video_path}")
+                    continue
+
+                keyframes = processor.iter_keyframes()
+                while True:
+                    item = next(keyframes, None)
+                    if item is None:
+                        break
+                    frame_num, pil_image = item
+                    if processor.is_frame_done(frame_num):
+                        metrics.inc("frames_skipped_progress", 1, processor.video_name)
+                        continue
+                    stats.add(time.perf_counter() - start)
+
+                    # Blocking put, time spent waiting on the model is not counted as busy
+                    self.frame_queue.put((processor, frame_num, pil_image))
+                    start = time.perf_counter()
+            except Exception as e:
+                print(f"Error occurred while extracting keyframes from {video_path}: {str(e)}")
+            finally:
+                stats.add(time.perf_counter() - start, items=0)
+                if processor is not None:
+                    self.frame_queue.put((processor, _VIDEO_DONE, None))
+
+        self.frame_queue.put((None, _PRODUCER_DONE, None))
+
+    def _write_worker(self, write_queue: queue.Queue) -> None:
+        stats = self.stats["write"]
+        while True:
+            processor, frame_num, pil_image, detection_results = write_queue.get()
+            if processor is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                if frame_num == _VIDEO_DONE:
+                    processor.finalize()
+                    print(f"Video keyframe processing completed: {processor.video_path}")
+                    stats.add(time.perf_counter() - start, items=0)
+                    continue
+
+                processor.record_detections(frame_num, pil_image, detection_results)
+                processor.mark_frame_done(frame_num)
+            except Exception as e:
+                print(f"Error occurred while writing frame {frame_num} of {processor.video_path}: {str(e)}")
+            stats.add(time.perf_counter() - start)
+
+    def _writer_for(self, processor, writers: Dict) -> queue.Queue:
+        if processor not in writers:
+            writers[processor] = self.write_queues[self._writer_index % self.write_workers]
+            self._writer_index += 1
+        return writers[processor]
+
+    def _dispatch(self, processor, batch: List, writers: Dict) -> None:
+        stats = self.stats["infer"]
+        start = time.perf_counter()
+        pil_images = [pil_image for _, pil_image in batch]
+        try:
+            batch_results = processor.detect_frames(pil_images, self.model_handler)
+        except Exception as e:
+            print(f"Error occurred while running detection on {processor.video_path}: {str(e)}")
+            return
+        finally:
+            stats.add(time.perf_counter() - start, items=len(batch))
+
+        write_queue = self._writer_for(processor, writers)
+        for (frame_num, pil_image), detection_results in zip(batch, batch_results):
+            write_queue.put((processor, frame_num, pil_image, detection_results))
+
+    def run(self, video_paths: Iterable[str]) -> Dict:
+        """Process all videos and return per-stage utilization
+
+        Args:
+            video_paths: Videos to process. May be a generator that yields videos as they become available
+
+        Returns:
+            Report with wall time and busy seconds, item count and utilization per stage
+        """
+        self._videos = iter(video_paths)
+        self.frame_writer = FrameWriter()
+        wall_start = time.perf_counter()
+
+        extractors = [threading.Thread(target=self._extract_worker, daemon=True) for _ in range(self.extract_workers)]
+        writers = [threading.Thread(target=self._write_worker, args=(q,), daemon=True) for q in self.write_queues]
+        for thread in extractors + writers:
+            thread.start()
+
+        # Model stage runs on the calling thread, which owns the model
+        pending = {}
+        video_writers = {}
+        producers_left = self.extract_workers
+        while producers_left > 0:
+            processor, frame_num, pil_image = self.frame_queue.get()
+
+            if frame_num == _PRODUCER_DONE:
+                producers_left -= 1
+                continue
+
+            if frame_num == _VIDEO_DONE:
+                batch = pending.pop(processor, [])
+                if batch:
+                    self._dispatch(processor, batch, video_writers)
+                self._writer_for(processor, video_writers).put((processor, _VIDEO_DONE, None, None))
+                video_writers.pop(processor, None)
+                continue
+
+            batch = pending.setdefault(processor, [])
+            batch.append((frame_num, pil_image))
+            # Dispatch full batches, or whatever is ready when producers fall behind
+            if len(batch) >= BATCH_SIZE or self.frame_queue.empty():
+                self._dispatch(processor, pending.pop(processor), video_writers)
+
+        for write_queue in self.write_queues:
+            write_queue.put((None, None, None, None))
+        for thread in extractors + writers:
+            thread.join()
+        self.frame_writer.close()
+
+        wall_time = time.perf_counter() - wall_start
+        report = {
+            "wall_seconds": round(wall_time, 3),
+            "stages": {name: stats.report(wall_time) for name, stats in self.stats.items()}
+        }
+        self.print_report(report)
+        return report
+
+    @staticmethod
+    def print_report(report: Dict) -> None:
+        print(f"\nPipeline finished in {report['wall_seconds']:.1f}s")
+        for name, stage in report["stages"].items():
+            print(f"  {name:<8} workers={stage['workers']:<3} items={stage['items']:<7} "
+                  f"busy={stage['busy_seconds']:.1f}s utilization={stage['utilization']:.0%}")
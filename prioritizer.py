@@ -0,0 +1,323 @@
+"""Label the keyframes most likely to contain the targets first, within a budget
+
+Most keyframes of a typical corpus have no detections, so with a limited
+number of model calls or limited time the order matters. Every keyframe is
+first decoded at PRIORITY_THUMB_SIDE and scored on the CPU, then the model
+runs on the highest scores, and scores are updated after every batch from
+what the model found.
+"""
+import math
+import time
+import numpy as np
+from PIL import Image
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import (BATCH_SIZE, STREAM_KEYFRAMES, USE_SCENE_INDEX, LABEL_BUDGET_FRAMES, LABEL_BUDGET_SECONDS,
+                    LABEL_BUDGET_SCOPE, PRIORITY_PROBE_FRACTION, PRIORITY_MIN_PROBE, PRIORITY_THUMB_SIDE, PRIORITY_EXPLORE)
+import metrics
+from utils import probe_video
+from frame_prep import FramePreparer
+from frame_writer import FrameWriter
+from video_processor import VideoProcessor
+
+_EMBED_SIDE = 8
+_VISUAL_SHARPNESS = 4  # cosine similarity is raised to this power, so only close look-alikes count
+_TEMPORAL_SCALE = 2.0  # keyframes apart at which the temporal weight falls to 1/e
+
+
+def keyframe_features(image: Image.Image) -> Tuple[np.ndarray, float]:
+    """Unit embedding of an 8x8 color thumbnail, and the edge energy of the image in [0, 1]"""
+    small = np.asarray(image.convert("RGB").resize((_EMBED_SIDE, _EMBED_SIDE), Image.BOX), dtype=np.float32).ravel()
+    small -= small.mean()
+    norm = np.linalg.norm(small)
+    embedding = small / norm if norm > 0 else small
+    gray = np.asarray(image.convert("L"), dtype=np.float32)
+    edges = (np.abs(np.diff(gray, axis=0)).mean() + np.abs(np.diff(gray, axis=1)).mean()) / 510.0
+    return embedding, float(edges)
+
+
+def _ratio(numerator, denominator) -> Optional[float]:
+    return round(numerator / denominator, 3) if denominator else None
+
+
+def _wilson_interval(hits: int, count: int, z: float = 1.96) -> Optional[List[float]]:
+    """95% confidence interval of a hit rate measured on `count` random frames"""
+    if not count:
+        return None
+    rate = hits / count
+    center = (rate + z * z / (2 * count)) / (1 + z * z / count)
+    margin = z * math.sqrt(rate * (1 - rate) / count + z * z / (4 * count * count)) / (1 + z * z / count)
+    return [round(max(0.0, center - margin), 3), round(min(1.0, center + margin), 3)]
+
+
+class KeyframeScorer:
+    """Estimate how likely each keyframe is to get detections
+
+    The score of a keyframe is the hit rate of labeled keyframes that look
+    like it or are next to it in the same video, weighted by similarity. The
+    hit rate so far, raised for frames with more edge detail, acts as a prior
+    worth one labeled frame. Keyframes unlike any labeled one get a bonus, so
+    a part of the corpus is not written off after its first misses.
+    """
+
+    def __init__(self, explore: float = PRIORITY_EXPLORE):
+        self.explore = explore
+        self.keys = []  # (video index, frame_num) of every keyframe
+        self._features = []
+        self._positions = defaultdict(int)
+        self.hits = 0
+        self.count = 0
+
+    def add(self, video_index: int, frame_num: int, image: Image.Image) -> None:
+        embedding, edges = keyframe_features(image)
+        self.keys.append((video_index, frame_num))
+        self._features.append((embedding, edges, self._positions[video_index]))
+        self._positions[video_index] += 1
+
+    def freeze(self) -> None:
+        """Build the score arrays once all keyframes are added"""
+        count = len(self.keys)
+        self.embeddings = np.array([f[0] for f in self._features], dtype=np.float32).reshape(count, _EMBED_SIDE * _EMBED_SIDE * 3)
+        edges = np.array([f[1] for f in self._features], dtype=np.float32)
+        self.edge_rank = edges.argsort().argsort() / max(1, count - 1)
+        self.positions = np.array([f[2] for f in self._features], dtype=np.float32)
+        self.videos = np.array([key[0] for key in self.keys], dtype=np.int32)
+        self.weight = np.zeros(count, dtype=np.float32)
+        self.weighted_hits = np.zeros(count, dtype=np.float32)
+        self.labeled = np.zeros(count, dtype=bool)
+        self._features = None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def remaining(self) -> int:
+        return int((~self.labeled).sum())
+
+    def scores(self) -> np.ndarray:
+        base = (self.hits + 1) / (self.count + 2)
+        prior = np.clip(base * (0.5 + self.edge_rank), 0.0, 1.0)
+        scores = (prior + self.weighted_hits + self.explore) / (1.0 + self.weight)
+        scores[self.labeled] = -np.inf
+        return scores
+
+    def best(self, count: int) -> List[int]:
+        count = min(count, self.remaining())
+        return np.argsort(-self.scores(), kind='stable')[:count].tolist()
+
+    def random(self, count: int, rng: np.random.Generator) -> List[int]:
+        unlabeled = np.flatnonzero(~self.labeled)
+        return rng.choice(unlabeled, size=min(count, len(unlabeled)), replace=False).tolist()
+
+    def update(self, indices: List[int], hits: List[bool]) -> None:
+        """Spread the outcome of labeled keyframes to similar and neighbouring ones"""
+        if not indices:
+            return
+        idx = np.asarray(indices)
+        outcome = np.asarray(hits, dtype=np.float32)
+        visual = np.clip(self.embeddings @ self.embeddings[idx].T, 0.0, None) ** _VISUAL_SHARPNESS
+        same_video = self.videos[:, None] == self.videos[idx][None, :]
+        temporal = np.exp(-np.abs(self.positions[:, None] - self.positions[idx][None, :]) / _TEMPORAL_SCALE) * same_video
+        weight = np.maximum(visual, temporal)
+        self.weight += weight.sum(axis=1)
+        self.weighted_hits += weight @ outcome
+        self.labeled[idx] = True
+        self.hits += int(outcome.sum())
+        self.count += len(idx)
+
+    def discard(self, indices: List[int]) -> None:
+        """Drop keyframes that could not be decoded"""
+        self.labeled[list(indices)] = True
+
+
+class PriorityLabeler:
+    """Label keyframes of one or more videos in score order until the budget is spent
+
+    A random probe of PRIORITY_PROBE_FRACTION of the budget is labeled first.
+    It seeds the scores and, being a random sample, estimates the yield of
+    labeling in the exhaustive order, which is what the prioritized yield is
+    reported against. Budgets count model calls, so near-duplicate keyframes
+    that reuse detections are free, and wall time from the start of scoring.
+    """
+
+    def __init__(self, model_handler, budget_frames: Optional[int] = LABEL_BUDGET_FRAMES,
+                 budget_seconds: Optional[float] = LABEL_BUDGET_SECONDS,
+                 probe_fraction: float = PRIORITY_PROBE_FRACTION, seed: int = 0):
+        self.model_handler = model_handler
+        self.budget_frames = budget_frames
+        self.budget_seconds = budget_seconds
+        self.probe_fraction = probe_fraction
+        self.rng = np.random.default_rng(seed)
+        self.scorer = KeyframeScorer()
+        self.processors = []
+        self.frame_writer = FrameWriter()
+        self.start = time.perf_counter()
+        self.scoring_seconds = 0.0
+        self.stats = {group: {"frames": 0, "model_calls": 0, "annotated": 0} for group in ("probe", "prioritized")}
+
+    def add_video(self, video_path: str) -> int:
+        """Score the unprocessed keyframes of a video, returns how many"""
+        start = time.perf_counter()
+        processor = VideoProcessor(video_path, frame_writer=self.frame_writer)
+        if not STREAM_KEYFRAMES and not USE_SCENE_INDEX and not processor.extract_keyframes():
+            print(f"Failed to extract keyframes from video: {video_path}")
+            processor.close()
+            return 0
+
+        info = probe_video(video_path)
+        processor.preparer = FramePreparer(info["width"], info["height"], PRIORITY_THUMB_SIDE)
+        video_index = len(self.processors)
+        count = 0
+        with metrics.timer("score_keyframes", processor.video_name):
+            for frame_num, image in processor.iter_keyframes(save_keyframes=False):
+                if processor.is_frame_done(frame_num):
+                    metrics.inc("frames_skipped_progress", 1, processor.video_name)
+                    continue
+                self.scorer.add(video_index, frame_num, image)
+                count += 1
+        # Labeling decodes the selected keyframes again at the inference resolution
+        processor.preparer = FramePreparer(info["width"], info["height"])
+        self.processors.append(processor)
+        self.scoring_seconds += time.perf_counter() - start
+        print(f"Scored {count} keyframes of {video_path}")
+        return count
+
+    @property
+    def model_calls(self) -> int:
+        return sum(stats["model_calls"] for stats in self.stats.values())
+
+    def _calls_left(self) -> Optional[int]:
+        if self.budget_seconds is not None and time.perf_counter() - self.start >= self.budget_seconds:
+            return 0
+        if self.budget_frames is None:
+            return None
+        return max(0, self.budget_frames - self.model_calls)
+
+    def _label(self, indices: List[int], group: str) -> None:
+        stats = self.stats[group]
+        by_video = defaultdict(dict)
+        for i in indices:
+            video_index, frame_num = self.scorer.keys[i]
+            by_video[video_index][frame_num] = i
+
+        labeled, hits = [], []
+        for video_index, index_of in by_video.items():
+            processor = self.processors[video_index]
+            batch = list(processor.read_selected_keyframes(list(index_of)))
+            calls = processor.model_calls
+            results = processor.detect_frames([image for _, image in batch], self.model_handler)
+            stats["model_calls"] += processor.model_calls - calls
+            for (frame_num, image), detection_results in zip(batch, results):
+                processor.record_detections(frame_num, image, detection_results)
+                processor.mark_frame_done(frame_num)
+                labeled.append(index_of.pop(frame_num))
+                hits.append(bool(detection_results))
+            # Whatever is left could not be decoded
+            self.scorer.discard(list(index_of.values()))
+
+        self.scorer.update(labeled, hits)
+        stats["frames"] += len(labeled)
+        stats["annotated"] += sum(hits)
+
+    def run(self) -> Dict:
+        """Label within the budget, finalize the videos and return the yield report"""
+        self.scorer.freeze()
+        planned = self.budget_frames if self.budget_frames is not None else len(self.scorer)
+        probe_left = min(len(self.scorer), math.ceil(self.probe_fraction * planned))
+
+        try:
+            while self.scorer.remaining():
+                calls_left = self._calls_left()
+                if calls_left == 0:
+                    break
+                size = BATCH_SIZE if calls_left is None else min(BATCH_SIZE, calls_left)
+                if probe_left > 0:
+                    size = min(size, probe_left)
+                    probe_left -= size
+                    self._label(self.scorer.random(size, self.rng), "probe")
+                else:
+                    self._label(self.scorer.best(size), "prioritized")
+        finally:
+            for processor in self.processors:
+                processor.finalize()
+            self.frame_writer.close()
+
+        report = self.report()
+        self.print_report(report)
+        return report
+
+    def report(self) -> Dict:
+        """Annotated frames per labeled frame (hit rate) and per model call, by group
+
+        Near-duplicate keyframes reuse detections without a model call, so the
+        lift compares hit rates, which do not depend on deduplication. It is
+        only given once the probe has PRIORITY_MIN_PROBE frames, together with
+        the confidence interval of the probe's hit rate.
+        """
+        groups = {}
+        for group, stats in self.stats.items():
+            groups[group] = dict(stats, hit_rate=_ratio(stats["annotated"], stats["frames"]),
+                                 yield_per_call=_ratio(stats["annotated"], stats["model_calls"]))
+        total_calls = self.model_calls
+        total_frames = sum(stats["frames"] for stats in self.stats.values())
+        total_annotated = sum(stats["annotated"] for stats in self.stats.values())
+        probe = groups["probe"]
+        probe["hit_rate_interval"] = _wilson_interval(probe["annotated"], probe["frames"])
+        prioritized_rate = groups["prioritized"]["hit_rate"]
+        lift = None
+        if probe["frames"] >= PRIORITY_MIN_PROBE and prioritized_rate is not None:
+            lift = _ratio(prioritized_rate, probe["hit_rate"])
+        return {
+            "videos": len(self.processors),
+            "keyframes": len(self.scorer),
+            "unlabeled": self.scorer.remaining(),
+            "model_calls": total_calls,
+            "annotated": total_annotated,
+            "hit_rate": _ratio(total_annotated, total_frames),
+            "yield_per_call": _ratio(total_annotated, total_calls),
+            "groups": groups,
+            # The random probe estimates the hit rate of labeling in the exhaustive order
+            "lift": lift,
+            "min_probe": PRIORITY_MIN_PROBE,
+            "scoring_seconds": round(self.scoring_seconds, 3),
+            "wall_seconds": round(time.perf_counter() - self.start, 3)
+        }
+
+    @staticmethod
+    def print_report(report: Dict) -> None:
+        print(f"\nLabeled {report['keyframes'] - report['unlabeled']} of {report['keyframes']} keyframes with "
+              f"{report['model_calls']} model calls in {report['wall_seconds']:.1f}s "
+              f"(scoring {report['scoring_seconds']:.1f}s)")
+        for group, stats in report["groups"].items():
+            rate_text = "n/a" if stats["hit_rate"] is None else f"{stats['hit_rate']:.2f}"
+            print(f"  {group:<12} frames={stats['frames']:<6} calls={stats['model_calls']:<6} "
+                  f"annotated={stats['annotated']:<6} hit_rate={rate_text}")
+        probe = report["groups"]["probe"]
+        if report["lift"] is not None:
+            low, high = probe["hit_rate_interval"]
+            print(f"  Prioritized hit rate is {report['lift']:.2f}x the random probe, which estimates the "
+                  f"exhaustive order (probe 95% interval {low:.2f}-{high:.2f}, {probe['frames']} frames)")
+        elif probe["frames"] < report["min_probe"]:
+            print(f"  Probe of {probe['frames']} frames is too small to estimate the exhaustive order, "
+                  f"PRIORITY_MIN_PROBE is {report['min_probe']}")
+
+
+def label_with_budget(video_paths: Iterable[str], model_handler, scope: str = LABEL_BUDGET_SCOPE) -> List[Dict]:
+    """Label videos in priority order within the configured budget
+
+    With scope "video" each video gets the full budget. With "global" all
+    videos are scored first and share one budget, so the most promising
+    keyframes of the whole corpus are labeled first.
+    """
+    if scope == "global":
+        labeler = PriorityLabeler(model_handler)
+        for video_path in video_paths:
+            labeler.add_video(video_path)
+        return [labeler.run()]
+
+    reports = []
+    for video_path in video_paths:
+        print(f"\nProcessing video: {video_path}")
+        labeler = PriorityLabeler(model_handler)
+        labeler.add_video(video_path)
+        reports.append(labeler.run())
+    return reports
@@ -0,0 +1,113 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, Set
+from config import PROGRESS_DB, PROGRESS_WAL
+
+
+class ProgressStore:
+    """Processed-frame progress of every video, stored in SQLite
+
+    With `wal` the database runs in WAL mode, so several processes on one
+    machine can mark frames while others read. Without it a rollback journal
+    is used, which is safe on network storage shared by several machines.
+    Marking or checking one frame is a single indexed statement and each
+    commit is atomic, unlike rewriting a shared progress.json.
+    """
+
+    def __init__(self, db_path: str = PROGRESS_DB, legacy_json: str = 'progress.json', wal: bool = PROGRESS_WAL):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_frames ("
+            "video TEXT NOT NULL, frame INTEGER NOT NULL, PRIMARY KEY (video, frame)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        if legacy_json and os.path.exists(legacy_json):
+            self.migrate_json(legacy_json)
+
+    def migrate_json(self, progress_file: str) -> int:
+        """Import an old progress.json once and rename it to progress.json.migrated
+
+        Returns:
+            Number of frames imported, 0 if another process already migrated it
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone()
+                if done:
+                    self.conn.execute("COMMIT")
+                    return 0
+
+                try:
+                    with open(progress_file, 'r') as f:
+                        progress = json.load(f)
+                except Exception as e:
+                    print(f"Error loading progress: {e}")
+                    progress = {}
+
+                rows = [(video, int(frame)) for video, frames in progress.items() for frame in frames]
+                self.conn.executemany("INSERT OR IGNORE INTO processed_frames VALUES (?, ?)", rows)
+                self.conn.execute("INSERT INTO meta VALUES ('migrated_json', ?)", (progress_file,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        try:
+            os.replace(progress_file, progress_file + '.migrated')
+        except OSError:
+            pass
+        print(f"Migrated {len(rows)} processed frames from {progress_file} to {self.db_path}")
+        return len(rows)
+
+    def mark_done(self, video_name: str, frame_num: int) -> None:
+        with self._lock:
+            self.conn.execute("INSERT OR IGNORE INTO processed_frames VALUES (?, ?)", (video_name, frame_num))
+
+    def mark_many(self, video_name: str, frame_nums: Iterable[int]) -> None:
+        """Mark several frames done in one transaction"""
+        rows = [(video_name, frame_num) for frame_num in frame_nums]
+        if not rows:
+            return
+        with self._lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR IGNORE INTO processed_frames VALUES (?, ?)", rows)
+            self.conn.execute("COMMIT")
+
+    def is_done(self, video_name: str, frame_num: int) -> bool:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM processed_frames WHERE video = ? AND frame = ?", (video_name, frame_num)
+            ).fetchone()
+        return row is not None
+
+    def done_frames(self, video_name: str) -> Set[int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT frame FROM processed_frames WHERE video = ?", (video_name,)).fetchall()
+        return {row[0] for row in rows}
+
+    def count(self, video_name: str) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM processed_frames WHERE video = ?", (video_name,)
+            ).fetchone()[0]
+
+    def video_counts(self) -> Dict[str, int]:
+        """Number of processed frames of every video"""
+        with self._lock:
+            rows = self.conn.execute("SELECT video, COUNT(*) FROM processed_frames GROUP BY video").fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        """Close the connection, safe to call more than once"""
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,74 @@
+"""Re-render boxes and COCO files from the detection cache
+
+Regenerates box/<video>/ images and annotations/<video>_annotations.json
+for every keyframe without loading or running the model, for example after
+changing BOX_COLOR, BOX_WIDTH, FRAME_FORMAT or SAVE_FRAME:
+
+    python render.py                  # all videos in VIDEO_PATH
+    python render.py Video/clip.mp4
+
+Keyframes missing from the cache are counted in the hit-rate report and keep
+the annotations they had. A video with fewer than RENDER_MIN_HIT_RATE of its
+keyframes in the cache is left as it is, label it with main.py first.
+"""
+import os
+import argparse
+from config import VIDEO_PATH
+from utils import list_videos
+from detection_cache import DetectionCache, CacheOnlyHandler
+from frame_writer import FrameWriter
+from video_processor import VideoProcessor
+
+
+def render_videos(video_paths, cache: DetectionCache) -> dict:
+    """Render all videos from the cache and return frame and hit counts"""
+    cache_handler = CacheOnlyHandler(cache)
+    frame_writer = FrameWriter()
+    reused = 0
+    kept_videos = 0
+    try:
+        for video_path in video_paths:
+            print(f"\nRendering video: {video_path}")
+            processor = VideoProcessor(video_path, frame_writer=frame_writer)
+            if not processor.render_from_cache(cache_handler):
+                kept_videos += 1
+            reused += processor.model_calls_saved
+    finally:
+        frame_writer.close()
+
+    hits = cache_handler.frames - cache_handler.missed_frames
+    return {
+        "videos": len(video_paths),
+        "videos_kept": kept_videos,
+        "frames_looked_up": cache_handler.frames,
+        "frames_hit": hits,
+        "frames_missed": cache_handler.missed_frames,
+        "frames_reused": reused,
+        "hit_rate": hits / cache_handler.frames if cache_handler.frames else 0.0
+    }
+
+
+def render(video_paths) -> dict:
+    """Render videos from the default cache and print the hit rate"""
+    cache = DetectionCache()
+    report = render_videos(video_paths, cache)
+    print(f"\nRendered {report['videos']} videos from cache: {report['frames_hit']} of "
+          f"{report['frames_looked_up']} keyframes hit ({report['hit_rate']:.1%}), "
+          f"{report['frames_missed']} missed, {report['frames_reused']} reused from near-duplicates")
+    if report["videos_kept"]:
+        print(f"{report['videos_kept']} videos kept their annotations because too few keyframes hit the cache")
+    cache.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-render boxes and COCO files from cached detections")
+    parser.add_argument('videos', nargs='*', help="Videos to render, defaults to all videos in VIDEO_PATH")
+    args = parser.parse_args()
+
+    video_dir = os.path.dirname(VIDEO_PATH) if os.path.dirname(VIDEO_PATH) else "."
+    render(args.videos or list_videos(video_dir))
+
+
+if __name__ == "__main__":
+    main()
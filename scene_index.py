@@ -0,0 +1,153 @@
+import os
+import re
+import argparse
+import subprocess
+import numpy as np
+from typing import List, Optional
+from config import SCENE_THRESHOLD
+from utils import get_video_name, create_directory, probe_video
+from extraction_manifest import video_fingerprint
+
+_SCENE_PATTERN = re.compile(r'lavfi\.scene_score=([\d.]+)')
+_SHOWINFO_PATTERN = re.compile(r'n:\s*(\d+)\s.*?pts_time:\s*(-?[\d.]+).*?\stype:(\w)')
+
+
+class SceneIndex:
+    """Scene-change score and picture type of every frame of a video
+
+    Built by one FFmpeg decode and stored as keyframes/<video>/scene_index.npz.
+    Keyframes for any threshold or per-minute budget are then selected from
+    the index without decoding the video again.
+    """
+
+    def __init__(self, frames: np.ndarray, pts_time: np.ndarray, scene: np.ndarray, is_key: np.ndarray, fps: float):
+        self.frames = frames
+        self.pts_time = pts_time
+        self.scene = scene
+        self.is_key = is_key
+        self.fps = fps
+
+    @staticmethod
+    def index_path(video_path: str) -> str:
+        return os.path.join('keyframes', get_video_name(video_path), 'scene_index.npz')
+
+    @classmethod
+    def build(cls, video_path: str) -> "SceneIndex":
+        """Decode the video once and record the score and type of every frame"""
+        fps = probe_video(video_path)["fps"]
+        cmd = [
+            'ffmpeg', '-nostats', '-i', video_path,
+            '-vf', "select='gte(scene,0)',metadata=mode=print,showinfo=checksum=0",
+            '-f', 'null', '-'
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+
+        pts_times, scores, keys = [], [], []
+        score = 0.0
+        tail = []
+        for line in process.stderr:
+            # metadata prints the score of a frame right before showinfo describes it
+            match = _SCENE_PATTERN.search(line)
+            if match:
+                score = float(match.group(1))
+                continue
+            if 'Parsed_showinfo' in line:
+                match = _SHOWINFO_PATTERN.search(line)
+                if match:
+                    pts_times.append(float(match.group(2)))
+                    scores.append(score)
+                    keys.append(match.group(3) == 'I')
+                    score = 0.0
+                continue
+            tail.append(line)
+            del tail[:-20]
+
+        if process.wait() != 0:
+            raise RuntimeError(f"FFmpeg scene analysis failed: {''.join(tail)}")
+
+        pts_time = np.array(pts_times, dtype=np.float64)
+        return cls(
+            frames=np.rint(pts_time * fps).astype(np.int64),
+            pts_time=pts_time,
+            scene=np.array(scores, dtype=np.float32),
+            is_key=np.array(keys, dtype=bool),
+            fps=fps
+        )
+
+    def save(self, path: str, fingerprint: dict) -> None:
+        create_directory(os.path.dirname(path))
+        temp_path = path + '.tmp.npz'
+        np.savez_compressed(temp_path, frames=self.frames, pts_time=self.pts_time, scene=self.scene,
+                            is_key=self.is_key, fps=self.fps, fingerprint=fingerprint.get("hash", ""),
+                            size=fingerprint["size"])
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load_or_build(cls, video_path: str) -> "SceneIndex":
+        """Load the stored index if it belongs to this video content, otherwise build and store it"""
+        path = cls.index_path(video_path)
+        fingerprint = video_fingerprint(video_path)
+        if os.path.exists(path):
+            try:
+                data = np.load(path)
+                if str(data["fingerprint"]) == fingerprint["hash"] and int(data["size"]) == fingerprint["size"]:
+                    return cls(data["frames"], data["pts_time"], data["scene"], data["is_key"], float(data["fps"]))
+            except Exception as e:
+                print(f"Error loading scene index: {e}")
+
+        print(f"Building scene index: {path}")
+        index = cls.build(video_path)
+        index.save(path, fingerprint)
+        return index
+
+    def select(self, threshold: Optional[float] = SCENE_THRESHOLD, max_per_minute: Optional[int] = None) -> List[int]:
+        """Frame numbers of the keyframes for a threshold and/or budget
+
+        Args:
+            threshold: Same rule as the FFmpeg select filter: I-frames plus frames
+                with a scene score above the threshold. None selects every frame
+            max_per_minute: Keep at most this many of the selected frames in each
+                minute of video, the ones with the highest scene scores
+
+        Returns:
+            Sorted frame numbers
+        """
+        mask = np.ones(len(self.frames), dtype=bool) if threshold is None else (self.is_key | (self.scene > threshold))
+        candidates = np.flatnonzero(mask)
+
+        if max_per_minute is not None and len(candidates):
+            minutes = (self.pts_time[candidates] // 60).astype(np.int64)
+            # Sort by minute, then by descending score, and keep the first K of every minute
+            order = np.lexsort((-self.scene[candidates], minutes))
+            candidates, minutes = candidates[order], minutes[order]
+            starts = np.searchsorted(minutes, minutes, side='left')
+            candidates = candidates[np.arange(len(candidates)) - starts < max_per_minute]
+
+        return sorted(int(frame) for frame in self.frames[candidates])
+
+    def threshold_counts(self, thresholds: List[float]) -> dict:
+        """Number of keyframes each threshold would select"""
+        return {threshold: int(np.count_nonzero(self.is_key | (self.scene > threshold))) for threshold in thresholds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a scene index and preview keyframe counts")
+    parser.add_argument('video_path')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.4, 0.5])
+    parser.add_argument('--max-per-minute', type=int)
+    args = parser.parse_args()
+
+    index = SceneIndex.load_or_build(args.video_path)
+    duration_minutes = max(len(index.frames) / index.fps / 60, 1e-9) if index.fps else 0
+    print(f"{len(index.frames)} frames, {int(index.is_key.sum())} I-frames")
+    for threshold, count in index.threshold_counts(args.thresholds).items():
+        line = f"threshold {threshold:.2f}: {count} keyframes"
+        if duration_minutes:
+            line += f" ({count / duration_minutes:.1f}/min)"
+        if args.max_per_minute is not None:
+            line += f", {len(index.select(threshold, args.max_per_minute))} with max {args.max_per_minute}/min"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
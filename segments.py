@@ -0,0 +1,51 @@
+import re
+import subprocess
+from typing import List, Optional, Tuple
+
+_PTS_TIME_PATTERN = re.compile(r'pts_time:\s*(-?[\d.]+)')
+
+
+def find_iframe_times(video_path: str) -> List[float]:
+    """Timestamps of all I-frames, decoding only the I-frames"""
+    cmd = [
+        'ffmpeg', '-nostats', '-skip_frame', 'nokey', '-i', video_path,
+        '-vf', 'showinfo=checksum=0',
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg I-frame scan failed: {result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if 'Parsed_showinfo' in line and ' n:' in line:
+            match = _PTS_TIME_PATTERN.search(line)
+            if match:
+                times.append(float(match.group(1)))
+    return sorted(times)
+
+
+def plan_segments(iframe_frames: List[int], total_frames: int, count: int, min_frames: int) -> List[Tuple[int, Optional[int]]]:
+    """Split a video into about `count` frame ranges that start on I-frames
+
+    Args:
+        iframe_frames: Frame numbers of the I-frames
+        total_frames: Number of frames in the video
+        count: Wanted number of segments
+        min_frames: Minimum segment length
+
+    Returns:
+        (start_frame, end_frame) ranges, end exclusive and None for the last one
+    """
+    boundaries = [0]
+    if count > 1 and total_frames > 0:
+        for k in range(1, count):
+            target = k * total_frames / count
+            # I-frame closest to the ideal split point
+            nearest = min(iframe_frames, key=lambda frame: abs(frame - target), default=None)
+            if nearest is None:
+                break
+            if nearest - boundaries[-1] >= min_frames and total_frames - nearest >= min_frames:
+                boundaries.append(nearest)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:] + [None])]
@@ -0,0 +1,145 @@
+import cv2
+import numpy as np
+from typing import Dict, List, Tuple
+from config import TRACK_IOU_THRESHOLD, TRACK_MAX_SIDE, TRACK_MAX_POINTS
+
+
+def box_iou(a: Dict, b: Dict) -> float:
+    """Intersection over union of two boxes in relative coordinates"""
+    x_min = max(a["x_min"], b["x_min"])
+    y_min = max(a["y_min"], b["y_min"])
+    x_max = min(a["x_max"], b["x_max"])
+    y_max = min(a["y_max"], b["y_max"])
+    intersection = max(0.0, x_max - x_min) * max(0.0, y_max - y_min)
+    area_a = (a["x_max"] - a["x_min"]) * (a["y_max"] - a["y_min"])
+    area_b = (b["x_max"] - b["x_min"]) * (b["y_max"] - b["y_min"])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class BoxTracker:
+    """Carry detection boxes between detector runs with sparse optical flow
+
+    Corners inside each box are tracked with pyramidal Lucas-Kanade flow on a
+    downscaled grayscale frame and checked forward-backward. The box moves by
+    the median displacement and scales by the median spread ratio of the
+    surviving points. Confidence of a track is the fraction of points that
+    survive, the frame confidence is the lowest track confidence.
+    """
+
+    def __init__(self, iou_threshold: float = TRACK_IOU_THRESHOLD, max_side: int = TRACK_MAX_SIDE,
+                 max_points: int = TRACK_MAX_POINTS):
+        self.iou_threshold = iou_threshold
+        self.max_side = max_side
+        self.max_points = max_points
+        self.tracks = []  # detection dicts with a "track_id"
+        self.next_track_id = 1
+        self.prev_gray = None
+
+    def prepare(self, frame: np.ndarray) -> np.ndarray:
+        """Downscaled grayscale copy of a BGR frame used for tracking"""
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.max_side / max(height, width))
+        if scale < 1.0:
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def reset(self) -> None:
+        """Forget the previous frame, the next frame must be detected"""
+        self.prev_gray = None
+
+    def update_from_detections(self, gray: np.ndarray, detections: List[Dict]) -> List[Dict]:
+        """Replace tracks with fresh detections, keeping track ids of boxes that overlap a track
+
+        Returns:
+            The detections with a "track_id" added
+        """
+        unmatched = list(self.tracks)
+        tracked = []
+        for obj in detections:
+            if not all(key in obj for key in ("x_min", "y_min", "x_max", "y_max")):
+                continue
+            best, best_iou = None, self.iou_threshold
+            for track in unmatched:
+                iou = box_iou(obj, track)
+                if iou >= best_iou and track.get("category_id") == obj.get("category_id"):
+                    best, best_iou = track, iou
+            obj = dict(obj)
+            if best is not None:
+                unmatched.remove(best)
+                obj["track_id"] = best["track_id"]
+            else:
+                obj["track_id"] = self.next_track_id
+                self.next_track_id += 1
+            tracked.append(obj)
+
+        self.tracks = tracked
+        self.prev_gray = gray
+        return [dict(obj) for obj in tracked]
+
+    def _box_points(self, gray: np.ndarray, obj: Dict):
+        height, width = gray.shape
+        x_min, y_min = int(obj["x_min"] * width), int(obj["y_min"] * height)
+        x_max, y_max = int(np.ceil(obj["x_max"] * width)), int(np.ceil(obj["y_max"] * height))
+        x_min, y_min = max(0, x_min), max(0, y_min)
+        x_max, y_max = min(width, x_max), min(height, y_max)
+        if x_max - x_min < 2 or y_max - y_min < 2:
+            return None
+        mask = np.zeros_like(gray)
+        mask[y_min:y_max, x_min:x_max] = 255
+        return cv2.goodFeaturesToTrack(gray, maxCorners=self.max_points, qualityLevel=0.01, minDistance=3, mask=mask)
+
+    def _track_box(self, gray: np.ndarray, obj: Dict) -> Tuple[Dict, float]:
+        points = self._box_points(self.prev_gray, obj)
+        if points is None or len(points) < 3:
+            return obj, 0.0
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, moved, None, winSize=(15, 15), maxLevel=2)
+        error = np.linalg.norm((points - back).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < 1.0)
+        if good.sum() < 3:
+            return obj, 0.0
+
+        old = points.reshape(-1, 2)[good]
+        new = moved.reshape(-1, 2)[good]
+        dx, dy = np.median(new - old, axis=0)
+
+        old_spread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+        new_spread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+        valid = old_spread > 1e-3
+        scale = float(np.median(new_spread[valid] / old_spread[valid])) if valid.any() else 1.0
+
+        height, width = gray.shape
+        center_x = (obj["x_min"] + obj["x_max"]) / 2 + dx / width
+        center_y = (obj["y_min"] + obj["y_max"]) / 2 + dy / height
+        half_w = (obj["x_max"] - obj["x_min"]) / 2 * scale
+        half_h = (obj["y_max"] - obj["y_min"]) / 2 * scale
+
+        moved_obj = dict(obj)
+        moved_obj["x_min"] = min(max(center_x - half_w, 0.0), 1.0)
+        moved_obj["y_min"] = min(max(center_y - half_h, 0.0), 1.0)
+        moved_obj["x_max"] = min(max(center_x + half_w, 0.0), 1.0)
+        moved_obj["y_max"] = min(max(center_y + half_h, 0.0), 1.0)
+        return moved_obj, good.sum() / len(points)
+
+    def update(self, gray: np.ndarray) -> Tuple[List[Dict], float]:
+        """Move every track to the new frame
+
+        Returns:
+            (tracked boxes, frame confidence). Confidence is 0 when there is no
+            previous frame and 1 when there is nothing to track
+        """
+        if self.prev_gray is None:
+            return [], 0.0
+
+        confidence = 1.0
+        tracks = []
+        for obj in self.tracks:
+            moved_obj, track_confidence = self._track_box(gray, obj)
+            confidence = min(confidence, track_confidence)
+            tracks.append(moved_obj)
+
+        self.tracks = tracks
+        self.prev_gray = gray
+        return [dict(obj) for obj in tracks], confidence
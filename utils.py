@@ -1,23 +1,84 @@
-import cv2
 from PIL import Image, ImageDraw
 import os
 import json
+import subprocess
 from datetime import datetime
-from typing import Dict, List
-from config import BOX_COLOR, BOX_WIDTH, SAVE_DIR, DETECTION_OBJECT
+from typing import Dict, List, Optional, Tuple
+import metrics
+from config import BOX_COLOR, BOX_WIDTH, SAVE_DIR, DETECTION_OBJECTS
+
+def add_bundled_tools_to_path() -> None:
+    """Put the vips and FFmpeg builds shipped next to the scripts on PATH on Windows"""
+    if os.name != 'nt':
+        return
+    current_path = os.path.dirname(os.path.abspath(__file__))
+    vips_path = os.path.join(current_path, r'vips-dev-8.16\bin')
+    ffmpeg_path = os.path.join(current_path, r'ffmpeg-7.1-essentials_build\bin')
+    os.environ['PATH'] = vips_path + os.pathsep + ffmpeg_path + os.pathsep + os.environ.get('PATH', '')
 
 def cv2_to_pil(cv2_frame) -> Image.Image:
-    rgb_frame = cv2.cvtColor(cv2_frame, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(rgb_frame)
+    import cv2
+
+    with metrics.timer("cv2_to_pil"):
+        rgb_frame = cv2.cvtColor(cv2_frame, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(rgb_frame)
+
+def compute_dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Compute a difference hash of the image, similar frames get hashes with a small Hamming distance"""
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
 
 def get_video_name(video_path: str) -> str:
     """Extract video name without extension from path"""
     return os.path.splitext(os.path.basename(video_path))[0]
 
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+def list_videos(video_dir: str) -> List[str]:
+    """Paths of the video files in a directory"""
+    return [
+        os.path.join(video_dir, filename)
+        for filename in sorted(os.listdir(video_dir))
+        if filename.lower().endswith(VIDEO_EXTENSIONS)
+    ]
+
 def create_directory(dir_path: str) -> None:
     """Create directory if it doesn't exist"""
     os.makedirs(dir_path, exist_ok=True)
 
+def probe_video(video_path: str) -> Dict:
+    """Read width, height and frame rate of the first video stream with ffprobe"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,r_frame_rate:format=duration',
+        '-of', 'json',
+        video_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr}")
+
+    info = json.loads(result.stdout)
+    stream = info["streams"][0]
+    num, den = stream.get("r_frame_rate", "0/1").split('/')
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "fps": float(num) / float(den) if float(den) else 0.0,
+        "duration": float(info.get("format", {}).get("duration", 0) or 0)
+    }
+
 def convert_to_absolute_coords(obj: Dict, image_width: int, image_height: int) -> Dict[str, int]:
     """Convert relative coordinates to absolute pixels"""
     x_min = int(obj["x_min"] * image_width)
@@ -31,35 +92,58 @@ def convert_to_absolute_coords(obj: Dict, image_width: int, image_height: int) -
         "y_max": y_max
     }
 
-def draw_boxes(image: Image.Image, detection_results: list) -> Image.Image:
+def draw_boxes(image: Image.Image, detection_results: list, in_place: bool = False) -> Image.Image:
+    """Draw detection boxes, on a copy unless the caller owns the image and passes in_place=True"""
     if not detection_results:
         return image
         
-    image_with_boxes = image.copy()
-    draw = ImageDraw.Draw(image_with_boxes)
-    image_width, image_height = image.size
-    
-    for obj in detection_results:
-        if not all(key in obj for key in ("x_min", "y_min", "x_max", "y_max")):
-            continue
-            
-        coords = convert_to_absolute_coords(obj, image_width, image_height)
-        draw.rectangle(
-            [(coords["x_min"], coords["y_min"]), (coords["x_max"], coords["y_max"])],
-            outline=BOX_COLOR,
-            width=BOX_WIDTH
-        )
+    with metrics.timer("draw_boxes"):
+        image_with_boxes = image if in_place else image.copy()
+        draw = ImageDraw.Draw(image_with_boxes)
+        image_width, image_height = image.size
+
+        for obj in detection_results:
+            if not all(key in obj for key in ("x_min", "y_min", "x_max", "y_max")):
+                continue
+
+            coords = convert_to_absolute_coords(obj, image_width, image_height)
+            draw.rectangle(
+                [(coords["x_min"], coords["y_min"]), (coords["x_max"], coords["y_max"])],
+                outline=BOX_COLOR,
+                width=BOX_WIDTH
+            )
     
     return image_with_boxes
 
-def save_frame(video_path: str, image: Image.Image, frame_num: int) -> str:
-    """Save a frame to disk with proper path handling"""
+FRAME_EXTENSIONS = {"png": "png", "jpeg": "jpg", "jpg": "jpg", "webp": "webp"}
+
+def save_frame(video_path: str, image: Image.Image, frame_num: int,
+               image_format: str = "png", quality: int = 90, compress_level: int = 6) -> str:
+    """Save a frame to disk with proper path handling
+
+    Args:
+        image_format: "png", "jpeg" or "webp"
+        quality: JPEG/WebP quality (1-100)
+        compress_level: PNG zlib level (0-9), lower is faster and larger
+    """
     video_name = get_video_name(video_path)
     save_dir = os.path.join(SAVE_DIR, video_name)
     create_directory(save_dir)
     
-    save_path = os.path.join(save_dir, f"{video_name}_{frame_num}.png")
-    image.save(save_path)
+    image_format = image_format.lower()
+    if image_format not in FRAME_EXTENSIONS:
+        raise ValueError(f"Unsupported frame format: {image_format}")
+
+    save_path = os.path.join(save_dir, f"{video_name}_{frame_num}.{FRAME_EXTENSIONS[image_format]}")
+    with metrics.timer("save_frame", video_name):
+        if image_format == "png":
+            image.save(save_path, format="PNG", compress_level=compress_level)
+        elif image_format == "webp":
+            image.save(save_path, format="WEBP", quality=quality)
+        else:
+            image.save(save_path, format="JPEG", quality=quality)
+    if metrics.is_enabled():
+        metrics.inc("frame_bytes", os.path.getsize(save_path), video_name)
     return save_path
 
 def create_coco_annotation_base() -> Dict:
@@ -75,18 +159,30 @@ def create_coco_annotation_base() -> Dict:
         },
         "images": [],
         "annotations": [],
-        "categories": [{"id": 1, "name": DETECTION_OBJECT, "supercategory": "object"}]
+        "categories": [
+            {"id": category_id, "name": name, "supercategory": "object"}
+            for category_id, name in enumerate(DETECTION_OBJECTS, start=1)
+        ]
     }
 
-def create_image_info(frame_num: int, image: Image.Image) -> Dict:
-    """Create COCO format image info"""
-    width, height = image.size
-    return {
+def create_image_info(frame_num: int, image: Image.Image, source_size: Optional[Tuple[int, int]] = None,
+                      video_name: Optional[str] = None) -> Dict:
+    """Create COCO format image info, with the source size if the image was downscaled
+
+    The video name and frame number are recorded as well, so images can still
+    be traced back to their video once annotations of several videos are merged.
+    """
+    width, height = source_size or image.size
+    image_info = {
         "id": frame_num,
         "file_name": f"{frame_num:06d}.png",
         "width": width,
-        "height": height
+        "height": height,
+        "frame_num": frame_num
     }
+    if video_name is not None:
+        image_info["video"] = video_name
+    return image_info
 
 def create_annotation(annotation_id: int, frame_num: int, obj: Dict, image_width: int, image_height: int) -> Dict:
     """Create COCO format annotation for a detection result"""
@@ -94,14 +190,17 @@ def create_annotation(annotation_id: int, frame_num: int, obj: Dict, image_width
     width = coords["x_max"] - coords["x_min"]
     height = coords["y_max"] - coords["y_min"]
     
-    return {
+    annotation = {
         "id": annotation_id,
         "image_id": frame_num,
-        "category_id": 1,
+        "category_id": obj.get("category_id", 1),
         "bbox": [coords["x_min"], coords["y_min"], width, height],
         "area": width * height,
         "iscrowd": 0
     }
+    if "track_id" in obj:
+        annotation["track_id"] = obj["track_id"]
+    return annotation
 
 def save_coco_annotations(annotations: Dict, video_path: str) -> None:
     video_name = get_video_name(video_path)
@@ -109,6 +208,12 @@ def save_coco_annotations(annotations: Dict, video_path: str) -> None:
     create_directory(annotation_dir)
     
     annotation_path = os.path.join(annotation_dir, f'{video_name}_annotations.json')
-    with open(annotation_path, 'w', encoding='utf-8') as f:
-        json.dump(annotations, f, indent=2, ensure_ascii=False)
+    # Write to a temporary file first so an interrupted save never leaves a truncated JSON
+    temp_path = annotation_path + '.tmp'
+    with metrics.timer("save_coco", video_name):
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(annotations, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, annotation_path)
+    if metrics.is_enabled():
+        metrics.inc("checkpoint_bytes", os.path.getsize(annotation_path), video_name)
     print(f"Saved COCO format annotations to: {annotation_path}") 
\ No newline at end of file
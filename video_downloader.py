@@ -1,37 +1,224 @@
 import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Generator, Iterable, List, Optional
 from tqdm import tqdm
-import yt_dlp
-
-def download_video(url: str | list, output_path: str) -> None:
-
-    if url is None or url == "" or len(url) == 0:
-        return
-
-    if os.path.exists(output_path):
-        print(f"Video already exists at {output_path}")
-        return
-    
-    with tqdm(total=0, unit='B', unit_scale=True, desc="Downloading video") as pbar:
-        def progress_hook(d):
-            if d['status'] != 'downloading':
-                if d['status'] == 'finished':
-                    pbar.close()
-                    print("Download complete")
-                return
-
-            if d.get('total_bytes'):
-                pbar.total = d['total_bytes']
-            downloaded = d.get('downloaded_bytes', 0)
-            pbar.update(downloaded - pbar.n)
-
-        ydl_opts = {
-            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-            'outtmpl': os.path.join(os.path.dirname(output_path), '%(id)s.%(ext)s'),
-            'progress_hooks': [progress_hook],
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            if isinstance(url, str):
-                url = [url]
-            for video_url in url:
-                print(f"Downloading: {video_url}")
-                info_dict = ydl.extract_info(video_url, download=True)
\ No newline at end of file
+from config import DOWNLOAD_WORKERS, DOWNLOAD_MANIFEST
+from utils import list_videos
+
+
+class YtDlpFetcher:
+    """Download videos with yt-dlp"""
+
+    def video_id(self, url: str) -> str:
+        """Id of a YouTube URL without a network request, a hash of the URL for other sites"""
+        parsed = urlparse(url)
+        host = parsed.netloc.lower()
+        if host.endswith("youtu.be"):
+            return parsed.path.strip("/").split("/")[0]
+        if "youtube" in host:
+            query = parse_qs(parsed.query)
+            if "v" in query:
+                return query["v"][0]
+            parts = parsed.path.strip("/").split("/")
+            if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live"):
+                return parts[1]
+        return hashlib.sha1(url.encode()).hexdigest()[:16]
+
+    def fetch(self, url: str, output_dir: str) -> str:
+        """Download one video into output_dir and return the path of the finished file"""
+        import yt_dlp
+
+        with tqdm(total=0, unit='B', unit_scale=True, desc=f"Downloading {self.video_id(url)}", leave=False) as pbar:
+            def progress_hook(d):
+                if d['status'] != 'downloading':
+                    return
+                if d.get('total_bytes'):
+                    pbar.total = d['total_bytes']
+                downloaded = d.get('downloaded_bytes', 0)
+                pbar.update(downloaded - pbar.n)
+
+            ydl_opts = {
+                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+                'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
+                'progress_hooks': [progress_hook],
+                'quiet': True,
+                'noprogress': True,
+            }
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info_dict = ydl.extract_info(url, download=True)
+                # Merged formats end up in a different file than the template suggests
+                downloads = info_dict.get('requested_downloads') or []
+                if downloads and downloads[0].get('filepath'):
+                    return downloads[0]['filepath']
+                return ydl.prepare_filename(info_dict)
+
+
+class LocalFileFetcher:
+    """Offline stand-in for yt-dlp that "downloads" files from a local directory
+
+    A URL is a file name in `source_dir`, its id the name without extension.
+    `delay` simulates download time in seconds.
+    """
+
+    def __init__(self, source_dir: str, delay: float = 0.0):
+        self.source_dir = source_dir
+        self.delay = delay
+
+    def video_id(self, url: str) -> str:
+        return os.path.splitext(os.path.basename(url))[0]
+
+    def fetch(self, url: str, output_dir: str) -> str:
+        if self.delay:
+            time.sleep(self.delay)
+        source = os.path.join(self.source_dir, os.path.basename(url))
+        target = os.path.join(output_dir, os.path.basename(url))
+        shutil.copyfile(source, target)
+        return target
+
+
+class DownloadManifest:
+    """Video ids downloaded into a directory and their file names, stored as JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.videos = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.videos = json.load(f)
+            except Exception as e:
+                print(f"Error loading download manifest: {e}")
+
+    def completed_path(self, video_id: str, video_dir: str) -> Optional[str]:
+        """Path of a finished download that is still on disk"""
+        with self._lock:
+            entry = self.videos.get(video_id)
+        if entry is None:
+            return None
+        path = os.path.join(video_dir, entry["file"])
+        return path if os.path.exists(path) else None
+
+    def add(self, video_id: str, url: str, file_name: str) -> None:
+        with self._lock:
+            self.videos[video_id] = {"url": url, "file": file_name}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.videos, f, indent=2)
+            os.replace(temp_path, self.path)
+
+
+class VideoDownloader:
+    """Download videos concurrently and hand out each file as soon as it lands
+
+    Videos in the manifest whose file still exists are not downloaded again.
+    Files are fetched into a `.downloading` subdirectory and moved into the
+    video directory once complete, so a directory listing never picks up a
+    partial download.
+    """
+
+    def __init__(self, video_dir: str, fetcher=None, workers: int = DOWNLOAD_WORKERS,
+                 manifest_name: str = DOWNLOAD_MANIFEST):
+        self.video_dir = video_dir
+        self.fetcher = fetcher or YtDlpFetcher()
+        self.workers = max(1, workers)
+        self.manifest = DownloadManifest(os.path.join(video_dir, manifest_name))
+        self.temp_dir = os.path.join(video_dir, '.downloading')
+        self._executor = None
+        self._futures = []
+        self._ready = []
+
+    def _download(self, url: str, video_id: str) -> str:
+        print(f"Downloading: {url}")
+        temp_dir = os.path.join(self.temp_dir, video_id)
+        os.makedirs(temp_dir, exist_ok=True)
+        try:
+            temp_path = self.fetcher.fetch(url, temp_dir)
+            path = os.path.join(self.video_dir, os.path.basename(temp_path))
+            os.replace(temp_path, path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.manifest.add(video_id, url, os.path.basename(path))
+        print(f"Download complete: {path}")
+        return path
+
+    def start(self, urls: Iterable[str]) -> None:
+        """Skip finished videos and start downloading the others in the background"""
+        os.makedirs(self.video_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        seen = set()
+        for url in urls:
+            video_id = self.fetcher.video_id(url)
+            if video_id in seen:
+                continue
+            seen.add(video_id)
+            path = self.manifest.completed_path(video_id, self.video_dir)
+            if path is not None:
+                print(f"Video already downloaded: {path}")
+                self._ready.append(path)
+            else:
+                self._futures.append(self._executor.submit(self._download, url, video_id))
+
+    def completed(self) -> Generator[str, None, None]:
+        """Paths of downloaded videos in the order they finish, skipped ones first"""
+        yield from self._ready
+        for future in as_completed(self._futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"Error downloading video: {e}")
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        try:
+            os.rmdir(self.temp_dir)
+        except OSError:
+            pass
+
+
+def normalize_urls(url) -> List[str]:
+    if not url:
+        return []
+    return [url] if isinstance(url, str) else list(url)
+
+
+def iter_videos(urls, video_dir: str, fetcher=None) -> Generator[str, None, None]:
+    """Videos already in video_dir first, then downloads as they complete
+
+    Downloads start with the first video requested, so they run while the
+    local videos are processed.
+    """
+    downloader = VideoDownloader(video_dir, fetcher)
+    downloader.start(normalize_urls(urls))
+    yielded = set()
+    for path in list_videos(video_dir) if os.path.isdir(video_dir) else []:
+        yielded.add(os.path.abspath(path))
+        yield path
+    for path in downloader.completed():
+        if os.path.abspath(path) not in yielded:
+            yielded.add(os.path.abspath(path))
+            yield path
+
+
+def download_video(url: str | list, output_path: str) -> List[str]:
+    """Download all videos and wait for them to finish
+
+    Returns:
+        Paths of the downloaded or already present videos
+    """
+    urls = normalize_urls(url)
+    if not urls:
+        return []
+    video_dir = os.path.dirname(output_path) if os.path.dirname(output_path) else "."
+    downloader = VideoDownloader(video_dir)
+    downloader.start(urls)
+    return list(downloader.completed())
@@ -1,68 +1,92 @@
 import cv2
+import numpy as np
 from tqdm import tqdm
-from typing import Generator, Tuple, List, Dict
+from typing import Generator, Iterable, Optional, Tuple, List, Dict
 import subprocess
+import threading
+import queue
+import re
 import os
 import json
+import shutil
 from config import *
 from utils import *
+from annotation_journal import AnnotationJournal
+from progress_store import ProgressStore
+from frame_writer import FrameWriter
+from frame_prep import FramePreparer
+from tracker import BoxTracker
+from extraction_manifest import ExtractionManifest
+from scene_index import SceneIndex
+from segments import find_iframe_times, plan_segments
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class VideoProcessor:
-    def __init__(self, video_path: str):
+    def __init__(self, video_path: str, frame_writer: Optional[FrameWriter] = None,
+                 frame_range: Optional[Tuple[int, Optional[int]]] = None, journal_part: Optional[str] = None):
+        """
+        Args:
+            frame_range: Only process keyframes in [start, end), end None for the end of the video
+            journal_part: Record annotations in a part journal of the video, see AnnotationJournal
+        """
         self.video_path = video_path
+        self.video_name = get_video_name(video_path)
         self.cap = None
         self.total_frames = 0
+        self.frame_range = frame_range
         self.keyframes_dir = os.path.join('keyframes', get_video_name(video_path))
+        self.journal = AnnotationJournal(video_path, part=journal_part)
         self.annotations = self._load_or_create_annotations()
         self.annotation_id = self._get_next_annotation_id()
-        self.processed_frames = self._load_progress()
+        self.progress = ProgressStore()
+        # Frames replayed from the journal are done, even if the run stopped before their progress checkpoint
+        self._pending_frames = {image["id"] for image in self.annotations["images"]}
+        self._pending_frames.difference_update(self.progress.done_frames(self.video_name))
         self.frames_since_last_save = 0  # 添加計數器追蹤自上次保存後處理的幀數
+        self.recent_signatures = []  # (dhash, detections) of recently inferred frames
+        self.model_calls = 0
+        self.model_calls_saved = 0
+        # Rendered frames are saved in the background, by a shared writer if one is given
+        self.frame_writer = frame_writer
+        self._owns_frame_writer = False
+        self._preparer = None
+
+    @property
+    def preparer(self) -> FramePreparer:
+        """Frame preparation for this video, created from its probed size on first use"""
+        if self._preparer is None:
+            info = probe_video(self.video_path)
+            self._preparer = FramePreparer(info["width"], info["height"])
+        return self._preparer
+
+    @preparer.setter
+    def preparer(self, preparer: FramePreparer) -> None:
+        self._preparer = preparer
         
-    def _load_progress(self) -> set:
-        """Load processing progress from progress file"""
-        progress_file = 'progress.json'
-        video_name = get_video_name(self.video_path)
-        if os.path.exists(progress_file):
-            try:
-                with open(progress_file, 'r') as f:
-                    progress = json.load(f)
-                    return set(progress.get(video_name, []))
-            except Exception as e:
-                print(f"Error loading progress: {e}")
-        return set()
-        
+    def in_range(self, frame_num: int) -> bool:
+        if self.frame_range is None:
+            return True
+        start, end = self.frame_range
+        return frame_num >= start and (end is None or frame_num < end)
+
+    def is_frame_done(self, frame_num: int) -> bool:
+        """Check whether a frame was already processed, by this or any other worker"""
+        return frame_num in self._pending_frames or self.progress.is_done(self.video_name, frame_num)
+
+    def mark_frame_done(self, frame_num: int) -> None:
+        """Mark a frame processed, recorded in the progress store at the next checkpoint"""
+        self._pending_frames.add(frame_num)
+
     def _save_progress(self):
-        """Save processing progress to file"""
-        progress_file = 'progress.json'
-        video_name = get_video_name(self.video_path)
-        
-        # Load existing progress
-        if os.path.exists(progress_file):
-            try:
-                with open(progress_file, 'r') as f:
-                    progress = json.load(f)
-            except:
-                progress = {}
-        else:
-            progress = {}
-            
-        # Update progress for current video
-        progress[video_name] = list(self.processed_frames)
-        
-        # Save updated progress
-        with open(progress_file, 'w') as f:
-            json.dump(progress, f)
+        """Record frames processed since the last checkpoint in the progress store"""
+        # Called after the journal is synced, so a frame is never marked done before its annotations are durable
+        pending = list(self._pending_frames)
+        self.progress.mark_many(self.video_name, pending)
+        self._pending_frames.difference_update(pending)
             
     def _load_or_create_annotations(self) -> Dict:
-        """Load existing annotations or create new ones"""
-        annotation_file = os.path.join('annotations', f"{get_video_name(self.video_path)}_annotations.json")
-        if os.path.exists(annotation_file):
-            try:
-                with open(annotation_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading annotations: {e}")
-        return create_coco_annotation_base()
+        """Replay the annotation journal, or create new annotations"""
+        return self.journal.load()
         
     def _get_next_annotation_id(self) -> int:
         """Get the next available annotation ID"""
@@ -70,46 +94,220 @@ class VideoProcessor:
             return 1
         return max(ann["id"] for ann in self.annotations["annotations"]) + 1
         
-    def extract_keyframes(self) -> bool:
+    def _keyframe_path(self, frame_num: int) -> str:
+        return os.path.join(self.keyframes_dir, f"{get_video_name(self.video_path)}_{frame_num}.jpg")
+
+    def _keyframe_numbers(self) -> List[int]:
+        if not os.path.exists(self.keyframes_dir):
+            return []
+        return [int(f.split('.')[0].split('_')[-1]) for f in os.listdir(self.keyframes_dir) if f.endswith('.jpg')]
+
+    def _last_complete_keyframe(self) -> Optional[int]:
+        """Frame number of the newest fully written keyframe, truncated files are removed"""
+        for frame_num in sorted(self._keyframe_numbers(), reverse=True):
+            path = self._keyframe_path(frame_num)
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() >= 2:
+                    f.seek(-2, os.SEEK_END)
+                    if f.read(2) == b'\xff\xd9':  # JPEG end of image marker
+                        return frame_num
+            os.remove(path)
+        return None
+
+    def has_cached_keyframes(self) -> bool:
+        """Check whether a finished extraction of this exact video and threshold is on disk"""
+        manifest = ExtractionManifest(self.keyframes_dir, self.video_path)
+        return manifest.complete and manifest.matches(SCENE_THRESHOLD) and self._archive_at_source_size(manifest)
+
+    def _archive_at_source_size(self, manifest: ExtractionManifest) -> bool:
+        """Check that archived keyframes have the source resolution, which their readers assume"""
+        source_size = list(self.preparer.source_size)
+        recorded = manifest.data.get("frame_size")
+        if recorded is not None:
+            return recorded == source_size
+        # Manifests written before the size was recorded, look at a keyframe
+        for frame_num in self._keyframe_numbers()[:1]:
+            with Image.open(self._keyframe_path(frame_num)) as image:
+                return list(image.size) == source_size
+        return True
+
+    def _extraction_command(self, scene_threshold: float, fps: float, start_frame: int = 0, skip: int = 0,
+                            end_frame: Optional[int] = None, threads: Optional[int] = None) -> List[str]:
+        """Build the FFmpeg command writing selected keyframes as JPEGs
+
+        Args:
+            start_frame: First frame to decode
+            skip: Number of decoded frames, from start_frame, that are not written
+            end_frame: Stop before this frame, None for the end of the video
+            threads: Decoder threads, FFmpeg default when None
+        """
+        outputName = os.path.join(self.keyframes_dir, f"{get_video_name(self.video_path)}_%d.jpg")
+        cmd = ['ffmpeg']
+        if threads:
+            cmd += ['-threads', str(threads)]
+        range_args, select = self._range_select(f"eq(pict_type,I) + gt(scene,{scene_threshold})",
+                                                fps, start_frame, skip, end_frame)
+
+        # Build FFmpeg command to extract keyframes using both I-frames and scene detection
+        return cmd + range_args + [
+            '-copyts', '-start_at_zero', '-i', f"{self.video_path}",
+            '-vf', f"select='{select}'",
+            '-vsync', '0',
+            '-frame_pts', '1',
+            '-q:v', '2',  # High quality JPEG
+            outputName
+        ]
+
+    @staticmethod
+    def _range_select(select: str, fps: float, start_frame: int = 0, skip: int = 0,
+                      end_frame: Optional[int] = None) -> Tuple[List[str], str]:
+        """FFmpeg input options and select expression that limit `select` to a frame range
+
+        The input must be opened with -copyts -start_at_zero, so timestamps and
+        frame numbers stay global and count from the start of the file, as they
+        do without a seek.
+        """
+        args = []
+        if start_frame > 0:
+            # Seek half a frame early
+            args += ['-ss', f"{(start_frame - 0.5) / fps:.6f}"]
+        if end_frame is not None:
+            # Read a little past the end, the exact cut is done by select
+            args += ['-t', f"{(end_frame - start_frame + 1) / fps + 1:.6f}"]
+            select = f"lt(t,{(end_frame - 0.5) / fps:.6f})*({select})"
+        if skip:
+            select = f"gte(n,{skip})*({select})"
+        return args, select
+
+    def _extract_segmented(self, scene_threshold: float, manifest: ExtractionManifest, info: Dict) -> bool:
+        """Extract keyframes of I-frame aligned segments with concurrent FFmpeg processes
+
+        Each segment also decodes the frame before its first I-frame without
+        writing it, so scene scores and `-frame_pts` numbers match a single
+        pass over the whole video. The plan and finished segments are kept in
+        the manifest, an interrupted run only redoes unfinished segments.
+        """
+        fps = info["fps"]
+        plan = manifest.data.get("segments")
+        if plan is None:
+            with metrics.timer("iframe_scan", self.video_name):
+                iframe_frames = [int(round(t * fps)) for t in find_iframe_times(self.video_path)]
+            total_frames = int(round(info["duration"] * fps))
+            min_frames = max(1, int(EXTRACT_SEGMENT_MIN_SECONDS * fps))
+            plan = [list(segment) for segment in plan_segments(iframe_frames, total_frames, EXTRACT_WORKERS * 2, min_frames)]
+            manifest.update(segments=plan, segments_done=[])
+
+        done = set(manifest.data.get("segments_done", []))
+        pending = [i for i in range(len(plan)) if i not in done]
+
+        # Output of segments that did not finish may be truncated, redo them from scratch
+        for frame_num in self._keyframe_numbers():
+            for i in pending:
+                start, end = plan[i]
+                if frame_num >= start and (end is None or frame_num < end):
+                    os.remove(self._keyframe_path(frame_num))
+                    break
+
+        print(f"Extracting {len(pending)} of {len(plan)} segments with {max(1, EXTRACT_WORKERS)} workers")
+        workers = max(1, EXTRACT_WORKERS)
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        failed = False
+        with metrics.timer("ffmpeg_extract", self.video_name), ThreadPoolExecutor(workers) as pool:
+            futures = {}
+            for i in pending:
+                start, end = plan[i]
+                start_frame = max(0, start - 1)
+                cmd = self._extraction_command(scene_threshold, fps, start_frame, start - start_frame, end, threads)
+                futures[pool.submit(subprocess.run, cmd, capture_output=True, text=True)] = i
+
+            for future in as_completed(futures):
+                i = futures[future]
+                result = future.result()
+                if result.returncode != 0:
+                    print(f"FFmpeg keyframe extraction failed for segment {plan[i]}: {result.stderr}")
+                    failed = True
+                    continue
+                done.add(i)
+                manifest.update(segments_done=sorted(done))
+
+        return not failed
+
+    def extract_keyframes(self, scene_threshold: Optional[float] = None) -> bool:
         """Extract keyframes from video using FFmpeg with scene detection
+
+        Extraction is skipped when keyframes/<video>/manifest.json shows a
+        finished extraction of the same video content and threshold, and an
+        interrupted extraction resumes after its last complete keyframe.
         
         Args:
             scene_threshold (float): Threshold for scene change detection (0.0 to 1.0).
-                                   Lower values extract more frames. Default: 0.3
+                                   Lower values extract more frames. Default: SCENE_THRESHOLD
                                    
         """
-        outputName = os.path.join(self.keyframes_dir, f"{get_video_name(self.video_path)}_%d.jpg")
+        if scene_threshold is None:
+            scene_threshold = SCENE_THRESHOLD
+        requested_threshold = scene_threshold
+
         try:
             # Create directory for saving keyframes
             create_directory(self.keyframes_dir)
-            
-            # Build FFmpeg command to extract keyframes using both I-frames and scene detection
-            cmd = [
-
-                'ffmpeg', '-i', f"{self.video_path}",
-                '-vf', f"select='eq(pict_type,I) + gt(scene,{SCENE_THRESHOLD})'",
-                '-vsync', '0',
-                '-frame_pts', '1',
-                '-q:v', '2',  # High quality JPEG
-                outputName
-                # f"{os.path.join(self.keyframes_dir, '%d.jpg')}"
-
-            ]
-            
-            # Execute FFmpeg command
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                print(f"FFmpeg keyframe extraction failed: {result.stderr}")
-                return False
+
+            manifest = ExtractionManifest(self.keyframes_dir, self.video_path)
+            resume_from = None
+            if manifest.matches(scene_threshold) and self._archive_at_source_size(manifest):
+                if manifest.complete:
+                    print(f"Keyframes are up to date, skipping extraction: {self.keyframes_dir}")
+                    return True
+                # Resume at the threshold the interrupted extraction used, lower after a retry
+                scene_threshold = manifest.data["scene_threshold"]
+                resume_from = self._last_complete_keyframe()
+            else:
+                # Keyframes of another version of the video, another threshold or a reduced size
+                for frame_num in self._keyframe_numbers():
+                    os.remove(self._keyframe_path(frame_num))
+                manifest.start(scene_threshold, self.preparer.source_size)
+
+            info = probe_video(self.video_path)
+            # An unfinished segmented extraction is always finished segment by segment
+            segmented = manifest.data.get("segments") is not None
+            if segmented or (EXTRACT_WORKERS > 1 and info["duration"] >= 2 * EXTRACT_SEGMENT_MIN_SECONDS):
+                if not self._extract_segmented(scene_threshold, manifest, info):
+                    return False
+            else:
+                start_frame, skip = 0, 0
+                if resume_from is not None:
+                    # Decode the last finished keyframe and the frame before it again, so scene scores of
+                    # the following frames match an uninterrupted run, but do not write them again
+                    start_frame = max(0, resume_from - 1)
+                    skip = resume_from - start_frame + 1
+                    print(f"Resuming keyframe extraction after frame {resume_from}")
+
+                cmd = self._extraction_command(scene_threshold, info["fps"], start_frame, skip)
+
+                # Execute FFmpeg command
+                with metrics.timer("ffmpeg_extract", self.video_name):
+                    result = subprocess.run(cmd, capture_output=True, text=True)
+
+                if result.returncode != 0:
+                    print(f"FFmpeg keyframe extraction failed: {result.stderr}")
+                    return False
                 
             # Check if any frames were extracted
             keyframes = [f for f in os.listdir(self.keyframes_dir) if f.endswith('.jpg')]
             if not keyframes:
+                lower_threshold = max(0.1, scene_threshold - 0.1)
+                if lower_threshold >= scene_threshold:
+                    print("No keyframes were extracted.")
+                    return False
                 print("No keyframes were extracted. Trying with lower scene threshold...")
-                # Retry with lower threshold if no frames were extracted
-                return self.extract_keyframes(scene_threshold=max(0.1, SCENE_THRESHOLD - 0.1))
+                # Retry with lower threshold if no frames were extracted, the manifest keeps the requested
+                # threshold so the next run finds the retried keyframes up to date
+                manifest.start(lower_threshold, self.preparer.source_size, requested_threshold)
+                return self.extract_keyframes(scene_threshold=requested_threshold)
                 
+            manifest.finish(len(keyframes))
+            metrics.inc("frames_extracted", len(keyframes), self.video_name)
             print(f"Successfully extracted {len(keyframes)} keyframes to: {self.keyframes_dir}")
             return True
             
@@ -117,31 +315,355 @@ class VideoProcessor:
             print(f"Error occurred while extracting keyframes: {str(e)}")
             return False
             
-    def process_keyframes(self, model_handler) -> None:
-        """Process extracted keyframes"""
+    def stream_keyframes(self, save_keyframes: bool = True) -> Generator[Tuple[int, Image.Image], None, None]:
+        """Stream selected keyframes from FFmpeg without touching disk
+
+        FFmpeg scales the selected frames to the inference resolution and writes
+        them as raw RGB to stdout, which is read into one reused buffer. Frames
+        that are archived come at the source resolution and are reduced here. The
+        showinfo filter reports the timestamp of every selected frame on stderr.
+        The timestamp is converted to the same frame number that
+        `-frame_pts 1` puts in the JPEG names. With a frame range only that
+        range is decoded, plus the frame before it for matching scene scores.
+
+        Args:
+            save_keyframes: False never archives keyframes, for passes at a reduced size
+
+        Yields:
+            (frame_num, image) pairs in presentation order
+        """
+        info = probe_video(self.video_path)
+        fps = info["fps"]
+        if self._preparer is None:
+            self._preparer = FramePreparer(info["width"], info["height"])
+        preparer = self._preparer
+
+        save_keyframes = save_keyframes and SAVE_KEYFRAMES
+        manifest = None
+        if save_keyframes:
+            create_directory(self.keyframes_dir)
+            # A range only archives part of the keyframes, which is never a finished extraction
+            if self.frame_range is None:
+                manifest = ExtractionManifest(self.keyframes_dir, self.video_path)
+                if not (manifest.matches(SCENE_THRESHOLD) and manifest.data.get("scene_threshold") == SCENE_THRESHOLD
+                        and self._archive_at_source_size(manifest)):
+                    # Keyframes of another version of the video, another threshold or a reduced size
+                    for frame_num in self._keyframe_numbers():
+                        os.remove(self._keyframe_path(frame_num))
+                manifest.start(SCENE_THRESHOLD, preparer.source_size)
+        # The archive is kept at the source resolution, so FFmpeg does not scale and frames are reduced here
+        reduce_here = save_keyframes and preparer.scaled
+        stream_preparer = FramePreparer(*preparer.source_size, None) if reduce_here else preparer
+        frame_size = stream_preparer.frame_bytes
+        buffer = bytearray(frame_size)
+        view = memoryview(buffer)
+        frame_count = 0
+
+        select = f"eq(pict_type,I) + gt(scene,{SCENE_THRESHOLD})"
+        input_args = []
+        if self.frame_range is not None:
+            start, end = self.frame_range
+            start_frame = max(0, start - 1)
+            input_args, select = self._range_select(select, fps, start_frame, start - start_frame, end)
+            input_args += ['-copyts', '-start_at_zero']
+
+        cmd = [
+            'ffmpeg', '-nostats', *input_args, '-i', f"{self.video_path}",
+            '-vf', f"select='{select}',showinfo=checksum=0{stream_preparer.scale_filter()}",
+            '-vsync', '0',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            'pipe:1'
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # showinfo lines arrive on stderr, read them on a side thread so neither pipe blocks
+        timestamps = queue.Queue()
+        stderr_tail = []
+
+        def read_stderr():
+            pattern = re.compile(rb'pts_time:\s*(-?[\d.]+)')
+            for line in process.stderr:
+                if b'Parsed_showinfo' in line:
+                    match = pattern.search(line)
+                    if match:
+                        timestamps.put(float(match.group(1)))
+                        continue
+                stderr_tail.append(line)
+                del stderr_tail[:-20]
+            timestamps.put(None)
+
+        reader = threading.Thread(target=read_stderr, daemon=True)
+        reader.start()
+
+        try:
+            while True:
+                with metrics.timer("ffmpeg_read", self.video_name):
+                    received = 0
+                    while received < frame_size:
+                        count = process.stdout.readinto(view[received:])
+                        if not count:
+                            break
+                        received += count
+                    pts_time = timestamps.get() if received == frame_size else None
+                if pts_time is None:
+                    break
+                metrics.inc("frames_extracted", 1, self.video_name)
+                frame_num = int(round(pts_time * fps))
+
+                bgr = None
+                if save_keyframes:
+                    frame = np.frombuffer(buffer, dtype=np.uint8).reshape(stream_preparer.size[1], stream_preparer.size[0], 3)
+                    bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                    cv2.imwrite(self._keyframe_path(frame_num), bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+                frame_count += 1
+                with metrics.timer("prepare_frame", self.video_name):
+                    image = preparer.from_bgr(bgr) if reduce_here else preparer.from_rgb_bytes(buffer)
+                yield frame_num, image
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            reader.join(timeout=5)
+
+        if process.returncode != 0:
+            print(f"FFmpeg keyframe streaming failed: {b''.join(stderr_tail).decode(errors='replace')}")
+        elif manifest is not None:
+            # Every keyframe was archived, later runs can read them instead of decoding the video
+            manifest.finish(frame_count)
+
+    def read_keyframe_files(self, skip_done: bool = True) -> Generator[Tuple[int, Image.Image], None, None]:
+        """Read keyframes previously written by `extract_keyframes`, decoded reduced where JPEG allows"""
         if not os.path.exists(self.keyframes_dir):
             print("Keyframes directory does not exist")
             return
-            
+
         keyframes = [f for f in os.listdir(self.keyframes_dir) if f.endswith('.jpg')]
-        
-        for keyframe in tqdm(keyframes, desc="Processing keyframes"):
-            frame_path = os.path.join(self.keyframes_dir, keyframe)
+        for keyframe in keyframes:
             frame_num = int(keyframe.split('.')[0].split('_')[-1])
-            
-            # Skip if frame was already processed
-            if frame_num in self.processed_frames:
+            if not self.in_range(frame_num):
                 continue
-                
-            frame = cv2.imread(frame_path)
+
+            # Skip decoding frames that were already processed
+            if skip_done and self.is_frame_done(frame_num):
+                metrics.inc("frames_skipped_progress", 1, self.video_name)
+                continue
+
+            with metrics.timer("imread", self.video_name):
+                frame = cv2.imread(os.path.join(self.keyframes_dir, keyframe), self.preparer.imread_flag())
             if frame is not None:
-                self.process_frame(frame_num, frame, model_handler)
-                self.processed_frames.add(frame_num)
-        
+                with metrics.timer("prepare_frame", self.video_name):
+                    image = self.preparer.from_bgr(frame)
+                yield frame_num, image
+
+    def read_indexed_keyframes(self, frame_nums: List[int], skip_done: bool = True) -> Generator[Tuple[int, Image.Image], None, None]:
+        """Decode selected frames by seeking, short gaps are read through instead
+
+        Frame numbers are PTS based, which equals the decode index for constant
+        frame rate videos. With `skip_done` frames already processed are skipped.
+        """
+        cap = cv2.VideoCapture(self.video_path)
+        if not cap.isOpened():
+            print(f"Cannot open video file: {self.video_path}")
+            return
+
+        position = 0
+        try:
+            for frame_num in sorted(frame_nums):
+                if skip_done and self.is_frame_done(frame_num):
+                    metrics.inc("frames_skipped_progress", 1, self.video_name)
+                    continue
+
+                with metrics.timer("seek_read", self.video_name):
+                    # Seeking restarts decoding at the previous I-frame, grabbing is cheaper for short gaps
+                    if frame_num < position or frame_num - position > SEEK_READ_GAP:
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                        position = frame_num
+                    while position < frame_num and cap.grab():
+                        position += 1
+                    ret, frame = cap.read()
+                    position += 1
+                if not ret:
+                    continue
+                metrics.inc("frames_extracted", 1, self.video_name)
+                with metrics.timer("prepare_frame", self.video_name):
+                    image = self.preparer.from_bgr(frame)
+                yield frame_num, image
+        finally:
+            cap.release()
+
+    def iter_keyframes(self, skip_done: bool = True, save_keyframes: bool = True) -> Generator[Tuple[int, Image.Image], None, None]:
+        """Yield keyframes from the configured source, preferring a finished extraction on disk
+
+        Keyframes come out as RGB images at the inference resolution, ready for the model.
+        A frame range is always streamed unless the keyframes are on disk, since
+        extracting all keyframes is not a job for one range. With `skip_done`
+        processed frames are skipped where that saves decoding.
+        """
+        if USE_SCENE_INDEX:
+            index = SceneIndex.load_or_build(self.video_path)
+            frame_nums = [frame_num for frame_num in index.select(SCENE_THRESHOLD, KEYFRAMES_PER_MINUTE)
+                          if self.in_range(frame_num)]
+            return self.read_indexed_keyframes(frame_nums, skip_done)
+        if (STREAM_KEYFRAMES or self.frame_range is not None) and not self.has_cached_keyframes():
+            return self.stream_keyframes(save_keyframes)
+        return self.read_keyframe_files(skip_done)
+
+    def read_selected_keyframes(self, frame_nums: List[int]) -> Generator[Tuple[int, Image.Image], None, None]:
+        """Selected keyframes, read from the archive on disk where present and decoded by seeking otherwise"""
+        missing = []
+        for frame_num in sorted(frame_nums):
+            path = self._keyframe_path(frame_num)
+            if not os.path.exists(path):
+                missing.append(frame_num)
+                continue
+            with metrics.timer("imread", self.video_name):
+                frame = cv2.imread(path, self.preparer.imread_flag())
+            if frame is None:
+                missing.append(frame_num)
+                continue
+            with metrics.timer("prepare_frame", self.video_name):
+                image = self.preparer.from_bgr(frame)
+            yield frame_num, image
+        if missing:
+            yield from self.read_indexed_keyframes(missing, skip_done=False)
+
+    def process_keyframes(self, model_handler, keyframes: Optional[Iterable[Tuple[int, Image.Image]]] = None) -> None:
+        """Process keyframes
+
+        Args:
+            model_handler: Model used for detection
+            keyframes: Iterable of (frame_num, image) pairs. Defaults to `iter_keyframes()`
+        """
+        if keyframes is None:
+            keyframes = self.iter_keyframes()
+
+        batch = []
+        for frame_num, image in tqdm(keyframes, desc="Processing keyframes"):
+            # Skip if frame was already processed
+            if self.is_frame_done(frame_num):
+                metrics.inc("frames_skipped_progress", 1, self.video_name)
+                continue
+
+            batch.append((frame_num, image))
+            if len(batch) == BATCH_SIZE:
+                self.process_batch(batch, model_handler)
+                batch = []
+
+        # Dispatch the last partial batch
+        if batch:
+            self.process_batch(batch, model_handler)
+
+        self.finalize()
+
+    def render_from_cache(self, cache_handler) -> bool:
+        """Rebuild the annotations and rendered frames of all keyframes from cached detections
+
+        Keyframes are read the same way as when labeling, so their pixels hash
+        to the cached entries. The new annotations go to a staged journal that
+        replaces the current one at the end. Frames that had annotations but
+        got none from the cache keep their previous annotations, and when fewer
+        than RENDER_MIN_HIT_RATE of the keyframes hit, the annotations are left
+        as they were. Progress is left alone.
+
+        Returns:
+            Whether the annotations were replaced
+        """
+        previous = self.annotations
+        journal = self.journal
+        self.journal = journal.staged()
+        self.annotations = create_coco_annotation_base()
+        self.annotation_id = 1
+        frames_before, missed_before = cache_handler.frames, cache_handler.missed_frames
+
+        batch = []
+        for frame_num, image in tqdm(self.iter_keyframes(skip_done=False), desc="Rendering keyframes"):
+            batch.append((frame_num, image))
+            if len(batch) == BATCH_SIZE:
+                self._render_batch(batch, cache_handler)
+                batch = []
+        if batch:
+            self._render_batch(batch, cache_handler)
+
+        looked_up = cache_handler.frames - frames_before
+        hits = looked_up - (cache_handler.missed_frames - missed_before)
+        hit_rate = hits / looked_up if looked_up else 1.0
+        if previous["images"] and hit_rate < RENDER_MIN_HIT_RATE:
+            print(f"Only {hits} of {looked_up} keyframes of {self.video_name} hit the cache ({hit_rate:.1%}), "
+                  f"keeping its annotations")
+            self.journal.discard()
+            self.journal = journal
+            self.annotations = previous
+            self.finalize()
+            return False
+
+        rendered = {image["id"] for image in self.annotations["images"]}
+        kept = self._keep_missed_annotations(previous)
+        if kept:
+            print(f"Kept the previous annotations of {kept} frames missing from the cache")
+        journal.replace_with(self.journal)
+        self.journal = journal
+        if SAVE_FRAME:
+            self._prune_rendered_frames(rendered)
+        self.finalize()
+        return True
+
+    def _keep_missed_annotations(self, previous: Dict) -> int:
+        """Copy annotated frames of `previous` that the render left without annotations"""
+        rendered = {image["id"] for image in self.annotations["images"]}
+        missed = {image["id"] for image in previous["images"] if image["id"] not in rendered}
+        for image_info in previous["images"]:
+            if image_info["id"] in missed:
+                self.annotations["images"].append(image_info)
+                self.journal.append_image(image_info)
+        for annotation in previous["annotations"]:
+            if annotation["image_id"] in missed:
+                annotation = dict(annotation, id=self.annotation_id)
+                self.annotations["annotations"].append(annotation)
+                self.journal.append_annotation(annotation)
+                self.annotation_id += 1
+        return len(missed)
+
+    def _prune_rendered_frames(self, rendered: set) -> None:
+        """Remove rendered frames that are no longer annotated, or were rendered again in another format"""
+        save_dir = os.path.join(SAVE_DIR, self.video_name)
+        if not os.path.isdir(save_dir):
+            return
+        annotated = {image["id"] for image in self.annotations["images"]}
+        extension = FRAME_EXTENSIONS[FRAME_FORMAT.lower()]
+        for name in os.listdir(save_dir):
+            stem, _, ext = name.rpartition('.')
+            try:
+                frame_num = int(stem.split('_')[-1])
+            except ValueError:
+                continue
+            if frame_num not in annotated or (ext != extension and frame_num in rendered):
+                os.remove(os.path.join(save_dir, name))
+
+    def _render_batch(self, batch: List[Tuple[int, Image.Image]], cache_handler) -> None:
+        pil_images = [image for _, image in batch]
+        for (frame_num, _), pil_image, detection_results in zip(batch, pil_images, self.detect_frames(pil_images, cache_handler)):
+            self.record_detections(frame_num, pil_image, detection_results)
+
+    def finalize(self) -> None:
+        """Compact the journal into the COCO file once the video is done"""
         # 確保最後的幀都被保存
-        if self.frames_since_last_save > 0:
-            self.save_coco_annotations()
-            self.frames_since_last_save = 0
+        self.save_coco_annotations()
+        if self.model_calls_saved:
+            total = self.model_calls + self.model_calls_saved
+            print(f"Saved {self.model_calls_saved} of {total} model calls by reusing detections of near-duplicate keyframes")
+        self.frames_since_last_save = 0
+        self.close()
+
+    def close(self) -> None:
+        """Close the journal, the progress store connection and an owned frame writer"""
+        self.journal.close()
+        self.progress.close()
+        if self._owns_frame_writer:
+            self.frame_writer.close()
+            self.frame_writer = None
+            self._owns_frame_writer = False
         
     def open_video(self) -> bool:
 
@@ -175,23 +697,140 @@ class VideoProcessor:
                         yield frame_counter, frame_batch
                     break
                     
-                frame_counter += 1
+                # Frame numbers start at 0 like the PTS based keyframe numbers
                 frame_batch.append((frame_counter, frame))
+                frame_counter += 1
                 pbar.update(1)
                 
                 if len(frame_batch) == BATCH_SIZE:
                     yield frame_counter, frame_batch
                     frame_batch = []
                     
-    def process_frame(self, frame_num: int, frame, model_handler) -> None:
-        pil_image = cv2_to_pil(frame)
-        detection_results = model_handler.detect_objects(pil_image, DETECTION_OBJECT)
-        
+    def process_dense(self, model_handler, detect_every: int = DENSE_DETECT_EVERY) -> None:
+        """Label every frame, running the detector on every Nth frame and tracking in between
+
+        Boxes are carried to the frames between detections by `BoxTracker`.
+        A frame is detected early when tracking confidence drops below
+        TRACK_MIN_CONFIDENCE. Annotations carry the track id of each box.
+        Detections always call the model, near-duplicate reuse would hand the
+        tracker the stale boxes it is being corrected from.
+        """
+        if not self.open_video():
+            return
+
+        tracker = BoxTracker()
+        frames_since_detect = detect_every
+        labeled_frames = 0
+        try:
+            for _, frame_batch in self.read_frames():
+                for frame_num, frame in frame_batch:
+                    if self.is_frame_done(frame_num):
+                        metrics.inc("frames_skipped_progress", 1, self.video_name)
+                        tracker.reset()
+                        continue
+
+                    with metrics.timer("track", self.video_name):
+                        gray = tracker.prepare(frame)
+                        objects, confidence = (None, 0.0) if frames_since_detect >= detect_every else tracker.update(gray)
+
+                    pil_image = None
+                    if objects is None or confidence < TRACK_MIN_CONFIDENCE:
+                        pil_image = self.preparer.from_bgr(frame)
+                        metrics.inc("frames_inferred", 1, self.video_name)
+                        detections = model_handler.detect_batch([pil_image], DETECTION_OBJECTS)[0]
+                        self.model_calls += 1
+                        objects = tracker.update_from_detections(gray, detections)
+                        frames_since_detect = 0
+                    else:
+                        metrics.inc("frames_tracked", 1, self.video_name)
+                    frames_since_detect += 1
+
+                    if objects:
+                        self.record_detections(frame_num, pil_image or self.preparer.from_bgr(frame), objects)
+                        labeled_frames += 1
+                    self.mark_frame_done(frame_num)
+        finally:
+            self.close_video()
+
+        print(f"Dense labeling: {labeled_frames} frames labeled with {self.model_calls} model calls")
+        self.finalize()
+
+    def process_frame(self, frame_num: int, image: Image.Image, model_handler) -> None:
+        self.process_batch([(frame_num, image)], model_handler)
+
+    def process_batch(self, batch: List[Tuple[int, Image.Image]], model_handler) -> None:
+        """Run detection on a batch of (frame_num, image) pairs in one model call"""
+        pil_images = [image for _, image in batch]
+        batch_results = self.detect_frames(pil_images, model_handler)
+
+        for (frame_num, _), pil_image, detection_results in zip(batch, pil_images, batch_results):
+            self.record_detections(frame_num, pil_image, detection_results)
+            self.mark_frame_done(frame_num)
+
+    def detect_frames(self, pil_images: List[Image.Image], model_handler) -> List[list]:
+        """Run the detector on prepared frames, one result list per frame
+
+        Frames whose perceptual hash is within DEDUP_MAX_DISTANCE of a recently
+        inferred frame reuse that frame's detections instead of calling the
+        model. Boxes are relative, so they scale to the new frame as is.
+        """
+        metrics.inc("frames_inferred", len(pil_images), self.video_name)
+        if DEDUP_MAX_DISTANCE < 0:
+            self.model_calls += len(pil_images)
+            return model_handler.detect_batch(pil_images, DETECTION_OBJECTS)
+
+        hashes = [compute_dhash(image) for image in pil_images]
+        # For every frame, the index of the frame in this batch it copies from, or itself if it is inferred
+        sources = []
+        reused = [None] * len(pil_images)
+        to_infer = []
+        for i, frame_hash in enumerate(hashes):
+            source = i
+            for recent_hash, detections in self.recent_signatures:
+                if hamming_distance(frame_hash, recent_hash) <= DEDUP_MAX_DISTANCE:
+                    reused[i] = detections
+                    break
+            else:
+                for j in to_infer:
+                    if hamming_distance(frame_hash, hashes[j]) <= DEDUP_MAX_DISTANCE:
+                        source = j
+                        break
+                else:
+                    to_infer.append(i)
+            sources.append(source)
+
+        inferred = dict(zip(to_infer, model_handler.detect_batch([pil_images[i] for i in to_infer], DETECTION_OBJECTS)))
+        self.model_calls += len(to_infer)
+        self.model_calls_saved += len(pil_images) - len(to_infer)
+        metrics.inc("frames_deduplicated", len(pil_images) - len(to_infer), self.video_name)
+
+        for i in to_infer:
+            self.recent_signatures.append((hashes[i], inferred[i]))
+        del self.recent_signatures[:-DEDUP_HISTORY]
+
+        results = []
+        for i, source in enumerate(sources):
+            if reused[i] is None and source == i:
+                results.append(inferred[i])
+                continue
+            # Copies, so annotating one frame never changes the detections of another
+            detections = reused[i] if reused[i] is not None else inferred[source]
+            results.append([dict(obj) for obj in detections])
+        return results
+
+    def record_detections(self, frame_num: int, pil_image: Image.Image, detection_results: list) -> None:
+        """Add detection results of a frame to the annotations and save the rendered frame"""
         if not detection_results:
             return
 
-        # Add image info to COCO annotations
-        self.annotations["images"].append(create_image_info(frame_num, pil_image))
+        metrics.inc("frames_annotated", 1, self.video_name)
+        metrics.inc("detections", len(detection_results), self.video_name)
+
+        # Image info and boxes are in source pixels, the frame may be prepared at a lower resolution
+        source_width, source_height = self.preparer.source_size
+        image_info = create_image_info(frame_num, pil_image, self.preparer.source_size, self.video_name)
+        self.annotations["images"].append(image_info)
+        self.journal.append_image(image_info)
 
         # Add detection results to COCO annotations
         for obj in detection_results:
@@ -200,24 +839,34 @@ class VideoProcessor:
                     self.annotation_id,
                     frame_num,
                     obj,
-                    pil_image.size[0],
-                    pil_image.size[1]
+                    source_width,
+                    source_height
                 )
                 self.annotations["annotations"].append(annotation)
+                self.journal.append_annotation(annotation)
                 self.annotation_id += 1
         
         self.frames_since_last_save += 1
         
-        # Save annotations every 10 frames or if it's the last frame
-        if self.frames_since_last_save >= 10:
-            self.save_coco_annotations()
+        # Checkpoint the journal and progress every few frames, the COCO file is written by finalize
+        if self.frames_since_last_save >= CHECKPOINT_EVERY:
+            self.checkpoint()
             self.frames_since_last_save = 0
         
         if SAVE_FRAME:
-            image_with_boxes = draw_boxes(pil_image, detection_results)
-            save_frame(self.video_path, image_with_boxes, frame_num)
+            if self.frame_writer is None:
+                self.frame_writer = FrameWriter()
+                self._owns_frame_writer = True
+            # The frame is not used after this point, so the writer may draw on it in place
+            self.frame_writer.submit(self.video_path, pil_image, detection_results, frame_num)
+
+    def checkpoint(self) -> None:
+        """Make journaled annotations durable and record progress"""
+        with metrics.timer("checkpoint", self.video_name):
+            self.journal.sync()
+            self._save_progress()
 
     def save_coco_annotations(self) -> None:
-        """Save COCO annotations to file"""
-        save_coco_annotations(self.annotations, self.video_path)
+        """Compact the journal into the COCO annotation file"""
+        self.journal.compact(self.annotations)
         self._save_progress()  # Save progress along with annotations
\ No newline at end of file